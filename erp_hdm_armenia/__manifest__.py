@@ -11,6 +11,15 @@
         'views/product.xml',
         'views/log.xml',
         'views/hdm_receipt.xml',
+        'views/hdm_outbox.xml',
+        'views/hdm_fiscal_report.xml',
+        'views/hdm_fleet.xml',
+        'views/account_move.xml',
+
+        'data/hdm_outbox_data.xml',
+        'data/hdm_fleet_data.xml',
+        'data/hdm_health_data.xml',
+        'data/hdm_invoice_data.xml',
 
         'security/ir.model.access.csv'
     ],
@@ -0,0 +1,28 @@
+import hmac
+
+from odoo import http
+from odoo.http import request
+from odoo.tools import config
+
+from odoo.addons.erp_hdm_armenia.utils.hdm_metrics import HDM_METRICS
+
+
+class HdmMetricsController(http.Controller):
+
+    @http.route('/hdm/metrics', type='http', auth='none', methods=['GET'], save_session=False)
+    def hdm_metrics(self, **kwargs):
+        """Prometheus scrape endpoint of the HDM operation metrics of this worker.
+
+        Disabled until ``hdm_metrics_token`` is set in the server configuration
+        file; the scraper sends it as ``Authorization: Bearer <token>``.
+        """
+        token = config.get('hdm_metrics_token')
+        if not token:
+            return request.not_found()
+        supplied = request.httprequest.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not hmac.compare_digest(supplied.encode(), str(token).encode()):
+            return request.make_response('Forbidden', status=403)
+        return request.make_response(HDM_METRICS.render(), headers=[
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Cache-Control', 'no-store'),
+        ])
@@ -5,4 +5,7 @@ from . import hdm
 from . import product
 from . import hdm_invoice
 from . import hdm_logs
+from . import hdm_outbox
+from . import hdm_fiscal_report
+from . import hdm_fleet
 
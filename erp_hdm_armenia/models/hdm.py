@@ -1,21 +1,57 @@
 import logging
-import struct
-import json
+import threading
+from contextlib import contextmanager
+from datetime import datetime, time, timezone
 
-from odoo import fields, models, _
+import pytz
+
+from odoo import api, fields, models, _
 from odoo.exceptions import ValidationError, AccessError
 
 from odoo.addons.erp_hdm_armenia.utils.hdm_socket import HDM
-from odoo.addons.erp_hdm_armenia.utils.utils import unpack_hdm_key, unpack_hdm_response, hdm_error_codes
+from odoo.addons.erp_hdm_armenia.utils.hdm_async import HdmClient
+from odoo.addons.erp_hdm_armenia.utils.hdm_dispatcher import (
+    HDM_DISPATCHER, DeviceBusyError, DeviceTurn, advisory_lock, advisory_unlock,
+)
+from odoo.addons.erp_hdm_armenia.utils.hdm_metrics import HDM_METRICS
+from odoo.addons.erp_hdm_armenia.utils.hdm_codec import (
+    CODES_WITH_RESPONSES, HdmFrameTooLarge, decode_result, is_unanswered,
+)
+from odoo.addons.erp_hdm_armenia.utils.hdm_fleet import FLEET_OPERATIONS, run_fleet
+from odoo.addons.erp_hdm_armenia.utils.hdm_health import HDM_BREAKERS, probe_hosts
+from odoo.addons.erp_hdm_armenia.utils.hdm_timeouts import HDM_TIMEOUTS
+
+from .hdm_logs import HDM_LOG_BUFFER
+
+REPORT_TYPE_CODES = {'x': 1, 'z': 2}
+FLEET_WORKERS = 8
+# Device statuses after which a pooled receipt is printed on the next device: out of paper.
+FAILOVER_STATUSES = (145,)
+# Seconds a pooled receipt waits for a busy device before trying the next one.
+POOL_QUEUE_TIMEOUT = 5
 
 _logger = logging.getLogger(__name__)
 
 
+def hdm_error_status(error) -> int | None:
+    """Device status of an ``'<status>: <message>'`` error, None for errors raised before the device answered."""
+    status = str(error).split(':', 1)[0].strip()
+    return int(status) if status.isdigit() else None
+
+
+class HdmUnreachableError(ValidationError):
+    """The device could not be reached, so nothing was sent to it."""
+
+
+class HdmBusyError(ValidationError):
+    """The device stayed busy with other requests, so nothing was sent to it."""
+
+
 class HdmReceipt(models.Model):
     _name = 'hdm.receipt'
     _description = 'HDM Receipt'
 
-    name = fields.Char(string='Ֆիսկալ կոդ', help='HDM-ի կողմից տրված Ֆիսկալ կոդ')
+    name = fields.Char(string='Ֆիսկալ կոդ', help='HDM-ի կողմից տրված Ֆիսկալ կոդ', index='trigram')
     hdm_type = fields.Selection([
         ('1', 'Պարզ կտրոն'),
         ('2', 'Ապրանքներ ռեժիմ'),
@@ -34,6 +70,78 @@ class HdmReceipt(models.Model):
 
     related_model_name = fields.Char(string='Related Model Name')
     related_model_id = fields.Integer(string='Related Model ID')
+    line_index = fields.Json(string='Item Positions', readonly=True,
+                             help='Position (rpid) of each source line id in the items sent to HDM')
+
+    _crn_rseq_idx = models.Index('(crn, rseq)')
+    _related_model_idx = models.Index('(related_model_name, related_model_id)')
+
+    @api.model
+    def _find_by_number(self, crn, rseq) -> 'HdmReceipt':
+        """The receipt printed by the device ``crn`` under the sequence number ``rseq``."""
+        if not crn or not rseq:
+            return self.browse()
+        return self.search([('crn', '=', str(crn)), ('rseq', '=', str(rseq))], order='id desc', limit=1)
+
+    @api.model
+    def _find_for_record(self, record, hdm_types=('1', '2', '3')) -> 'HdmReceipt':
+        """The latest sale receipt printed for ``record``, returns excluded by default."""
+        if not record:
+            return self.browse()
+        return self.search([
+            ('related_model_name', '=', record._name),
+            ('related_model_id', '=', record.id),
+            ('hdm_type', 'in', list(hdm_types)),
+        ], order='id desc', limit=1)
+
+    @api.model
+    def search_fiscal_code(self, fiscal_code, limit=10) -> list:
+        """Receipts of the allowed companies whose fiscal code matches ``fiscal_code``.
+
+        An exact match is returned alone; otherwise codes containing the
+        text are searched through the trigram index of ``name``.
+        """
+        fiscal_code = (fiscal_code or '').strip()
+        if not fiscal_code:
+            return []
+        field_names = ['name', 'hdm_type', 'crn', 'rseq', 'total', 'related_model_name', 'related_model_id',
+                       'create_date']
+        company_domain = [('company_id', 'in', self.env.companies.ids + [False])]
+        receipts = self.search_fetch([('name', '=', fiscal_code)] + company_domain, field_names, limit=1)
+        if not receipts and len(fiscal_code) >= 3:
+            receipts = self.search_fetch([('name', 'ilike', fiscal_code)] + company_domain, field_names,
+                                         order='id desc', limit=limit)
+        return receipts.read(field_names)
+
+    @api.model
+    def _create_from_response(self, response, hdm_type, record=None, related_receipt=None, line_ids=None):
+        """Create the receipt described by a successful device response.
+
+        ``line_ids`` are the source lines in the order their items were sent;
+        returns later refer to an item by that position.
+        """
+        vals = {
+            'rseq': response.get('rseq', ''),
+            'name': response.get('fiscal', ''),
+            'crn': response.get('crn', ''),
+            'hdm_type': str(hdm_type),
+            'total': response.get('total', 0.0),
+        }
+        if record:
+            vals.update({
+                'related_model_name': record._name,
+                'related_model_id': record.id,
+            })
+        if related_receipt:
+            vals['related_hdm_receipt_id'] = related_receipt.id
+        if line_ids:
+            vals['line_index'] = {str(line_id): position for position, line_id in enumerate(line_ids)}
+        return self.sudo().create(vals)
+
+    def _get_line_positions(self) -> dict:
+        """``{line id: rpid}`` of the items of this receipt, empty for receipts created without it."""
+        self.ensure_one()
+        return {int(line_id): position for line_id, position in (self.line_index or {}).items()}
 
     def action_open_related_record(self):
         self.ensure_one()
@@ -50,7 +158,7 @@ class HdmReceipt(models.Model):
 class HDMConnection(models.Model):
     _name = 'hdm.connection'
     _description = 'HDM Connection Settings'
-    _code_with_responses = [2, 4, 6]
+    _code_with_responses = CODES_WITH_RESPONSES
 
     name = fields.Char(string='Terminal ID')
     host = fields.Char(string='HOST')
@@ -63,7 +171,34 @@ class HDMConnection(models.Model):
     hdm_seq = fields.Integer(string='sequence', default=1)
     company_id = fields.Many2one('res.company', string='Company', default=lambda self: self.env.company, required=True)
     use_ext_pos = fields.Boolean(string='Use External POS', default=False)
+    hdm_invoices = fields.Boolean(string='Fiscalize Invoices', default=False,
+                                  help='Print the receipts of invoices fiscalized in bulk. Without any such device, '
+                                       'the default HDM connection of the company is used.')
     active = fields.Boolean(string='Active', default=True)
+    hdm_queue_depth = fields.Integer(string='Queued Requests', compute='_compute_hdm_queue_stats',
+                                     help='Requests waiting for or being served by this device in this server process')
+    hdm_queue_wait = fields.Float(string='Average Queue Wait (ms)', compute='_compute_hdm_queue_stats')
+    hdm_queue_max_wait = fields.Float(string='Max Queue Wait (ms)', compute='_compute_hdm_queue_stats')
+    hdm_crn = fields.Char(string='Device CRN', readonly=True, copy=False, index='btree_not_null',
+                          help='Registration number of the device, learned from its receipts')
+    hdm_status = fields.Selection([
+        ('unknown', 'Unknown'),
+        ('up', 'Online'),
+        ('down', 'Offline'),
+    ], string='Status', default='unknown', readonly=True, copy=False)
+    hdm_last_rtt = fields.Float(string='Last RTT (ms)', readonly=True, copy=False)
+    hdm_last_error = fields.Char(string='Last Error', readonly=True, copy=False)
+    hdm_last_check = fields.Datetime(string='Status Since', readonly=True, copy=False,
+                                     help='When the health monitor last saw the status change')
+    hdm_connect_timeout_floor = fields.Float(string='Connect Timeout Floor (s)', default=1.0)
+    hdm_connect_timeout_ceiling = fields.Float(string='Connect Timeout Ceiling (s)', default=10.0)
+    hdm_read_timeout_floor = fields.Float(string='Read Timeout Floor (s)', default=5.0)
+    hdm_read_timeout_ceiling = fields.Float(string='Read Timeout Ceiling (s)', default=60.0,
+                                            help='Also used until enough answers of the same kind were timed')
+    hdm_connect_timeout = fields.Float(string='Connect Timeout (s)', compute='_compute_hdm_timeouts',
+                                       help='Current connect deadline, learned from recent connects in this process')
+    hdm_sale_timeout = fields.Float(string='Sale Timeout (s)', compute='_compute_hdm_timeouts',
+                                    help='Current deadline for the answer to a receipt of up to 10 items')
 
     @property
     def hdm_login_data(self):
@@ -85,66 +220,479 @@ class HDMConnection(models.Model):
         return False
 
     def get_response_status_code(self, response):
-        try:
-            response_status = struct.unpack('>H', response[5:7])[0]
-            if response_status != 200:
-                error_message = hdm_error_codes.get(response_status, 'Unknown Error')
-                return {'hdm_error': f'{response_status}: {error_message}'}
-        except Exception as E:
-            _logger.error(f'Error unpack response status from HDM: {E}')
+        if response is None:
             return {'hdm_error': 'Failed to unpack response status from HDM.'}
+        if not response.ok:
+            return {'hdm_error': response.error}
 
     def create_log_entry(self, error_data, request_data,  model=False, res_id=False):
         self.ensure_one()
         if ':' in str(error_data):
-            code, message = error_data.split(': ')
+            code, message = error_data.split(': ', 1)
         else:
             code, message = 'Unknown', str(error_data)
 
-        self.env['hdm.log'].create({
+        entry = {
             'name': f'HDM Request Error {code} - {message}',
-            'code': int(code),
+            'code': code,
             'terminal_id': self.id,
+            'company_id': self.company_id.id,
             'req_data': request_data,
             'model_name': model,
             'res_id': res_id,
-        })
+            'last_seen': fields.Datetime.now(),
+        }
+        # Written in bulk from its own cursor, outside the transaction of the sale.
+        if getattr(threading.current_thread(), 'testing', False):
+            self.env['hdm.log']._store_entries([entry])
+        else:
+            HDM_LOG_BUFFER.add(self.env.cr.dbname, entry)
 
-    def send_request_to_hdm(self, id, code, data):
+    @property
+    def hdm_session_id(self):
+        self.ensure_one()
+        return f'hdm_{self.id}'
+
+    @property
+    def hdm_metrics_device(self):
+        """Label of the device in the HDM metrics."""
+        self.ensure_one()
+        return self.name or self.hdm_session_id
+
+    def _compute_hdm_queue_stats(self):
+        for connection in self:
+            stats = HDM_DISPATCHER.stats(connection.hdm_session_id) if connection.id else {}
+            connection.hdm_queue_depth = stats.get('depth', 0)
+            connection.hdm_queue_wait = stats.get('avg_wait', 0.0) * 1000
+            connection.hdm_queue_max_wait = stats.get('max_wait', 0.0) * 1000
+
+    def _hdm_timeouts(self):
+        """Connect and read deadlines of the device, within its configured floor and ceiling."""
+        self.ensure_one()
+        return HDM_TIMEOUTS.get(self.hdm_session_id, self.hdm_connect_timeout_floor, self.hdm_connect_timeout_ceiling,
+                                self.hdm_read_timeout_floor, self.hdm_read_timeout_ceiling)
+
+    @api.depends('hdm_connect_timeout_floor', 'hdm_connect_timeout_ceiling', 'hdm_read_timeout_floor',
+                 'hdm_read_timeout_ceiling')
+    def _compute_hdm_timeouts(self):
+        for connection in self:
+            timeouts = connection._hdm_timeouts() if connection.id else None
+            connection.hdm_connect_timeout = timeouts.connect_timeout() if timeouts else 0.0
+            connection.hdm_sale_timeout = timeouts.read_timeout(4, 1) if timeouts else 0.0
+
+    def _hdm_next_seq(self, cr=None) -> int:
+        """Allocate the next request sequence number of the device.
+
+        The counter is advanced in its own committed transaction, on ``cr``
+        (the cursor of the device turn) or a new cursor, so callers in other
+        workers never get the same number and the sale transaction never
+        updates the hdm.connection row that every till shares.
+        """
+        self.ensure_one()
+        if cr is None:
+            with self.env.registry.cursor() as cr:
+                return self._hdm_next_seq(cr)
+        cr.execute("UPDATE hdm_connection SET hdm_seq = hdm_seq + 1 WHERE id = %s RETURNING hdm_seq - 1", [self.id])
+        seq = cr.fetchone()[0]
+        cr.commit()
+        return seq
+
+    def _hdm_store_crn(self, crn):
+        """Remember the registration number the device printed, without touching the caller's transaction."""
+        self.ensure_one()
+        with self.env.registry.cursor() as cr:
+            cr.execute("UPDATE hdm_connection SET hdm_crn = %s WHERE id = %s AND hdm_crn IS DISTINCT FROM %s",
+                       [crn, self.id, crn])
+        self.invalidate_recordset(['hdm_crn'])
+
+    @contextmanager
+    def _hdm_turn(self, code, timeout=None):
+        """Wait until this caller may talk to the device, among the threads of this process and across workers.
+
+        ``HDM_DISPATCHER`` grants the turn within the process, then a session
+        advisory lock, held by a cursor of its own, keeps the other workers off
+        the device. That cursor only runs short committed transactions, so no
+        snapshot is held while the device prints: reading the session key,
+        allocating the sequence numbers and, at the end, storing the key. The
+        key travels with the lock, so workers share one login instead of
+        displacing each other's.
+
+        Yields a ``DeviceTurn``; raises ``DeviceBusyError`` when the turn does
+        not come within ``timeout`` seconds.
+        """
+        self.ensure_one()
+        session_id = self.hdm_session_id
+        timeout = HDM_DISPATCHER.timeout if timeout is None else timeout
+        with HDM_DISPATCHER.turn(session_id, code, timeout=timeout) as wait:
+            with self.env.registry.cursor() as cr:
+                try:
+                    wait += advisory_lock(cr, self.id, timeout=max(0.0, timeout - wait))
+                finally:
+                    # The key is read in a new snapshot, taken once the previous holder stored its key.
+                    cr.rollback()
+                try:
+                    cr.execute("SELECT hdm_key FROM hdm_connection WHERE id = %s", [self.id])
+                    HDM.adopt(session_id, cr.fetchone()[0])
+                    cr.commit()
+                    yield DeviceTurn(wait, lambda: self._hdm_next_seq(cr))
+                finally:
+                    cr.rollback()
+                    self._hdm_store_key(cr, HDM.sessions.get(session_id) or None)
+                    advisory_unlock(cr, self.id)
+                    cr.commit()
+
+    def _hdm_store_key(self, cr, key):
+        """Store the session key left by a turn for the next worker; a failure only costs that worker a login.
+
+        Called once the device answered, so it must never fail the request.
+        """
+        try:
+            cr.execute("UPDATE hdm_connection SET hdm_key = %s WHERE id = %s AND hdm_key IS DISTINCT FROM %s",
+                       [key, self.id, key])
+            cr.commit()
+        except Exception as e:
+            _logger.warning('HDM %s: the session key could not be stored: %s', self.hdm_session_id, e)
+            cr.rollback()
+
+    @api.model
+    def _find_by_crn(self, crn) -> 'HDMConnection':
+        """The device whose receipts carry the registration number ``crn``."""
+        if not crn:
+            return self.browse()
+        return self.search([('hdm_crn', '=', str(crn))], limit=1)
+
+    def _hdm_set_health(self, status, rtt=None, error=''):
+        """Store a change of the health of the device in its own transaction and notify the clients.
+
+        The record is left alone while the status stays the same: it is shared
+        by every till, and ``hdm_last_check`` is when the status last changed.
+        """
+        self.ensure_one()
+        with self.env.registry.cursor() as cr:
+            cr.execute("""
+                UPDATE hdm_connection
+                   SET hdm_status = %s, hdm_last_error = %s, hdm_last_check = now() AT TIME ZONE 'UTC',
+                       hdm_last_rtt = COALESCE(%s, hdm_last_rtt)
+                 WHERE id = %s AND hdm_status IS DISTINCT FROM %s
+             RETURNING id
+            """, [status, error or None, rtt, self.id, status])
+            if cr.fetchone():
+                _logger.info('HDM %s is now %s %s', self.name, status, error)
+                self.with_env(self.env(cr=cr))._hdm_notify_status(status, error)
+        self.invalidate_recordset(['hdm_status', 'hdm_last_rtt', 'hdm_last_error', 'hdm_last_check'])
+
+    def _hdm_notify_status(self, status, error):
+        """Hook to push a status change of the device to its clients."""
+
+    def _hdm_breaker(self):
+        """The circuit breaker of the device, opened too when another process saw it down."""
+        self.ensure_one()
+        breaker = HDM_BREAKERS.get(self.hdm_session_id)
+        if self.hdm_status == 'down' and self.hdm_last_check:
+            breaker.observe_down(self.hdm_last_check.replace(tzinfo=timezone.utc).timestamp(), self.hdm_last_error)
+        return breaker
+
+    @api.model
+    def _cron_check_health(self):
+        connections = self.search([('host', '!=', False), ('port', '!=', False)])
+        limit = int(self.env['ir.config_parameter'].sudo().get_param('erp_hdm_armenia.fleet_workers', FLEET_WORKERS))
+        results = probe_hosts([connection.hdm_host for connection in connections], limit=limit)
+        for connection, (reachable, rtt, error) in zip(connections, results):
+            breaker = HDM_BREAKERS.get(connection.hdm_session_id)
+            if reachable:
+                breaker.record_success()
+                connection._hdm_set_health('up', rtt=rtt * 1000)
+            else:
+                breaker.record_failure(error)
+                connection._hdm_set_health('down', error=error)
+
+    def send_request_to_hdm(self, id, code, data, queue_timeout=None):
+        """Send ``data`` to the device over its shared authenticated session.
+
+        ``id`` identifies the caller (till, kiosk, button) in the logs; the
+        session itself belongs to the device, so every caller reuses the same
+        login until the device rejects its key. Callers of the same device are
+        served one at a time, sales and returns first. Every phase of the call
+        is timed in ``HDM_METRICS``. A device known to be down is not contacted
+        until its circuit breaker lets a request through again. ``queue_timeout``
+        overrides how long to wait for a busy device.
+        """
         self.ensure_one()
         pos_connection = self
+        session_id = pos_connection.hdm_session_id
+        timer = HDM_METRICS.timer(pos_connection.hdm_metrics_device, code)
+        _logger.info('HDM request %s from %s to %s', code, id, pos_connection.name)
+        breaker = pos_connection._hdm_breaker()
+        if not breaker.allow():
+            timer.finish('circuit_open')
+            raise HdmUnreachableError(_("HDM %(device)s is offline (%(error)s). Next attempt in %(seconds)s s.",
+                                        device=pos_connection.name, error=breaker.last_error,
+                                        seconds=round(breaker.retry_in())))
         try:
-            HDM.close(id=id, connection=pos_connection)
-        except ConnectionError:
-            _logger.info('No existing HDM connection to close.')
-        connection = HDM.connect(host=pos_connection.hdm_host, id=id)
-        if connection is None:
-            raise ValidationError(_("Unable to connect to HDM. Please check the HOST and PORT settings."))
-        response = HDM.send(id=id, data=pos_connection.hdm_login_data, code=2, connection=pos_connection)
-        if self.check_waiting_for_response(code):
+            with pos_connection._hdm_turn(code, timeout=queue_timeout) as turn:
+                timer.add('queue', turn.wait)
+                response = HDM.request(id=session_id, host=pos_connection.hdm_host, data=data, code=code,
+                                       connection=pos_connection, next_seq=turn.next_seq,
+                                       timer=timer, timeouts=pos_connection._hdm_timeouts())
+                key = HDM.sessions.get(session_id, '')
+        except DeviceBusyError as E:
+            timer.finish('busy')
+            _logger.error('HDM queue timeout: %s', E)
+            raise HdmBusyError(_("The HDM device is busy with other requests. Please try again."))
+        except HdmFrameTooLarge as E:
+            # Raised while encoding, before anything was written to the socket.
+            timer.finish('too_large')
+            _logger.error('HDM request %s from %s not sent: %s', code, id, E)
+            return {'hdm_error': _("The receipt is too large for the HDM device. Split it into smaller receipts.")}
+        except ConnectionError as E:
+            timer.finish('unreachable')
+            _logger.error('Error connecting to HDM: %s', E)
+            breaker.record_failure(E)
+            if breaker.state != 'closed' and pos_connection.hdm_status != 'down':
+                pos_connection._hdm_set_health('down', error=str(E))
+            raise HdmUnreachableError(_("Unable to connect to HDM. Please check the HOST and PORT settings."))
+        breaker.record_success()
+        if pos_connection.hdm_status == 'down':
+            pos_connection._hdm_set_health('up')
+        with timer.phase('decrypt'):
+            result = decode_result(response, key, code)
+        if response is None:
+            timer.finish('no_response')
+        else:
+            timer.finish('unreadable' if result is False and response.length else response.status)
+        if result and result.get('crn') and str(result['crn']) != pos_connection.hdm_crn:
+            pos_connection._hdm_store_crn(str(result['crn']))
+        return result
+
+    @api.model
+    def _hdm_can_queue(self, code, data) -> bool:
+        """Whether a request may be fiscalized later.
+
+        Card amounts the device charges itself (no external POS) cannot: the
+        money is only collected when the device answers.
+        """
+        card_amount = data.get('paidAmountCard') if code == 4 else data.get('cardAmountForReturn')
+        return not card_amount or bool(data.get('useExtPOS'))
+
+    def send_or_enqueue(self, id, code, data, record=None, hdm_type=False):
+        """``send_request_to_hdm`` that parks the request in the fiscal outbox instead of failing.
+
+        Unreachable devices are retried automatically; a request that got no
+        answer, or no readable one, may already be printed, so it waits for a
+        manual check.
+        Returns ``{'queued': True, 'hdm_outbox_id': id}`` when the request was queued.
+        """
+        self.ensure_one()
+        can_queue = self._hdm_can_queue(code, data)
+        try:
+            response = self.send_request_to_hdm(id=id, code=code, data=data)
+        except HdmUnreachableError as E:
+            if not can_queue:
+                raise
+            entry = self.env['hdm.outbox'].enqueue(self, code, data, record, hdm_type, error=str(E))
+            return {'queued': True, 'hdm_outbox_id': entry.id}
+        return self._hdm_check_answer(code, data, response, record, hdm_type)
+
+    def _hdm_check_answer(self, code, data, response, record=None, hdm_type=False):
+        """``response``, or the queued entry to verify when the device may have printed without answering."""
+        self.ensure_one()
+        if is_unanswered(response) and self._hdm_can_queue(code, data):
+            entry = self.env['hdm.outbox'].enqueue(
+                self, code, data, record, hdm_type, state='check',
+                error=_('No answer from HDM, check the last receipt on the device.'))
+            return {'queued': True, 'hdm_outbox_id': entry.id}
+        return response
+
+    def _hdm_route(self) -> 'HDMConnection':
+        """Devices of ``self`` in the order a pooled receipt tries them.
+
+        Devices neither known to be down nor behind an open breaker come first,
+        the least loaded first; the load is the number of requests this process
+        is sending to the device. Ties keep the order of ``self``.
+        """
+        position = {connection.id: index for index, connection in enumerate(self)}
+        return self.sorted(lambda connection: (
+            connection.hdm_status == 'down' or connection._hdm_breaker().state == 'open',
+            HDM_DISPATCHER.queue(connection.hdm_session_id).depth,
+            position[connection.id],
+        ))
+
+    def send_pooled(self, id, code, data, record=None, hdm_type=False) -> tuple:
+        """``send_or_enqueue`` over the pool of devices in ``self``.
+
+        The receipt goes to the first device of ``_hdm_route``. It moves on to
+        the next one only when it provably was not printed: the device is
+        unreachable or behind an open breaker, still busy after
+        ``POOL_QUEUE_TIMEOUT`` seconds, or refused it for lack of paper. The
+        last device queues it like ``send_or_enqueue``. A request that got no
+        readable answer may have been printed and is never sent again.
+        Returns ``(device, response)``.
+        """
+        route = self._hdm_route()
+        for connection in route[:-1]:
             try:
-                response_status = struct.unpack('>H', response[5:7])[0]
-            except Exception as E:
-                _logger.error(f'Error unpack response status from HDM: {E}')
-                raise ValidationError(_("Failed to receive a valid response from HDM. Please try again."))
-            else:
-                if response_status == 200:
-                    unpack_key = json.loads(unpack_hdm_key(pos_connection.hdm_password, response[11:])).get('key')
-                    if unpack_key:
-                        pos_connection.write({'hdm_key': unpack_key})
+                response = connection.send_request_to_hdm(id=id, code=code, data=dict(data),
+                                                           queue_timeout=POOL_QUEUE_TIMEOUT)
+            except (HdmUnreachableError, HdmBusyError) as E:
+                _logger.info('HDM %s skipped for %s: %s', connection.name, id, E)
+                continue
+            error = response and response.get('hdm_error')
+            if error and hdm_error_status(error) in FAILOVER_STATUSES:
+                connection.create_log_entry(error, request_data=data, model=record and record._name,
+                                            res_id=record and record.id)
+                continue
+            return connection, connection._hdm_check_answer(code, data, response, record, hdm_type)
+        connection = route[-1:]
+        return connection, connection.send_or_enqueue(id=id, code=code, data=data, record=record, hdm_type=hdm_type)
+
+    def _hdm_client(self, **kwargs) -> HdmClient:
+        """Return the blocking facade of this device's asyncio client."""
+        self.ensure_one()
+        return HdmClient(self.hdm_session_id, self.hdm_host, self.hdm_password, self.hdm_login_data, **kwargs)
+
+    def send_request_with_client(self, id, code, data):
+        """Same contract as ``send_request_to_hdm``, through the asyncio client."""
+        self.ensure_one()
+        _logger.info(f'HDM request {code} from {id} to {self.name} (async client)')
+        client = self._hdm_client()
         try:
-            response = HDM.send(id=id, data=data, code=code, connection=pos_connection)
-            if self.check_waiting_for_response(code):
-                error_code = self.get_response_status_code(response)
-                if error_code:
-                    return error_code
-            unpack_data = json.loads(unpack_hdm_response(pos_connection.hdm_key, response[11:]))
-            return unpack_data
-        except Exception as E:
-            _logger.error(f'Error recv data to HDM: {E}')
-            return False
-        finally:
-            HDM.close(id=id, connection=pos_connection)
+            with self._hdm_turn(code) as turn:
+                response = client.request(code, data, next_seq=turn.next_seq)
+        except DeviceBusyError as E:
+            _logger.error(f'HDM queue timeout: {E}')
+            raise HdmBusyError(_("The HDM device is busy with other requests. Please try again."))
+        except HdmFrameTooLarge as E:
+            _logger.error(f'HDM request {code} from {id} not sent: {E}')
+            return {'hdm_error': _("The receipt is too large for the HDM device. Split it into smaller receipts.")}
+        except ConnectionError as E:
+            _logger.error(f'Error connecting to HDM: {E}')
+            raise HdmUnreachableError(_("Unable to connect to HDM. Please check the HOST and PORT settings."))
+        return response
+
+    def _hdm_timestamp(self, day, end=False) -> int:
+        """Milliseconds since the epoch at the start, or the end, of ``day`` in the user's timezone."""
+        tz = pytz.timezone(self.env.user.tz or 'Asia/Yerevan')
+        return int(tz.localize(datetime.combine(day, time.max if end else time.min)).timestamp() * 1000)
+
+    def _hdm_fetch_fiscal_report(self, report_type, date_from, date_to, filters=None) -> dict:
+        """Ask the device for the report of one window of at most two months."""
+        self.ensure_one()
+        data = {
+            'seq': self.hdm_seq,
+            'reportType': REPORT_TYPE_CODES[report_type],
+            'startDate': self._hdm_timestamp(date_from),
+            'endDate': self._hdm_timestamp(date_to, end=True),
+            **(filters or {}),
+        }
+        response = self.send_request_to_hdm(id=f'report_{self.id}', code=9, data=data)
+        if response is False or response.get('hdm_error'):
+            error = response and response.get('hdm_error') or 'Unknown HDM error occurred.'
+            self.create_log_entry(error, request_data=data, model=self._name, res_id=self.id)
+            raise ValidationError(error)
+        return response
+
+    def get_fiscal_report(self, date_from, date_to, report_type='x', filters=None):
+        """Fiscal reports of the device for any date range, split into windows the device accepts.
+
+        ``filters`` holds at most one of the device report filters, e.g.
+        ``{'cashierId': 3}``. Returns the ``hdm.fiscal.report`` of every window.
+        """
+        self.ensure_one()
+        return self.env['hdm.fiscal.report']._get_reports(self, date_from, date_to, report_type, filters)
+
+    def action_fetch_fiscal_reports(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Fetch Fiscal Reports'),
+            'res_model': 'hdm.fiscal.report.wizard',
+            'view_mode': 'form',
+            'target': 'new',
+            'context': {'default_connection_id': self.id},
+        }
+
+    def action_open_fiscal_reports(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Fiscal Reports'),
+            'res_model': 'hdm.fiscal.report',
+            'view_mode': 'list,form',
+            'domain': [('connection_id', '=', self.id)],
+            'context': {'default_connection_id': self.id},
+        }
+
+    def _hdm_run_fleet(self, operation) -> list:
+        """Run ``operation`` (a key of ``FLEET_OPERATIONS``) on every device of ``self`` concurrently.
+
+        Returns one ``{'connection': record, 'status', 'message', 'seconds',
+        'queue_wait'}`` per device, in the order of ``self``. Devices refuse
+        concurrent work only for themselves, so up to
+        ``erp_hdm_armenia.fleet_workers`` devices are driven at once.
+        """
+        code = FLEET_OPERATIONS[operation]
+        limit = int(self.env['ir.config_parameter'].sudo().get_param('erp_hdm_armenia.fleet_workers', FLEET_WORKERS))
+        calls, connections, outcomes = [], [], dict()
+        for connection in self:
+            if not (connection.host and connection.port and connection.cashier):
+                outcomes[connection.id] = {'status': 'failed', 'message': _('HOST, PORT or cashier is missing.'),
+                                           'seconds': 0.0, 'queue_wait': 0.0}
+                continue
+            calls.append({
+                'client': connection._hdm_client().client,
+                'device': connection.hdm_metrics_device,
+                'code': code,
+                'data': {},
+                'turn': connection._hdm_turn(code),
+            })
+            connections.append(connection)
+        _logger.info('HDM fleet %s on %s device(s)', operation, len(calls))
+        for connection, call, outcome in zip(connections, calls, run_fleet(calls, limit=limit)):
+            outcomes[connection.id] = outcome
+            if outcome['status'] != 'ok':
+                connection.create_log_entry(outcome['message'] or outcome['status'], request_data=call['data'],
+                                            model=self._name, res_id=connection.id)
+        return [dict(outcomes[connection.id], connection=connection) for connection in self]
+
+    @api.model
+    def _cron_fleet_operation(self, operation='sync_time'):
+        results = self.search([])._hdm_run_fleet(operation)
+        failed = [result for result in results if result['status'] != 'ok']
+        _logger.info('HDM fleet %s: %s ok, %s failed', operation, len(results) - len(failed), len(failed))
+
+    def action_hdm_fleet(self, operation):
+        """Run ``operation`` on these devices and show the summary."""
+        return self.env['hdm.fleet.run'].create({
+            'operation': operation,
+            'connection_ids': [fields.Command.set(self.ids)],
+        }).action_run()
+
+    def _hdm_fleet_notification(self, operation, success_message):
+        """Run ``operation`` on this device only and report the outcome in a notification."""
+        self.ensure_one()
+        result = self._hdm_run_fleet(operation)[0]
+        if result['status'] == 'ok':
+            message, notification_type = success_message, 'success'
+        else:
+            message, notification_type = _('HDM %(device)s: %(error)s', device=self.name,
+                                           error=result['message'] or result['status']), 'warning'
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'target': 'new',
+            'params': {
+                'message': message,
+                'type': notification_type,
+                'sticky': False,
+                'next': {'type': 'ir.actions.act_window_close'},
+            }
+        }
+
+    def action_hdm_login_test(self):
+        return self.action_hdm_fleet('login')
+
+    def action_hdm_disconnect(self):
+        return self.action_hdm_fleet('disconnect')
 
     def sync_hdm_time(self):
         self.ensure_one()
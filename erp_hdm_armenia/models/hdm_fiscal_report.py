@@ -0,0 +1,118 @@
+from datetime import timedelta
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from odoo.addons.erp_hdm_armenia.utils.hdm_codec import encode_json
+from odoo.addons.erp_hdm_armenia.utils.utils import hdm_error_codes
+
+# The device refuses report ranges longer than two months (error 170).
+REPORT_MAX_MONTHS = 2
+
+
+class HdmFiscalReport(models.Model):
+    _name = 'hdm.fiscal.report'
+    _description = 'HDM Fiscal Report'
+    _order = 'connection_id, report_type, date_from'
+
+    connection_id = fields.Many2one('hdm.connection', string='HDM Device', required=True, index=True,
+                                    ondelete='cascade')
+    company_id = fields.Many2one(related='connection_id.company_id', store=True)
+    report_type = fields.Selection([
+        ('x', 'X Report'),
+        ('z', 'Z Report'),
+    ], string='Report Type', required=True, default='x')
+    filter_key = fields.Char(string='Filter', required=True, default='all',
+                             help='The single filter the report was requested with, as JSON')
+    date_from = fields.Date(string='From', required=True)
+    date_to = fields.Date(string='To', required=True)
+    data = fields.Json(string='Report Data', readonly=True)
+    final = fields.Boolean(string='Final', readonly=True,
+                           help='The period was closed when the report was fetched, so it is never fetched again')
+    fetch_date = fields.Datetime(string='Fetched On', readonly=True)
+
+    _window_uniq = models.Constraint(
+        'UNIQUE(connection_id, report_type, filter_key, date_from, date_to)',
+        'A fiscal report window is stored once per device, type and filter.',
+    )
+
+    @api.model
+    def _split_windows(self, date_from, date_to) -> list:
+        """``[(from, to), ...]`` windows the device accepts, covering the range in order.
+
+        Windows are calendar blocks of two months (January-February,
+        March-April, ...) clipped to the range, so overlapping ranges ask for
+        the same inner windows and reuse the stored final ones.
+        """
+        windows = []
+        start = date_from
+        while start <= date_to:
+            block = start.replace(month=start.month - (start.month - 1) % REPORT_MAX_MONTHS, day=1)
+            end = min(block + relativedelta(months=REPORT_MAX_MONTHS, days=-1), date_to)
+            windows.append((start, end))
+            start = end + timedelta(days=1)
+        return windows
+
+    @api.model
+    def _get_reports(self, connection, date_from, date_to, report_type='x', filters=None) -> 'HdmFiscalReport':
+        """Reports of ``connection`` covering ``date_from`` to ``date_to``, one per device window.
+
+        Windows that ended before today are final: once stored they are read
+        from the database. The others are fetched again and updated.
+        """
+        date_from, date_to = fields.Date.to_date(date_from), fields.Date.to_date(date_to)
+        if date_from > date_to:
+            raise UserError(_('The start date of the fiscal report is after its end date.'))
+        filters = {name: value for name, value in (filters or {}).items() if value not in (None, False, '')}
+        if len(filters) > 1:
+            raise UserError(hdm_error_codes[169])
+        filter_key = encode_json(filters) if filters else 'all'
+
+        stored = self.search([
+            ('connection_id', '=', connection.id),
+            ('report_type', '=', report_type),
+            ('filter_key', '=', filter_key),
+            ('date_from', '>=', date_from),
+            ('date_to', '<=', date_to),
+        ])
+        by_window = {(report.date_from, report.date_to): report for report in stored}
+        today = fields.Date.context_today(self)
+        reports = self.browse()
+        for start, end in self._split_windows(date_from, date_to):
+            report = by_window.get((start, end))
+            if not (report and report.final):
+                vals = {
+                    'data': connection._hdm_fetch_fiscal_report(report_type, start, end, filters),
+                    'final': end < today,
+                    'fetch_date': fields.Datetime.now(),
+                }
+                if report:
+                    report.write(vals)
+                else:
+                    report = self.create(dict(vals, connection_id=connection.id, report_type=report_type,
+                                              filter_key=filter_key, date_from=start, date_to=end))
+            reports |= report
+        return reports
+
+
+class HdmFiscalReportWizard(models.TransientModel):
+    _name = 'hdm.fiscal.report.wizard'
+    _description = 'Fetch HDM Fiscal Reports'
+
+    connection_id = fields.Many2one('hdm.connection', string='HDM Device', required=True)
+    report_type = fields.Selection([
+        ('x', 'X Report'),
+        ('z', 'Z Report'),
+    ], string='Report Type', required=True, default='x')
+    date_from = fields.Date(string='From', required=True,
+                            default=lambda self: fields.Date.context_today(self).replace(day=1))
+    date_to = fields.Date(string='To', required=True, default=fields.Date.context_today)
+
+    def action_fetch(self):
+        self.ensure_one()
+        reports = self.connection_id.get_fiscal_report(self.date_from, self.date_to, self.report_type)
+        action = self.connection_id.action_open_fiscal_reports()
+        action['domain'] = [('id', 'in', reports.ids)]
+        return action
@@ -0,0 +1,76 @@
+from odoo import api, fields, models, _
+
+FLEET_OPERATION_SELECTION = [
+    ('sync_time', 'Time Sync'),
+    ('login', 'Login Test'),
+    ('disconnect', 'Disconnect'),
+]
+
+
+class HdmFleetRun(models.TransientModel):
+    _name = 'hdm.fleet.run'
+    _description = 'HDM Fleet Operation'
+
+    operation = fields.Selection(FLEET_OPERATION_SELECTION, string='Operation', required=True, default='sync_time')
+    connection_ids = fields.Many2many('hdm.connection', string='HDM Devices',
+                                      default=lambda self: self._default_connection_ids())
+    line_ids = fields.One2many('hdm.fleet.run.line', 'run_id', string='Results', readonly=True)
+    done = fields.Boolean(readonly=True)
+    ok_count = fields.Integer(string='Succeeded', compute='_compute_summary')
+    failed_count = fields.Integer(string='Failed', compute='_compute_summary')
+    duration = fields.Float(string='Slowest Device (s)', compute='_compute_summary', digits=(16, 3))
+
+    @api.model
+    def _default_connection_ids(self):
+        if self.env.context.get('active_model') == 'hdm.connection' and self.env.context.get('active_ids'):
+            return self.env.context['active_ids']
+        return self.env['hdm.connection'].search([]).ids
+
+    @api.depends('line_ids.status', 'line_ids.seconds')
+    def _compute_summary(self):
+        for run in self:
+            run.ok_count = len(run.line_ids.filtered(lambda line: line.status == 'ok'))
+            run.failed_count = len(run.line_ids) - run.ok_count
+            run.duration = max(run.line_ids.mapped('seconds'), default=0.0)
+
+    def action_run(self):
+        self.ensure_one()
+        results = self.connection_ids._hdm_run_fleet(self.operation)
+        self.write({
+            'done': True,
+            'line_ids': [fields.Command.clear()] + [fields.Command.create({
+                'connection_id': result['connection'].id,
+                'status': result['status'],
+                'message': result['message'],
+                'seconds': result['seconds'],
+                'queue_wait': result['queue_wait'],
+            }) for result in results],
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('HDM Fleet Operation'),
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+
+class HdmFleetRunLine(models.TransientModel):
+    _name = 'hdm.fleet.run.line'
+    _description = 'HDM Fleet Operation Result'
+    _order = 'id'
+
+    run_id = fields.Many2one('hdm.fleet.run', required=True, ondelete='cascade')
+    connection_id = fields.Many2one('hdm.connection', string='HDM Device')
+    status = fields.Selection([
+        ('ok', 'OK'),
+        ('error', 'HDM Error'),
+        ('no_response', 'No Response'),
+        ('unreachable', 'Unreachable'),
+        ('busy', 'Busy'),
+        ('failed', 'Failed'),
+    ], string='Status')
+    message = fields.Char(string='Message')
+    seconds = fields.Float(string='Duration (s)', digits=(16, 3))
+    queue_wait = fields.Float(string='Queue Wait (s)', digits=(16, 3))
@@ -1,27 +1,46 @@
+import heapq
 import logging
+import threading
 
-from odoo import fields, models, _
+from odoo import api, fields, models, _
 from odoo.exceptions import ValidationError, AccessError
 
+from odoo.addons.erp_hdm_armenia.utils.hdm_metrics import HDM_METRICS
+
 _logger = logging.getLogger(__name__)
 
+# Invoices are fiscalized in goods mode, items in the taxable department unless their product says otherwise.
+INVOICE_HDM_TYPE = 2
+INVOICE_HDM_DEP = 1
+
 
 class HdmInvoiceLines(models.Model):
     _inherit = 'account.move.line'
 
     fiscal_receipt_id = fields.Many2one('hdm.receipt', related='move_id.fiscal_receipt_id', string='Fiscal Receipt', help='HDM Կտրոն')
 
-    def _prepare_hdm_item_data(self) -> dict:
+    def _prepare_hdm_item_data(self, fiscal_data=None) -> dict:
+        """``fiscal_data`` is the ``_get_hdm_fiscal_data`` of the invoice's products, when already read.
+
+        The device applies the discount itself, so a discounted item carries
+        its unit price before the discount, taxes included.
+        """
         self.ensure_one()
-        hs_code = self.product_id.hs_code or self.product_id.product_tmpl_id and self.product_id.product_tmpl_id.hs_code
+        if fiscal_data is None:
+            fiscal_data = self.product_id._get_hdm_fiscal_data()
+        product = fiscal_data.get(self.product_id.id, {})
+        price = round(self.price_total / self.quantity, 2) if self.quantity else 0.0
+        if self.discount:
+            price = round(self.tax_ids.compute_all(self.price_unit, self.currency_id, 1.0, product=self.product_id,
+                                                   partner=self.partner_id)['total_included'], 2)
         item = {
-            "dep": self.product_id.hdm_dep or 1,
-            "adgCode": hs_code,
+            "dep": product.get('dep') or INVOICE_HDM_DEP,
+            "adgCode": product.get('adgCode', False),
             "productCode": self.product_id.id,
-            "productName": self.product_id.hdm_product_name,
-            "qty": self.qty,
+            "productName": product.get('productName', False),
+            "qty": self.quantity,
             "unit": self.product_uom_id.name,
-            "price": self.price_total / self.qty,
+            "price": price,
         }
         if self.discount:
             item.update({
@@ -30,6 +49,11 @@ class HdmInvoiceLines(models.Model):
             })
         return item
 
+    def _prepare_hdm_items(self) -> list:
+        """Items of all lines in ``self``, with product data read once for the whole invoice."""
+        fiscal_data = self.product_id._get_hdm_fiscal_data()
+        return [line._prepare_hdm_item_data(fiscal_data) for line in self]
+
 
 class HdmInvoice(models.Model):
     _inherit = 'account.move'
@@ -45,11 +69,19 @@ class HdmInvoice(models.Model):
     rseq = fields.Char(string='Rseq', help='Կտրոնի հերթական համար')
     returned_rseq = fields.Char(string='Returned Rseq', help='Վերադարձի Կտրոնի հերթական համար')
     hdm_success = fields.Boolean(string='HDM Success', readonly=True, help='Հաջողությամբ ուղարկված է HDM')
+    hdm_to_fiscalize = fields.Boolean(string='To Fiscalize', readonly=True, copy=False,
+                                      help='Waiting to be queued for an HDM device')
+    hdm_outbox_id = fields.Many2one('hdm.outbox', string='Queued Fiscal Receipt', readonly=True, copy=False,
+                                    help='Fiscal receipt waiting in the HDM outbox')
+    hdm_outbox_state = fields.Selection(related='hdm_outbox_id.state', string='Fiscalization Status')
+    hdm_error = fields.Char(related='hdm_outbox_id.last_error', string='HDM Error')
+
+    _hdm_to_fiscalize_idx = models.Index('(id) WHERE hdm_to_fiscalize')
 
     def get_lines_without_downpayment(self):
         return self.invoice_line_ids.filtered(
-            lambda l: l.product_id.id != self.company_id.sale_down_payment_product_id.id).sorted(
-            'id')
+            lambda l: l.display_type == 'product'
+                      and l.product_id.id != self.company_id.sale_down_payment_product_id.id).sorted('id')
 
     def get_downpayment_lines(self):
         return self.invoice_line_ids.filtered(
@@ -57,7 +89,7 @@ class HdmInvoice(models.Model):
             'id')
 
     # sale_down_payment_product_id
-    def _prepare_invoice_hdm_data(self, hdm_dep, hdm_type) -> dict:
+    def _prepare_invoice_hdm_data(self, hdm_dep, hdm_type, connection=None) -> dict:
         self.ensure_one()
 
         cash_amount, bank_amount, prepayment_amount = 0, 0, 0
@@ -79,10 +111,113 @@ class HdmInvoice(models.Model):
             'eMarks': [],
             "mode": hdm_type,
             "partnerTin": None,
-            "seq": self.config_id.hdm_connection_id.hdm_seq,
+            "seq": connection.hdm_seq if connection else 0,
         }
         if hdm_type == 1:
             data['dep'] = hdm_dep
         if hdm_type == 2:
-            data['items'] = [line._prepare_hdm_item_data() for line in self.get_lines_without_downpayment()]
+            data['items'] = self.get_lines_without_downpayment()._prepare_hdm_items()
         return data
+
+    def _hdm_can_fiscalize(self) -> bool:
+        self.ensure_one()
+        # The receipt carries the amounts paid; the device refuses an unpaid one.
+        return (self.state == 'posted' and self.move_type == 'out_invoice' and not self.fiscal_receipt_id
+                and self.payment_state in ('paid', 'in_payment')
+                and self.hdm_outbox_state not in ('pending', 'check', 'sent', 'sent_error'))
+
+    def action_hdm_fiscalize(self):
+        """Mark the selected invoices to be fiscalized; the cron queues them for the company's devices."""
+        moves = self.filtered(lambda move: move._hdm_can_fiscalize())
+        moves.write({'hdm_to_fiscalize': True})
+        if moves:
+            self.env.ref('erp_hdm_armenia.ir_cron_hdm_fiscalize_invoices').sudo()._trigger()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'message': _('%(count)s of %(total)s invoices will be sent to HDM.', count=len(moves),
+                             total=len(self)),
+                'type': 'success' if moves else 'warning',
+                'sticky': False,
+            },
+        }
+
+    @api.model
+    def _hdm_invoice_connections(self, company):
+        """Devices of ``company`` to fiscalize invoices on, the ones not known to be down if there are any.
+
+        These are the devices marked to fiscalize invoices, or else the default
+        HDM connection of the company.
+        """
+        connections = self.env['hdm.connection'].sudo().search([
+            ('company_id', '=', company.id), ('hdm_invoices', '=', True), ('host', '!=', False), ('port', '!=', False)])
+        if not connections:
+            connections = company.sudo().default_hdm_connection_id.filtered(
+                lambda connection: connection.host and connection.port)
+        return connections.filtered(lambda connection: connection.hdm_status != 'down') or connections
+
+    @api.model
+    def _cron_hdm_fiscalize_invoices(self, batch_size=500):
+        """Queue the invoices marked to fiscalize in the HDM outbox, spread over the devices of their company.
+
+        Each invoice goes to the device with the fewest pending entries, so the
+        outbox drains the batch on all devices at once. Every batch is committed
+        and a full one triggers the cron again, so a large selection is queued
+        in consecutive runs and resumes where it stopped.
+        """
+        moves = self.search([('hdm_to_fiscalize', '=', True)], order='id', limit=batch_size)
+        outbox = self.env['hdm.outbox']
+        for company in moves.company_id:
+            company_moves = moves.filtered(lambda move: move.company_id == company)
+            connections = self._hdm_invoice_connections(company)
+            if not connections:
+                _logger.warning('No HDM device to fiscalize %s invoices of %s', len(company_moves), company.name)
+                company_moves.write({'hdm_to_fiscalize': False})
+                continue
+            pending = dict(outbox._read_group([('connection_id', 'in', connections.ids), ('state', '=', 'pending')],
+                                              ['connection_id'], ['__count']))
+            load = [(pending.get(connection, 0), connection.id, connection) for connection in connections]
+            heapq.heapify(load)
+            for move in company_moves:
+                if not move._hdm_can_fiscalize():
+                    move.hdm_to_fiscalize = False
+                    continue
+                count, connection_id, connection = heapq.heappop(load)
+                hdm_type = int(move.hdm_type or INVOICE_HDM_TYPE)
+                try:
+                    with self.env.cr.savepoint():
+                        data = move._prepare_invoice_hdm_data(INVOICE_HDM_DEP, hdm_type, connection)
+                        entry = outbox.enqueue(connection, 4, data, record=move, hdm_type=hdm_type)
+                        move.write({'hdm_to_fiscalize': False, 'hdm_outbox_id': entry.id,
+                                    'hdm_type': str(hdm_type)})
+                except Exception as e:
+                    # One invoice must not hold back the batch, nor every later run starting with it.
+                    _logger.exception('Invoice %s could not be queued for HDM', move.name)
+                    move.hdm_to_fiscalize = False
+                    move.message_post(body=_('The invoice could not be sent to HDM: %(error)s', error=e))
+                    heapq.heappush(load, (count, connection_id, connection))
+                    continue
+                heapq.heappush(load, (count + 1, connection_id, connection))
+        if moves:
+            outbox._trigger_drain()
+        if not getattr(threading.current_thread(), 'testing', False):
+            self.env.cr.commit()
+        if len(moves) == batch_size:
+            self.env.ref('erp_hdm_armenia.ir_cron_hdm_fiscalize_invoices').sudo()._trigger()
+
+    def _hdm_outbox_done(self, entry, response):
+        """Called by the outbox once the queued receipt of this invoice was printed."""
+        self.ensure_one()
+        hdm_type = entry.hdm_type or self.hdm_type
+        line_ids = self.get_lines_without_downpayment().ids if int(hdm_type) == 2 else None
+        with HDM_METRICS.timed(entry.connection_id.hdm_metrics_device, entry.code, 'write'):
+            receipt = self.env['hdm.receipt']._create_from_response(response, hdm_type, record=self,
+                                                                    line_ids=line_ids)
+            self.write({
+                'hdm_success': True,
+                'rseq': response.get('rseq', ''),
+                'fiscal_uuid': response.get('fiscal', ''),
+                'fiscal_receipt_id': receipt.id,
+            })
+        return receipt
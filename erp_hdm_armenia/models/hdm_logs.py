@@ -1,19 +1,43 @@
-from odoo import models, api, fields
+from datetime import timedelta
+
+from odoo import models, api, fields, SUPERUSER_ID
+from odoo.modules.registry import Registry
+
+from odoo.addons.erp_hdm_armenia.utils.hdm_log_buffer import LogBuffer
+
+# Identical errors seen again within this window increase the count of the existing entry.
+LOG_COLLAPSE_WINDOW = timedelta(hours=1)
+LOG_RETENTION_DAYS = 30
+LOG_KEY_FIELDS = ('terminal_id', 'code', 'name', 'model_name', 'res_id')
+
+
+def _write_log_batch(dbname, entries):
+    with Registry(dbname).cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        env['hdm.log']._store_entries(entries)
+
+
+HDM_LOG_BUFFER = LogBuffer(_write_log_batch)
 
 
 class HdmLogs(models.Model):
     _name = 'hdm.log'
     _description = 'HDM Logs'
+    _order = 'last_seen desc, id desc'
 
     name = fields.Char(string='Log Entry', required=True)
-    code = fields.Char(string='Request Code')
-    req_data = fields.Char(string='Request Data')
-    terminal_id = fields.Many2one('hdm.connection', string='HDM Device', required=True)
+    code = fields.Char(string='Request Code', index=True)
+    req_data = fields.Json(string='Request Data')
+    terminal_id = fields.Many2one('hdm.connection', string='HDM Device', required=True, index=True)
     company_id = fields.Many2one('res.company', string='Company')
     model_name = fields.Char(string='Model Name')
     res_id = fields.Integer(string='Record ID')
+    count = fields.Integer(string='Occurrences', default=1)
+    last_seen = fields.Datetime(string='Last Seen', default=fields.Datetime.now, index=True)
     ref = fields.Reference([('pos.order', 'POS Order'), ('pos.payment.method', 'Pos Payment Method')], 'Document ID',
-                           compute='_compute_ref_id', store=True)
+                           compute='_compute_ref_id')
+
+    _terminal_create_date_idx = models.Index('(terminal_id, create_date)')
 
     @api.depends('model_name', 'res_id')
     def _compute_ref_id(self):
@@ -22,3 +46,50 @@ class HdmLogs(models.Model):
                 record.ref = f"{record.model_name},{int(record.res_id)}"
             else:
                 record.ref = False
+
+    @api.model
+    def _store_entries(self, entries):
+        """Write buffered entries, folding repeated errors into one row.
+
+        Entries with the same device, code, message and document are merged,
+        and merged again into a row of the same key seen within
+        ``LOG_COLLAPSE_WINDOW`` instead of inserting a new one.
+        """
+        merged = dict()
+        for entry in entries:
+            key = tuple(entry.get(name) or False for name in LOG_KEY_FIELDS)
+            if key in merged:
+                previous = merged[key]
+                previous['count'] += entry.get('count', 1)
+                previous['last_seen'] = max(previous['last_seen'], entry['last_seen'])
+                previous['req_data'] = entry.get('req_data')
+            else:
+                merged[key] = dict(entry, count=entry.get('count', 1))
+
+        recent = self.search([
+            ('terminal_id', 'in', list({key[0] for key in merged})),
+            ('last_seen', '>=', fields.Datetime.now() - LOG_COLLAPSE_WINDOW),
+        ])
+        existing = {tuple(log[name].id if name == 'terminal_id' else log[name] for name in LOG_KEY_FIELDS): log
+                    for log in recent}
+        vals_list = []
+        for key, vals in merged.items():
+            log = existing.get(key)
+            if log:
+                log.write({
+                    'count': log.count + vals['count'],
+                    'last_seen': max(log.last_seen, vals['last_seen']),
+                    'req_data': vals.get('req_data'),
+                })
+            else:
+                vals_list.append(vals)
+        if vals_list:
+            self.create(vals_list)
+
+    @api.autovacuum
+    def _gc_hdm_logs(self):
+        days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'erp_hdm_armenia.log_retention_days', LOG_RETENTION_DAYS))
+        if days <= 0:
+            return
+        self.search([('last_seen', '<', fields.Datetime.now() - timedelta(days=days))]).unlink()
@@ -0,0 +1,269 @@
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from odoo import api, fields, models, _
+from odoo.exceptions import ValidationError, UserError
+
+from odoo.addons.erp_hdm_armenia.utils.hdm_codec import is_unanswered
+from odoo.addons.erp_hdm_armenia.utils.hdm_metrics import HDM_METRICS
+
+from .hdm import FLEET_WORKERS, HdmUnreachableError
+
+_logger = logging.getLogger(__name__)
+
+OUTBOX_MAX_BACKOFF = 3600
+# A customer waiting at a kiosk is gone after this many seconds; their entry is not sent any more.
+OUTBOX_INTERACTIVE_TIMEOUT = 120
+
+
+class HdmOutbox(models.Model):
+    _name = 'hdm.outbox'
+    _description = 'HDM Fiscal Outbox'
+    _order = 'id'
+
+    connection_id = fields.Many2one('hdm.connection', string='HDM Device', required=True, index=True,
+                                    ondelete='restrict')
+    code = fields.Integer(string='Operation Code', required=True)
+    payload = fields.Json(string='Request Data', required=True)
+    hdm_type = fields.Char(string='Mode')
+    res_model = fields.Char(string='Model Name')
+    res_id = fields.Integer(string='Record ID')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('check', 'To Verify'),
+        ('sent', 'Sent'),
+        ('sent_error', 'Sent, Not Recorded'),
+        ('failed', 'Failed'),
+        ('cancel', 'Cancelled'),
+    ], string='Status', default='pending', required=True, index=True)
+    attempts = fields.Integer(string='Attempts', default=0)
+    next_attempt = fields.Datetime(string='Next Attempt', default=fields.Datetime.now, index=True)
+    last_error = fields.Char(string='Last Error')
+    receipt_id = fields.Many2one('hdm.receipt', string='Fiscal Receipt')
+    response = fields.Json(string='Device Answer', readonly=True, copy=False,
+                           help='Answer of the device, kept to record the receipt again if that failed.')
+    interactive = fields.Boolean(string='Customer Waiting', readonly=True,
+                                 help='Sent once, ahead of the other entries. A failure is reported to the waiting '
+                                      'customer instead of being retried.')
+    company_id = fields.Many2one(related='connection_id.company_id', store=True)
+
+    @api.depends('code', 'res_model', 'res_id')
+    def _compute_display_name(self):
+        for entry in self:
+            entry.display_name = f'HDM {entry.code} - {entry.res_model or ""},{entry.res_id or ""}'
+
+    @api.model
+    def enqueue(self, connection, code, data, record=None, hdm_type=False, state='pending', error=False,
+                interactive=False):
+        """Queue a request; ``interactive`` entries are sent as soon as this transaction is committed."""
+        entry = self.sudo().create({
+            'connection_id': connection.id,
+            'code': code,
+            'payload': data,
+            'hdm_type': str(hdm_type) if hdm_type else False,
+            'res_model': record._name if record else False,
+            'res_id': record.id if record else False,
+            'state': state,
+            'last_error': error,
+            'interactive': interactive,
+        })
+        if interactive:
+            self._trigger_drain(interactive=True)
+        return entry
+
+    @api.model
+    def _trigger_drain(self, interactive=False):
+        """Run the drain of the interactive entries, or of the others, as soon as the transaction is committed."""
+        cron = 'ir_cron_hdm_outbox_interactive' if interactive else 'ir_cron_hdm_outbox_drain'
+        self.env.ref(f'erp_hdm_armenia.{cron}').sudo()._trigger()
+
+    def _get_record(self):
+        self.ensure_one()
+        if self.res_model and self.res_id and self.res_model in self.env:
+            return self.env[self.res_model].browse(self.res_id).exists()
+        return None
+
+    def _claim(self) -> bool:
+        """Lock this entry for the current transaction if it is still pending and nobody else holds it."""
+        self.ensure_one()
+        self.env.cr.execute("""
+            SELECT id FROM hdm_outbox
+             WHERE id = %s AND state = 'pending'
+               FOR UPDATE SKIP LOCKED
+        """, [self.id])
+        claimed = bool(self.env.cr.fetchone())
+        self.invalidate_recordset()
+        return claimed
+
+    def _reschedule(self, error):
+        """Push back every pending entry of the devices of ``self``, keeping their order.
+
+        Entries another worker is sending are left alone.
+        """
+        for connection in self.connection_id:
+            self.env.cr.execute("""
+                SELECT id FROM hdm_outbox
+                 WHERE connection_id = %s AND state = 'pending' AND NOT interactive
+                   FOR UPDATE SKIP LOCKED
+            """, [connection.id])
+            entries = self.browse([row[0] for row in self.env.cr.fetchall()])
+            attempts = max(entries.mapped('attempts') or [0]) + 1
+            delay = min(30 * 2 ** attempts, OUTBOX_MAX_BACKOFF)
+            entries.write({
+                'attempts': attempts,
+                'next_attempt': fields.Datetime.now() + timedelta(seconds=delay),
+                'last_error': error,
+            })
+
+    def _fail(self, error, state='failed'):
+        """Record the failure of this entry and tell its document, which may have a customer waiting."""
+        self.ensure_one()
+        self.write({'state': state, 'attempts': self.attempts + 1, 'last_error': error})
+        record = self._get_record()
+        if record is not None and hasattr(record, '_hdm_outbox_failed'):
+            try:
+                with self.env.cr.savepoint():
+                    record._hdm_outbox_failed(self, error)
+            except Exception:
+                _logger.exception('Failed to report the failure of HDM outbox entry %s', self.id)
+
+    def _process(self):
+        """Record the receipt of an entry the device printed, from its stored answer.
+
+        A failure leaves the entry in ``sent_error``: the receipt exists on the
+        device, so the entry is never sent again, only processed again.
+        """
+        self.ensure_one()
+        connection = self.connection_id
+        try:
+            with self.env.cr.savepoint():
+                record = self._get_record()
+                if record is not None and hasattr(record, '_hdm_outbox_done'):
+                    receipt = record._hdm_outbox_done(self, self.response)
+                else:
+                    with HDM_METRICS.timed(connection.hdm_metrics_device, self.code, 'write'):
+                        receipt = self.env['hdm.receipt']._create_from_response(
+                            self.response, self.hdm_type or self.code, record)
+                self.write({'state': 'sent', 'last_error': False, 'receipt_id': receipt.id})
+        except Exception as e:
+            _logger.exception('HDM outbox entry %s was printed but could not be recorded', self.id)
+            self.write({'state': 'sent_error', 'last_error': str(e)})
+
+    def _send(self, commit=False) -> bool:
+        """Send one entry; returns False when its device is still unreachable.
+
+        The answer of the device is stored and the entry marked sent before the
+        receipt is recorded, committed when ``commit`` is set, so an error while
+        recording cannot roll the entry back to pending and print it twice.
+        """
+        self.ensure_one()
+        connection = self.connection_id
+        expired = fields.Datetime.now() - timedelta(seconds=OUTBOX_INTERACTIVE_TIMEOUT)
+        if self.interactive and self.create_date < expired:
+            self._fail(_('The payment was not sent to HDM in time.'))
+            return True
+        try:
+            response = connection.send_request_to_hdm(id=f'outbox_{self.id}', code=self.code, data=dict(self.payload))
+        except (HdmUnreachableError, ValidationError) as e:
+            if self.interactive:
+                self._fail(str(e))
+            else:
+                self._reschedule(str(e))
+            return False
+        if is_unanswered(response):
+            self._fail(_('No answer from HDM, check the last receipt on the device.'), state='check')
+        elif response.get('hdm_error'):
+            self._fail(response['hdm_error'])
+            connection.create_log_entry(response['hdm_error'], request_data=self.payload,
+                                        model=self.res_model, res_id=self.res_id)
+        else:
+            self.write({'state': 'sent', 'attempts': self.attempts + 1, 'last_error': False, 'response': response})
+            if commit:
+                self.env.cr.commit()
+            self._process()
+        return True
+
+    @api.model
+    def _cron_drain_outbox(self, limit=200, interactive=False):
+        """Send due entries in creation order.
+
+        Entries with a customer waiting are drained by their own cron
+        (``interactive``), triggered when they are queued, so they never wait
+        behind a batch of invoices.
+
+        Devices are drained concurrently, up to ``erp_hdm_armenia.fleet_workers``
+        at once, each from its own thread and cursor; the entries of one device
+        are sent one after the other. A full batch triggers the cron again, so a
+        long backlog goes out in consecutive runs and picks up where it stopped
+        after a restart.
+        """
+        entries = self.search([('state', '=', 'pending'), ('interactive', '=', interactive),
+                               ('next_attempt', '<=', fields.Datetime.now())], order='id', limit=limit)
+        by_connection = defaultdict(list)
+        for entry in entries:
+            by_connection[entry.connection_id.id].append(entry.id)
+        testing = getattr(threading.current_thread(), 'testing', False)
+        workers = min(len(by_connection), int(self.env['ir.config_parameter'].sudo().get_param(
+            'erp_hdm_armenia.fleet_workers', FLEET_WORKERS)))
+        if testing or workers <= 1:
+            for entry_ids in by_connection.values():
+                self.browse(entry_ids)._drain(commit=not testing)
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hdm_outbox') as pool:
+                for entry_ids in by_connection.values():
+                    pool.submit(self._drain_in_thread, entry_ids)
+        if len(entries) == limit:
+            self._trigger_drain(interactive=interactive)
+
+    def _drain_in_thread(self, entry_ids):
+        try:
+            with self.env.registry.cursor() as cr:
+                self.with_env(self.env(cr=cr)).browse(entry_ids)._drain()
+        except Exception:
+            _logger.exception('Failed to send HDM outbox entries %s', entry_ids)
+
+    def _drain(self, commit=True):
+        """Send the entries of ``self``, all of one device, in order.
+
+        Each entry is claimed with a row lock first, so two workers never send
+        the same one, and committed right after it is sent: the device has
+        printed the receipt by then, and a later failure must not roll that
+        back and send it again. The device being unreachable ends the run, once
+        the customers waiting on it were told.
+        """
+        for entry in self:
+            if not entry._claim():
+                continue
+            reachable = entry._send(commit=commit)
+            if commit:
+                self.env.cr.commit()
+            if not reachable and not entry.interactive:
+                break
+
+    def action_retry(self):
+        if self.filtered(lambda e: e.state in ('sent', 'sent_error')):
+            raise UserError(_("Sent entries cannot be sent again."))
+        if self.filtered(lambda e: e.state == 'check'):
+            raise UserError(_("The device may have printed these entries. Check its last receipt, then confirm "
+                              "they were not printed to send them again."))
+        self._resend()
+
+    def action_confirm_not_printed(self):
+        """Send again entries to verify, once the device was checked and did not print them."""
+        self.filtered(lambda e: e.state == 'check')._resend()
+
+    def _resend(self):
+        # Nobody is waiting for an entry sent again by hand.
+        self.write({'state': 'pending', 'next_attempt': fields.Datetime.now(), 'interactive': False})
+        self._trigger_drain()
+
+    def action_process(self):
+        """Record again the receipts of printed entries whose recording failed."""
+        for entry in self.filtered(lambda e: e.state == 'sent_error'):
+            entry._process()
+
+    def action_cancel(self):
+        self.filtered(lambda e: e.state not in ('sent', 'sent_error')).write({'state': 'cancel'})
@@ -12,4 +12,25 @@ class ProductTemplate(models.Model):
 class ProductProduct(models.Model):
     _inherit = 'product.product'
 
-    hdm_dep = fields.Integer(string='HDM Department', related='product_tmpl_id.hdm_dep')
\ No newline at end of file
+    hdm_dep = fields.Integer(string='HDM Department', related='product_tmpl_id.hdm_dep')
+
+    def _get_hdm_fiscal_data(self) -> dict:
+        """Fiscal item fields of the products in ``self``, keyed by product id.
+
+        Templates and units are read for the whole recordset at once, so
+        building the items of a basket costs the same few queries whatever
+        its number of lines.
+        """
+        self.fetch(['product_tmpl_id'])
+        templates = self.product_tmpl_id
+        templates.fetch(['hdm_product_name', 'hdm_dep', 'hs_code', 'uom_id'])
+        templates.uom_id.fetch(['name'])
+        return {
+            product.id: {
+                'dep': product.product_tmpl_id.hdm_dep,
+                'adgCode': product.product_tmpl_id.hs_code,
+                'productName': product.product_tmpl_id.hdm_product_name,
+                'unit': product.product_tmpl_id.uom_id.name,
+            }
+            for product in self
+        }
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+from . import test_hdm_protocol
+from . import test_hdm_outbox
+from . import test_hdm_turn
+from . import test_hdm_timeouts
+from . import test_hdm_invoice
+from . import test_hdm_fiscal_report
@@ -0,0 +1,25 @@
+from datetime import date
+
+from odoo.tests.common import TransactionCase, tagged
+
+
+@tagged('post_install', '-at_install')
+class TestHdmFiscalReport(TransactionCase):
+
+    def test_windows_follow_the_calendar(self):
+        windows = self.env['hdm.fiscal.report']._split_windows(date(2025, 2, 10), date(2025, 7, 20))
+        self.assertEqual(windows, [
+            (date(2025, 2, 10), date(2025, 2, 28)),
+            (date(2025, 3, 1), date(2025, 4, 30)),
+            (date(2025, 5, 1), date(2025, 6, 30)),
+            (date(2025, 7, 1), date(2025, 7, 20)),
+        ])
+
+    def test_overlapping_ranges_share_windows(self):
+        split = self.env['hdm.fiscal.report']._split_windows
+        first = set(split(date(2025, 1, 15), date(2025, 6, 30)))
+        second = set(split(date(2025, 3, 1), date(2025, 9, 5)))
+        self.assertEqual(first & second, {
+            (date(2025, 3, 1), date(2025, 4, 30)),
+            (date(2025, 5, 1), date(2025, 6, 30)),
+        })
@@ -0,0 +1,69 @@
+from unittest.mock import patch
+
+from odoo import Command
+from odoo.tests.common import tagged
+
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+
+
+@tagged('post_install', '-at_install')
+class TestHdmInvoice(AccountTestInvoicingCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.connection = cls.env['hdm.connection'].create({
+            'name': 'Invoices',
+            'host': '127.0.0.1',
+            'port': 8888,
+            'cashier': '1',
+            'hdm_invoices': True,
+            'company_id': cls.env.company.id,
+        })
+
+    def invoice(self, **line):
+        invoice = self.env['account.move'].create({
+            'move_type': 'out_invoice',
+            'partner_id': self.partner_a.id,
+            'invoice_date': '2026-01-01',
+            'invoice_line_ids': [Command.create({
+                'product_id': self.product_a.id,
+                'quantity': 2,
+                'price_unit': 100.0,
+                'tax_ids': [Command.clear()],
+                **line,
+            })],
+        })
+        invoice.action_post()
+        return invoice
+
+    def pay(self, invoice):
+        self.env['account.payment.register'].with_context(
+            active_model='account.move', active_ids=invoice.ids).create({})._create_payments()
+
+    def test_discount_applied_once(self):
+        line = self.invoice(discount=10.0).invoice_line_ids
+        item = line._prepare_hdm_item_data()
+        self.assertEqual((item['price'], item['discount'], item['discountType']), (100.0, 10.0, 1),
+                         "The device applies the discount to the price before it")
+        self.assertAlmostEqual(item['qty'] * item['price'] * (1 - item['discount'] / 100), line.price_total)
+
+    def test_failing_invoice_does_not_block_the_batch(self):
+        broken, invoice = self.invoice(), self.invoice()
+        for move in broken | invoice:
+            self.pay(move)
+        (broken | invoice).action_hdm_fiscalize()
+        self.assertTrue(all((broken | invoice).mapped('hdm_to_fiscalize')))
+
+        def prepare(move, *args):
+            if move == broken:
+                raise ValueError('No fiscal data')
+            return {'mode': 1, 'dep': 1, 'paidAmount': move.amount_total}
+
+        with patch.object(type(self.env['account.move']), '_prepare_invoice_hdm_data', prepare):
+            self.env['account.move']._cron_hdm_fiscalize_invoices()
+        self.assertFalse(broken.hdm_to_fiscalize)
+        self.assertFalse(broken.hdm_outbox_id)
+        self.assertIn('No fiscal data', broken.message_ids[:1].body)
+        self.assertFalse(invoice.hdm_to_fiscalize)
+        self.assertEqual(invoice.hdm_outbox_id.state, 'pending')
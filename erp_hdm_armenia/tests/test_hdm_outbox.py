@@ -0,0 +1,119 @@
+import socket
+from unittest.mock import patch
+
+from odoo.exceptions import UserError
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.erp_hdm_armenia.utils.hdm_health import HDM_BREAKERS
+from odoo.addons.erp_hdm_armenia.utils.hdm_simulator import HdmSimulator
+from odoo.addons.erp_hdm_armenia.utils.hdm_socket import HDM
+
+SALE = {'mode': 1, 'paidAmount': 100, 'paidAmountCard': 0, 'prePaymentAmount': 0, 'partialAmount': 0, 'dep': 1}
+
+
+@tagged('post_install', '-at_install')
+class TestHdmOutbox(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The device turn and the sequence numbers use cursors of their own; they must see this transaction.
+        cls.registry.enter_test_mode(cls.cr)
+        cls.addClassCleanup(cls.registry.leave_test_mode)
+        cls.simulator = HdmSimulator(password='password', cashier=1, pin='1234')
+        host, port = cls.simulator.start_in_thread()
+        cls.addClassCleanup(cls.simulator.stop)
+        cls.connection = cls.env['hdm.connection'].create({
+            'name': 'Simulator',
+            'host': host,
+            'port': port,
+            'cashier': '1',
+            'hdm_password': 'password',
+            'hdm_pin': '1234',
+        })
+        # A port nothing listens on.
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            closed_port = sock.getsockname()[1]
+        cls.offline = cls.connection.copy({'name': 'Offline', 'port': closed_port})
+        cls.outbox = cls.env['hdm.outbox']
+
+    def setUp(self):
+        super().setUp()
+        # The sequence of the connection is rolled back after every test, the one of the device is not.
+        self.simulator.last_seq = 0
+        self.simulator.drop_rate = 0.0
+        for connection in self.connection | self.offline:
+            self.addCleanup(HDM.drop, connection.hdm_session_id)
+            self.addCleanup(HDM_BREAKERS.breakers.pop, connection.hdm_session_id, None)
+
+    def sales(self):
+        return self.simulator.stats['by_code'].get(4, 0)
+
+    def test_sent_entry_keeps_answer(self):
+        entry = self.outbox.enqueue(self.connection, 4, dict(SALE), hdm_type=1)
+        sales = self.sales()
+        self.outbox._cron_drain_outbox()
+        self.assertEqual(entry.state, 'sent')
+        self.assertEqual(self.sales() - sales, 1)
+        self.assertTrue(entry.response.get('fiscal'))
+        self.assertEqual(entry.receipt_id.name, entry.response['fiscal'])
+
+    def test_recording_error_is_not_sent_again(self):
+        entry = self.outbox.enqueue(self.connection, 4, dict(SALE), hdm_type=1)
+        sales = self.sales()
+        with patch.object(type(self.env['hdm.receipt']), '_create_from_response', side_effect=ValueError('boom')):
+            self.outbox._cron_drain_outbox()
+        self.assertEqual(entry.state, 'sent_error')
+        self.assertFalse(entry.receipt_id)
+        self.assertTrue(entry.response.get('fiscal'), "The answer of the device is kept")
+
+        self.outbox._cron_drain_outbox()
+        with self.assertRaises(UserError):
+            entry.action_retry()
+        self.assertEqual(self.sales() - sales, 1, "A printed receipt must not be sent again")
+
+        entry.action_process()
+        self.assertEqual(entry.state, 'sent')
+        self.assertEqual(entry.receipt_id.name, entry.response['fiscal'])
+
+    def drop_answers(self):
+        """Let the device read the next requests without answering them, once it has a session."""
+        self.assertTrue(self.connection.send_request_to_hdm(id='test', code=4, data=dict(SALE)).get('fiscal'))
+        self.simulator.drop_rate = 1.0
+
+    def test_unanswered_entry_is_verified(self):
+        entry = self.outbox.enqueue(self.connection, 4, dict(SALE), hdm_type=1)
+        self.drop_answers()
+        self.outbox._cron_drain_outbox()
+        self.assertEqual(entry.state, 'check', "A request without answer may have been printed")
+        requests = self.simulator.stats['requests']
+        self.outbox._cron_drain_outbox()
+        with self.assertRaises(UserError):
+            entry.action_retry()
+        self.assertEqual(self.simulator.stats['requests'], requests, "An entry to verify is not sent again")
+
+        self.simulator.drop_rate = 0.0
+        entry.action_confirm_not_printed()
+        self.outbox._cron_drain_outbox()
+        self.assertEqual(entry.state, 'sent')
+
+    def test_unanswered_sale_is_parked(self):
+        self.drop_answers()
+        response = self.connection.send_or_enqueue(id='test', code=4, data=dict(SALE))
+        self.assertTrue(response.get('queued'))
+        self.assertEqual(self.outbox.browse(response['hdm_outbox_id']).state, 'check')
+
+    def test_unreachable_device_is_retried_later(self):
+        entry = self.outbox.enqueue(self.offline, 4, dict(SALE), hdm_type=1)
+        self.outbox._cron_drain_outbox()
+        self.assertEqual(entry.state, 'pending')
+        self.assertEqual(entry.attempts, 1)
+        self.assertGreater(entry.next_attempt, entry.create_date)
+
+    def test_interactive_entries_have_their_own_drain(self):
+        entry = self.outbox.enqueue(self.connection, 4, dict(SALE), hdm_type=1, interactive=True)
+        self.outbox._cron_drain_outbox()
+        self.assertEqual(entry.state, 'pending', "Kiosk entries are not drained with the batches")
+        self.outbox._cron_drain_outbox(interactive=True)
+        self.assertEqual(entry.state, 'sent')
@@ -0,0 +1,116 @@
+import itertools
+
+from odoo.tests.common import BaseCase, tagged
+
+from odoo.addons.erp_hdm_armenia.utils.hdm_async import HDM_LOOP, HdmClient
+from odoo.addons.erp_hdm_armenia.utils.hdm_codec import HdmFrameTooLarge, HdmResponse, decode_result, \
+    encode_session_request, is_unanswered
+from odoo.addons.erp_hdm_armenia.utils.hdm_simulator import HdmSimulator
+from odoo.addons.erp_hdm_armenia.utils.hdm_socket import HDM, response_status
+
+PASSWORD = 'password'
+LOGIN_DATA = {'password': PASSWORD, 'cashier': 1, 'pin': '1234'}
+
+
+class SimulatedDevice:
+    """The settings ``SocketConnection`` reads from an ``hdm.connection``."""
+    hdm_password = PASSWORD
+    hdm_login_data = LOGIN_DATA
+    hdm_key = ''
+
+
+@tagged('post_install', '-at_install')
+class TestHdmProtocol(BaseCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.simulator = HdmSimulator(password=PASSWORD, cashier=1, pin='1234')
+        cls.host = cls.simulator.start_in_thread()
+        cls.addClassCleanup(cls.simulator.stop)
+
+    def setUp(self):
+        super().setUp()
+        self.simulator.error_rate = 0.0
+        self.simulator.error_codes = (143,)
+        self.simulator.drop_rate = 0.0
+        self.session_id = f'test_{self._testMethodName}'
+        self.addCleanup(HDM.drop, self.session_id)
+        self.seq = itertools.count(self.simulator.last_seq + 1)
+        self.allocated = []
+        self.device = SimulatedDevice()
+
+    def next_seq(self):
+        self.allocated.append(next(self.seq))
+        return self.allocated[-1]
+
+    def sale(self, **data):
+        return HDM.request(id=self.session_id, host=self.host, data={'mode': 1, 'paidAmount': 100, 'dep': 1, **data},
+                           code=4, connection=self.device, next_seq=None if 'seq' in data else self.next_seq)
+
+    def logins(self):
+        return self.simulator.stats['by_code'].get(2, 0)
+
+    def test_session_reused(self):
+        logins, connections = self.logins(), self.simulator.stats['connections']
+        for _i in range(5):
+            self.assertEqual(response_status(self.sale()), 200)
+        self.assertEqual(self.logins() - logins, 1, "The device should be logged in once for all requests")
+        self.assertEqual(self.simulator.stats['connections'] - connections, 1)
+
+    def test_relogin_on_rejected_key(self):
+        self.assertEqual(response_status(self.sale()), 200)
+        logins = self.logins()
+        self.simulator.session_key = None
+        self.assertEqual(response_status(self.sale()), 200, "A 102 answer should be retried after a new login")
+        self.assertEqual(self.logins() - logins, 1)
+
+    def test_relogin_once(self):
+        self.assertEqual(response_status(self.sale()), 200)
+        logins = self.logins()
+        self.simulator.error_codes = (101,)
+        self.simulator.error_rate = 1.0
+        self.assertEqual(response_status(self.sale()), 101, "A request is only retried once")
+        self.assertEqual(self.logins() - logins, 1)
+
+    def test_seq_monotonic(self):
+        for _i in range(3):
+            self.assertEqual(response_status(self.sale()), 200)
+            self.assertEqual(self.simulator.last_seq, self.allocated[-1])
+        self.assertEqual(self.allocated, sorted(set(self.allocated)))
+        self.assertEqual(response_status(self.sale(seq=self.simulator.last_seq)), 104,
+                         "The device refuses a sequence number it already saw")
+
+    def test_sent_without_answer(self):
+        self.assertEqual(response_status(self.sale()), 200)
+        self.simulator.drop_rate = 1.0
+        response = self.sale()
+        self.assertIsNone(response, "The request was sent, only its answer is missing")
+        self.assertTrue(is_unanswered(decode_result(response, '', 4)))
+
+    def test_login_without_answer(self):
+        self.simulator.drop_rate = 1.0
+        with self.assertRaises(ConnectionError, msg="Nothing was sent when the login got no answer"):
+            self.sale()
+
+    def test_async_client_shares_session(self):
+        self.assertEqual(response_status(self.sale()), 200)
+        logins = self.logins()
+        client = HdmClient(self.session_id, self.host, PASSWORD, LOGIN_DATA, timeout=10)
+        self.addCleanup(lambda: HDM_LOOP.loop.call_soon_threadsafe(HDM_LOOP.clients.pop(self.session_id)._close))
+        self.assertTrue(client.request(4, {'mode': 1, 'paidAmount': 100, 'dep': 1}, next_seq=self.next_seq).get('rseq'))
+        self.assertEqual(self.logins(), logins, "The asyncio client should use the session of HDM")
+        self.assertEqual(client.key, HDM.sessions[self.session_id])
+        HDM_LOOP.run(client.client.check_login(), timeout=10)
+        self.assertEqual(response_status(self.sale()), 200, "A login of the asyncio client is the session of HDM")
+        self.assertEqual(self.logins() - logins, 1)
+
+    def test_frame_too_large(self):
+        items = [{'productName': 'Product', 'qty': 1, 'price': 100, 'unit': 'pc'}] * 2000
+        with self.assertRaises(HdmFrameTooLarge):
+            encode_session_request('0' * 32, 4, {'mode': 2, 'items': items})
+
+    def test_error_status_for_every_code(self):
+        response = HdmResponse(145, memoryview(b''))
+        for code in (3, 4, 10):
+            self.assertEqual(decode_result(response, '', code), {'hdm_error': response.error})
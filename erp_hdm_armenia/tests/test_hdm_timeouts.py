@@ -0,0 +1,27 @@
+from odoo.tests.common import BaseCase, tagged
+
+from odoo.addons.erp_hdm_armenia.utils.hdm_timeouts import MIN_SAMPLES, DeviceTimeouts
+
+
+@tagged('post_install', '-at_install')
+class TestHdmTimeouts(BaseCase):
+
+    def setUp(self):
+        super().setUp()
+        self.timeouts = DeviceTimeouts(read_floor=5.0, read_ceiling=60.0)
+
+    def test_ceiling_until_enough_samples(self):
+        for _i in range(MIN_SAMPLES - 1):
+            self.timeouts.record_read(4, 0.5, 1)
+        self.assertEqual(self.timeouts.read_timeout(4, 1), 60.0)
+        self.timeouts.record_read(4, 0.5, 1)
+        self.assertEqual(self.timeouts.read_timeout(4, 1), 5.0)
+
+    def test_ceiling_for_larger_receipts_than_timed(self):
+        for _i in range(MIN_SAMPLES):
+            self.timeouts.record_read(4, 2.0, 60)
+        self.assertEqual(self.timeouts.read_timeout(4, 60), 7.0)
+        self.assertEqual(self.timeouts.read_timeout(4, 300), 60.0,
+                         "60 line receipts do not tell how long a 300 line one takes")
+        self.timeouts.record_read(4, 10.0, 300)
+        self.assertLess(self.timeouts.read_timeout(4, 300), 60.0)
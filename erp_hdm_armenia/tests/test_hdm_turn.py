@@ -0,0 +1,85 @@
+import socket
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.erp_hdm_armenia.utils.hdm_codec import encode_login
+from odoo.addons.erp_hdm_armenia.utils.hdm_health import HDM_BREAKERS
+from odoo.addons.erp_hdm_armenia.utils.hdm_simulator import HdmSimulator
+from odoo.addons.erp_hdm_armenia.utils.hdm_socket import HDM, recv_frame
+
+SALE = {'mode': 1, 'paidAmount': 100, 'paidAmountCard': 0, 'prePaymentAmount': 0, 'partialAmount': 0, 'dep': 1}
+
+
+@tagged('post_install', '-at_install')
+class TestHdmTurn(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The device turn uses a cursor of its own; it must see this transaction.
+        cls.registry.enter_test_mode(cls.cr)
+        cls.addClassCleanup(cls.registry.leave_test_mode)
+        cls.simulator = HdmSimulator(password='password', cashier=1, pin='1234')
+        host, port = cls.simulator.start_in_thread()
+        cls.addClassCleanup(cls.simulator.stop)
+        cls.connection = cls.env['hdm.connection'].create({
+            'name': 'Simulator',
+            'host': host,
+            'port': port,
+            'cashier': '1',
+            'hdm_password': 'password',
+            'hdm_pin': '1234',
+        })
+        cls.session_id = cls.connection.hdm_session_id
+
+    def setUp(self):
+        super().setUp()
+        # The sequence of the connection is rolled back after every test, the one of the device is not.
+        self.simulator.last_seq = 0
+        self.addCleanup(HDM.drop, self.session_id)
+        self.addCleanup(HDM_BREAKERS.breakers.pop, self.session_id, None)
+
+    def sale(self):
+        return self.connection.send_request_to_hdm(id='test', code=4, data=dict(SALE))
+
+    def logins(self):
+        return self.simulator.stats['by_code'].get(2, 0)
+
+    def stored(self):
+        self.connection.invalidate_recordset(['hdm_key', 'hdm_seq'])
+        return self.connection.hdm_key, self.connection.hdm_seq
+
+    def test_turn_allocates_seq(self):
+        with self.connection._hdm_turn(4) as turn:
+            self.assertEqual([turn.next_seq(), turn.next_seq()], [1, 2])
+        self.assertEqual(self.stored()[1], 3)
+
+    def test_key_stored_after_request(self):
+        self.assertTrue(self.sale().get('fiscal'))
+        key, seq = self.stored()
+        self.assertEqual(key, HDM.sessions[self.session_id])
+        self.assertEqual(self.simulator.last_seq, seq - 1)
+
+    def test_key_of_other_worker_adopted(self):
+        self.assertTrue(self.sale().get('fiscal'))
+        # Another worker logs in on its own socket, which replaces the session on the device, and its turn
+        # stores the new key.
+        with socket.create_connection(self.connection.hdm_host, timeout=5) as sock:
+            sock.sendall(encode_login('other_worker', 'password', self.connection.hdm_login_data))
+            key = recv_frame(sock).decode_login('password')['key']
+        self.env.cr.execute("UPDATE hdm_connection SET hdm_key = %s WHERE id = %s", [key, self.connection.id])
+        logins = self.logins()
+        self.assertTrue(self.sale().get('fiscal'), "The key stored by the other worker is used")
+        self.assertEqual(self.logins(), logins)
+        self.assertEqual(HDM.sessions[self.session_id], key)
+
+    def test_key_of_new_login_stored(self):
+        self.assertTrue(self.sale().get('fiscal'))
+        old_key, seq = self.stored()
+        self.simulator.session_key = None
+        self.assertTrue(self.sale().get('fiscal'))
+        key, next_seq = self.stored()
+        self.assertNotEqual(key, old_key, "The key of the login made during the turn is stored")
+        self.assertEqual(key, HDM.sessions[self.session_id])
+        self.assertEqual(next_seq, seq + 2, "The rejected request and its retry each took a number")
+        self.assertEqual(self.simulator.last_seq, next_seq - 1)
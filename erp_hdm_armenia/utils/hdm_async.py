@@ -0,0 +1,308 @@
+import asyncio
+import logging
+import threading
+
+from .hdm_codec import (
+    HdmResponse, RESPONSE_HEADER, decode_response_header, decode_result, encode_login, encode_session_request,
+)
+from .hdm_socket import HDM, SESSION_ERROR_CODES
+from .utils import forget_session_key
+
+_logger = logging.getLogger(__name__)
+
+# Seconds between two attempts to take the lock of a device held by a blocking request.
+LOCK_POLL_INTERVAL = 0.005
+
+
+class AsyncHdmClient:
+    """asyncio implementation of the HDM protocol for a single device.
+
+    The client shares the session of the device with ``HDM``: the key lives
+    in ``HDM.sessions`` and a request holds ``HDM.locks``, so a login made
+    here is the one the next blocking request uses and the two never talk
+    to the device at the same time. Sequence numbers come from the caller's
+    ``next_seq``, the same source ``SocketConnection.request`` uses. The
+    socket is kept between calls; a new login is made only when there is no
+    key yet or the device answers 101/102.
+    """
+
+    def __init__(self, id, host, password, login_data, connect_timeout=10, read_timeout=60):
+        self.id = id
+        self.host = host
+        self.password = password
+        self.login_data = login_data
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._settings = (host, password, login_data)
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    def configure(self, host, password, login_data):
+        """Refresh settings from the ORM; may be called from any thread.
+
+        The new settings are only taken by the next request, on the loop, so
+        a request in flight keeps the socket and key it started with.
+        """
+        self._settings = (host, password, login_data)
+
+    def _apply_settings(self):
+        if self._settings != (self.host, self.password, self.login_data):
+            if self._settings[0] != self.host:
+                self._close()
+            self.host, self.password, self.login_data = self._settings
+
+    @property
+    def key(self) -> str:
+        return HDM.sessions.get(self.id, '')
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing() and not self._reader.at_eof()
+
+    async def connect(self):
+        if self.connected:
+            return
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(*self.host), timeout=self.connect_timeout)
+        _logger.info(f"Connected to {self.host}")
+
+    async def _write(self, frame):
+        self._writer.write(frame)
+        await self._writer.drain()
+
+    async def _read_frame(self) -> HdmResponse:
+        header = await asyncio.wait_for(self._reader.readexactly(RESPONSE_HEADER.size), timeout=self.read_timeout)
+        status, length = decode_response_header(header)
+        body = await asyncio.wait_for(self._reader.readexactly(length), timeout=self.read_timeout)
+        return HdmResponse(status, memoryview(body))
+
+    async def _device_lock(self):
+        """Wait for ``HDM.locks`` of the device without blocking the loop.
+
+        Polled rather than acquired from a worker thread, so a cancelled
+        request cannot leave the lock taken behind it.
+        """
+        lock = HDM.locks.setdefault(self.id, threading.Lock())
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        return lock
+
+    async def login(self) -> HdmResponse:
+        """Connect and log in; raises ``ConnectionError`` when the device cannot be reached."""
+        try:
+            await self.connect()
+            await self._write(encode_login(self.id, self.password, self.login_data))
+            response = await self._read_frame()
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            self._close()
+            raise ConnectionError(f"Unable to log in to HDM at {self.host}: {e}") from e
+        if response.ok and (key := response.decode_login(self.password).get('key')):
+            forget_session_key(HDM.sessions.get(self.id))
+            HDM.sessions[self.id] = key
+        return response
+
+    async def request(self, code: int, data: dict, next_seq=None) -> dict | bool:
+        """Send ``data`` with operation ``code`` and return the decoded result.
+
+        Like ``SocketConnection.request``, a request that may have reached the
+        device is never sent twice, and ``next_seq`` is called right before
+        each send; without it ``data['seq']`` is sent as given.
+        """
+        async with self._lock:
+            lock = await self._device_lock()
+            try:
+                self._apply_settings()
+                return await self._request(code, data, next_seq)
+            except asyncio.CancelledError:
+                # An answer may still arrive on this socket; it must not be read as the next one.
+                self._close()
+                raise
+            finally:
+                lock.release()
+
+    async def _request(self, code, data, next_seq):
+        for attempt in range(2):
+            if not self.connected:
+                self._close()
+            if not self.key:
+                response = await self.login()
+                if not self.key:
+                    self._close()
+                    return decode_result(response, '', 2) if not response.ok else False
+            else:
+                try:
+                    await self.connect()
+                except (OSError, asyncio.TimeoutError) as e:
+                    raise ConnectionError(f"Unable to connect to HDM at {self.host}: {e}") from e
+            if code == 2:
+                return {'key': self.key}
+            if next_seq is not None:
+                data['seq'] = await asyncio.to_thread(next_seq)
+            key = self.key
+            try:
+                await self._write(encode_session_request(key, code, data))
+            except (ConnectionResetError, BrokenPipeError) as e:
+                _logger.info('HDM session %s was dropped by the device: %s', self.id, e)
+                self._close()
+                continue
+            try:
+                response = await self._read_frame()
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                _logger.error('Error recv data from HDM %s: %r', self.id, e)
+                self._close()
+                return decode_result(None, key, code)
+            if response.status in SESSION_ERROR_CODES and not attempt:
+                _logger.info('HDM session key of %s is no longer valid, logging in again.', self.id)
+                self._forget_key(key)
+                continue
+            if code == 3:
+                self._forget_key(key)
+                self._close()
+            return decode_result(response, key, code)
+        raise ConnectionError(f"HDM {self.id} dropped the session before the request was sent")
+
+    async def check_login(self) -> dict | bool:
+        """Log in again, e.g. to test the credentials; the new key is the device's session from then on."""
+        async with self._lock:
+            lock = await self._device_lock()
+            try:
+                self._apply_settings()
+                self._forget_key(self.key)
+                return await self._request(2, {}, None)
+            except asyncio.CancelledError:
+                self._close()
+                raise
+            finally:
+                lock.release()
+
+    async def sale(self, data: dict, next_seq=None):
+        return await self.request(4, data, next_seq)
+
+    async def return_receipt(self, data: dict, next_seq=None):
+        return await self.request(6, data, next_seq)
+
+    async def sync_time(self, next_seq=None):
+        return await self.request(10, {}, next_seq)
+
+    async def disconnect(self, next_seq=None):
+        if not self.key:
+            return {}
+        return await self.request(3, {}, next_seq)
+
+    def _forget_key(self, key):
+        """Drop ``key`` from the shared sessions, unless a newer login already replaced it."""
+        if key and HDM.sessions.get(self.id) == key:
+            HDM.sessions.pop(self.id, None)
+        forget_session_key(key)
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class HdmEventLoop:
+    """Background event loop that owns every AsyncHdmClient of the process.
+
+    Clients live on one loop thread so their sockets survive between ORM
+    requests and many devices can be driven concurrently without a thread
+    per device.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+        self._clients_lock = threading.Lock()
+        self.clients = dict()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='hdm-event-loop', daemon=True).start()
+            return self._loop
+
+    def run(self, coro, timeout=None):
+        """Run ``coro`` on the loop and wait for it; it is cancelled when ``timeout`` expires."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def client(self, id, host, password, login_data, **kwargs) -> AsyncHdmClient:
+        with self._clients_lock:
+            client = self.clients.get(id)
+            if client is None:
+                client = self.clients[id] = AsyncHdmClient(id, host, password, login_data, **kwargs)
+                return client
+        client.configure(host, password, login_data)
+        return client
+
+    def gather(self, calls, limit=8, timeout=None) -> list:
+        """Run ``calls`` (a list of ``(client, method_name, args)``) with at most ``limit`` in flight.
+
+        Returns one result per call, in order; a call that raised returns its exception.
+        """
+        async def _run_all():
+            semaphore = asyncio.Semaphore(limit)
+
+            async def _run(client, method, args):
+                async with semaphore:
+                    return await getattr(client, method)(*args)
+
+            return await asyncio.gather(*(_run(*call) for call in calls), return_exceptions=True)
+
+        return self.run(_run_all(), timeout=timeout)
+
+
+HDM_LOOP = HdmEventLoop()
+
+
+class HdmClient:
+    """Blocking facade over AsyncHdmClient for ORM callers.
+
+    Results have the same shape as ``hdm.connection.send_request_to_hdm``;
+    a device that cannot be reached raises ``ConnectionError``.
+    """
+
+    def __init__(self, id, host, password, login_data, timeout=None, **kwargs):
+        self.client = HDM_LOOP.client(id, host, password, login_data, **kwargs)
+        self.timeout = timeout
+
+    @property
+    def key(self):
+        return self.client.key
+
+    def _run(self, coro):
+        try:
+            return HDM_LOOP.run(coro, timeout=self.timeout)
+        except ConnectionError:
+            raise
+        except TimeoutError:
+            # The request may have reached the device before it was cancelled.
+            _logger.error('HDM %s did not finish within %ss', self.client.id, self.timeout)
+            return False
+        except OSError as e:
+            raise ConnectionError(f"Unable to reach HDM at {self.client.host}: {e}") from e
+
+    def login(self):
+        return self._run(self.client.request(2, {}))
+
+    def request(self, code, data, next_seq=None):
+        return self._run(self.client.request(code, data, next_seq))
+
+    def sale(self, data, next_seq=None):
+        return self._run(self.client.sale(data, next_seq))
+
+    def return_receipt(self, data, next_seq=None):
+        return self._run(self.client.return_receipt(data, next_seq))
+
+    def sync_time(self, next_seq=None):
+        return self._run(self.client.sync_time(next_seq))
+
+    def disconnect(self, next_seq=None):
+        return self._run(self.client.disconnect(next_seq))
@@ -0,0 +1,206 @@
+"""Microbenchmarks for the HDM protocol, crypto and payload hot paths.
+
+Protocol, crypto and JSON benchmarks run without Odoo::
+
+    python3 erp_hdm_armenia/utils/hdm_bench.py --output hdm_bench.json
+
+The item builders of ``pos.order.line`` and ``pos.payment.method`` need a
+database; run them from ``odoo-bin shell``::
+
+    from odoo.addons.erp_hdm_armenia.utils.hdm_bench import run
+    run(env, output='hdm_bench.json')
+
+Results are written as JSON: one entry per benchmark with ops/sec, mean time,
+peak and retained allocated bytes per operation and, for ORM benchmarks, queries per
+operation, so runs of two releases can be diffed.
+"""
+import argparse
+import base64
+import datetime
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+if __package__:
+    from .hdm_codec import HdmResponse, decode_response_header, encode_json, encode_request, encode_response
+    from .utils import generate_hdm_key, generate_second_key
+else:
+    # Run as a script from the utils directory.
+    from hdm_codec import HdmResponse, decode_response_header, encode_json, encode_request, encode_response
+    from utils import generate_hdm_key, generate_second_key
+
+# The frame length is two bytes, so a receipt body stays under 64 KiB.
+RECEIPT_SIZES = (1, 50, 300)
+SESSION_KEY = base64.b64encode(b'hdm-bench-session-key-24').decode()
+PASSWORD = 'benchmark'
+
+
+def measure(name, func, setup=None, min_time=0.5, max_ops=100000, cursor=None, **params) -> dict:
+    """Time ``func`` until ``min_time`` seconds have passed, then trace one call's memory.
+
+    ``setup`` runs before every call and is not timed. When ``cursor`` is
+    given, the SQL queries of one call are counted too.
+    """
+    setup = setup or (lambda: None)
+    setup()
+    func()
+    ops, elapsed = 0, 0.0
+    while elapsed < min_time and ops < max_ops:
+        setup()
+        start = time.perf_counter()
+        func()
+        elapsed += time.perf_counter() - start
+        ops += 1
+
+    setup()
+    queries = cursor.sql_log_count if cursor is not None else 0
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {
+        'name': name,
+        'params': params,
+        'ops': ops,
+        'ops_per_sec': round(ops / elapsed, 2) if elapsed else None,
+        'mean_us': round(elapsed / ops * 1e6, 3),
+        'alloc_peak_bytes': peak - base,
+        'alloc_retained_bytes': current - base,
+    }
+    if cursor is not None:
+        result['queries_per_op'] = cursor.sql_log_count - queries
+    return result
+
+
+def sample_items(count) -> list:
+    return [{
+        'dep': 1,
+        'adgCode': '2106',
+        'productCode': index,
+        'productName': f'Ապրանք {index}',
+        'qty': 1 + index % 3,
+        'unit': 'հատ',
+        'price': 100.0 + index,
+    } for index in range(count)]
+
+
+def sample_payload(count) -> dict:
+    return {
+        'items': sample_items(count),
+        'paidAmount': 0,
+        'paidAmountCard': 1000,
+        'partialAmount': 0,
+        'prePaymentAmount': 0,
+        'useExtPOS': True,
+        'eMarks': [],
+        'mode': 2,
+        'partnerTin': None,
+        'seq': 1,
+    }
+
+
+def protocol_benchmarks(min_time=0.5) -> list:
+    header = encode_response(200)
+    results = [
+        measure('decode_response_header', lambda: decode_response_header(header), min_time=min_time),
+    ]
+    for size in RECEIPT_SIZES:
+        payload = sample_payload(size)
+        text = encode_json(payload)
+        encrypted = generate_second_key(SESSION_KEY, text)
+        response = HdmResponse(200, memoryview(encrypted))
+        results += [
+            measure('json.dumps', lambda: json.dumps(payload), min_time=min_time, lines=size,
+                    bytes=len(json.dumps(payload).encode())),
+            measure('encode_json', lambda: encode_json(payload), min_time=min_time, lines=size,
+                    bytes=len(text.encode())),
+            measure('generate_hdm_key', lambda: generate_hdm_key(PASSWORD, text), min_time=min_time, lines=size),
+            measure('generate_second_key', lambda: generate_second_key(SESSION_KEY, text), min_time=min_time,
+                    lines=size),
+            measure('encode_request', lambda: encode_request(4, encrypted), min_time=min_time, lines=size),
+            measure('HdmResponse.decode', lambda: response.decode(SESSION_KEY), min_time=min_time, lines=size),
+        ]
+    return results
+
+
+def orm_benchmarks(env, min_time=0.5) -> list:
+    """Item builders of the POS module, on in-memory records so nothing is written."""
+    if 'pos.order.line' not in env or not hasattr(env['pos.order.line'], '_prepare_hdm_items'):
+        return []
+    products = env['product.product'].search([('sale_ok', '=', True)], limit=200)
+    if not products:
+        return []
+
+    def invalidate_products():
+        # Only the product side: the benchmarked lines live in the cache.
+        for model in ('product.product', 'product.template', 'uom.uom'):
+            env[model].invalidate_model()
+
+    results = []
+    for size in RECEIPT_SIZES:
+        chosen = [products[index % len(products)] for index in range(size)]
+        serialized = [{
+            'product_id': product.id,
+            'qty': 1 + index % 3,
+            'price_unit': 100.0 + index,
+            'discount': 10 if index % 5 == 0 else 0,
+        } for index, product in enumerate(chosen)]
+        lines = env['pos.order.line']
+        for line in serialized:
+            lines |= lines.new({
+                'product_id': line['product_id'],
+                'qty': line['qty'],
+                'price_unit': line['price_unit'],
+                'price_subtotal': line['price_unit'] * line['qty'],
+                'price_subtotal_incl': line['price_unit'] * line['qty'],
+                'discount': line['discount'],
+            })
+        method = env['pos.payment.method']
+        compact = {name: [line[key] for line in serialized]
+                   for name, key in (('product_ids', 'product_id'), ('qty', 'qty'), ('price_unit', 'price_unit'),
+                                     ('discount', 'discount'))}
+        results += [
+            measure('PosOrderLine._prepare_hdm_item_data',
+                    lambda: [line._prepare_hdm_item_data(1) for line in lines],
+                    setup=invalidate_products, min_time=min_time, max_ops=2000,
+                    cursor=env.cr, lines=size),
+            measure('PosOrderLine._prepare_hdm_items', lambda: lines._prepare_hdm_items(1),
+                    setup=invalidate_products, min_time=min_time, max_ops=2000, cursor=env.cr, lines=size),
+            measure('PosPaymentMethod._prepare_hdm_item_data',
+                    lambda: method._prepare_hdm_item_data(compact, 1),
+                    setup=invalidate_products, min_time=min_time, max_ops=2000, cursor=env.cr, lines=size),
+        ]
+    return results
+
+
+def run(env=None, output=None, min_time=0.5) -> dict:
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': protocol_benchmarks(min_time=min_time),
+    }
+    if env is not None:
+        report['results'] += orm_benchmarks(env, min_time=min_time)
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=1, ensure_ascii=False)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HDM protocol and crypto microbenchmarks')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    parser.add_argument('--min-time', type=float, default=0.5, help='Seconds spent timing each benchmark')
+    args = parser.parse_args()
+    report = run(output=args.output, min_time=args.min_time)
+    if not args.output:
+        json.dump(report, sys.stdout, indent=1, ensure_ascii=False)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Binary framing of the HDM protocol.
+
+Request frame: the 6-byte ``default_header_bytes`` magic, the protocol
+version (0, 7), the operation code, a reserved byte, the big-endian body
+length and the 3DES encrypted JSON body.
+
+Response frame: 11 header bytes carrying the big-endian status at offset
+5 and the body length at offset 7, then the encrypted body.
+"""
+import json
+import logging
+import struct
+
+if __package__:
+    from .utils import (
+        BoundedCache, generate_hdm_key, generate_second_key, hdm_error_codes, unpack_hdm_key, unpack_hdm_response,
+    )
+else:
+    # Imported by the simulator or the benchmarks run as scripts.
+    from utils import (
+        BoundedCache, generate_hdm_key, generate_second_key, hdm_error_codes, unpack_hdm_key, unpack_hdm_response,
+    )
+
+_logger = logging.getLogger(__name__)
+
+default_header_bytes = bytes([0xD5, 0x80, 0xD4, 0xB4, 0xD5, 0x84])
+PROTOCOL_VERSION = (0, 7)
+
+# magic, arc, arc_hamar, operation code, reserve, body length
+REQUEST_HEADER = struct.Struct('>6sBBBBH')
+# reserved, status, body length, reserved
+RESPONSE_HEADER = struct.Struct('>5sHH2s')
+
+MAX_BODY_SIZE = 0xFFFF
+CODES_WITH_RESPONSES = (2, 4, 6, 9)
+
+login_frames = BoundedCache(maxsize=128)
+
+
+NO_ANSWER = {'hdm_error': 'No answer from HDM after the request was sent, check the last receipt on the device.',
+             'hdm_no_answer': True}
+
+
+def is_unanswered(result) -> bool:
+    """Whether the device may have processed a request without its answer being read."""
+    return result is False or bool(result and result.get('hdm_no_answer'))
+
+
+class HdmFrameTooLarge(ValueError):
+    """The encrypted body does not fit in the 16-bit length of a request frame."""
+
+
+def encode_json(data) -> str:
+    """Compact JSON body without padding spaces; non-ASCII text stays \\u escaped as the devices expect."""
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=True)
+
+
+def encode_request(code: int, payload: bytes) -> bytes:
+    if len(payload) > MAX_BODY_SIZE:
+        raise HdmFrameTooLarge(f"HDM request body of {len(payload)} bytes exceeds the {MAX_BODY_SIZE} byte frame limit")
+    return REQUEST_HEADER.pack(default_header_bytes, *PROTOCOL_VERSION, code, 0, len(payload)) + payload
+
+
+def encode_session_request(key: str, code: int, data: dict) -> bytes:
+    """Frame ``data`` encrypted with the session ``key``."""
+    return encode_request(code, generate_second_key(key, encode_json(data)))
+
+
+def encode_password_request(password: str, code: int, data: dict) -> bytes:
+    """Frame ``data`` encrypted with the device password."""
+    return encode_request(code, generate_hdm_key(password, encode_json(data)))
+
+
+def encode_login(id, password: str, login_data: dict) -> bytes:
+    """Return the encrypted code-2 frame of a connection, built once per set of credentials.
+
+    The login payload carries no sequence number, so the same frame can be sent
+    for every login until the password, cashier or pin change.
+    """
+    payload = encode_json(login_data)
+    return login_frames.get_or_create(
+        (id, password, payload), lambda: encode_request(2, generate_hdm_key(password, payload)))
+
+
+def decode_request_header(header: bytes) -> tuple:
+    """Return ``(magic, version, code, length)`` of a request header."""
+    magic, arc, arc_hamar, code, _reserve, length = REQUEST_HEADER.unpack(header)
+    return magic, (arc, arc_hamar), code, length
+
+
+def encode_response(status: int, body: bytes = b'') -> bytes:
+    return RESPONSE_HEADER.pack(b'\x00' * 5, status, len(body), b'\x00\x00') + body
+
+
+def decode_response_header(header) -> tuple:
+    """Return ``(status, length)`` of a response header."""
+    _reserved, status, length, _reserved2 = RESPONSE_HEADER.unpack(header)
+    return status, length
+
+
+class HdmResponse:
+    """A response frame read from the device.
+
+    ``body`` may be a memoryview over the buffer the frame was received into,
+    so it can be handed to the cipher without copying.
+    """
+    __slots__ = ('status', 'length', 'body')
+
+    def __init__(self, status: int, body):
+        self.status = status
+        self.length = len(body)
+        self.body = body
+
+    def __repr__(self):
+        return f'<HdmResponse status={self.status} length={self.length}>'
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200
+
+    @property
+    def error(self) -> str | None:
+        """``'<status>: <message>'`` when the device refused the request."""
+        if self.ok:
+            return None
+        return f'{self.status}: {hdm_error_codes.get(self.status, "Unknown Error")}'
+
+    def decode(self, key: str) -> dict:
+        """JSON body encrypted with the session ``key``."""
+        return json.loads(unpack_hdm_response(key, self.body))
+
+    def decode_login(self, password: str) -> dict:
+        """JSON body of a login answer, encrypted with the device password."""
+        return json.loads(unpack_hdm_key(password, self.body))
+
+
+def decode_result(response: HdmResponse | None, key: str, code: int) -> dict | bool:
+    """Turn a response into the result shape of ``hdm.connection.send_request_to_hdm``.
+
+    Device errors become ``{'hdm_error': '<status>: <message>'}`` and an
+    unreadable reply becomes ``False``. No ``response`` means the request was
+    sent and no answer came back, so the device may have printed it: the
+    result is ``NO_ANSWER`` (see ``is_unanswered``).
+    """
+    if response is None:
+        return dict(NO_ANSWER)
+    if not response.ok:
+        return {'hdm_error': response.error}
+    if not response.length:
+        # Operations that only print on the device answer with an empty body.
+        return {}
+    try:
+        return response.decode(key)
+    except Exception as e:
+        _logger.error('Error recv data to HDM: %s', e)
+        return False
@@ -0,0 +1,163 @@
+"""Serialize the operations sent to each HDM device.
+
+``HDM_DISPATCHER`` only orders the threads of one process. Under a prefork
+server every worker has its own dispatcher, so ``hdm.connection._hdm_turn``
+also takes a Postgres advisory lock per device (see ``advisory_lock``) once
+the process turn is granted; the priorities apply within a worker, the lock
+makes the workers take turns.
+"""
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+PRIORITY_FISCAL = 0
+PRIORITY_ADMIN = 10
+
+FISCAL_CODES = (4, 6)
+# First key of the advisory locks held while a worker talks to a device ("HDM").
+ADVISORY_LOCK_NAMESPACE = 0x48444D
+ADVISORY_LOCK_POLL = 0.05
+
+
+class DeviceBusyError(TimeoutError):
+    """The turn did not come in time; nothing was sent to the device."""
+
+
+class DeviceTurn:
+    """A turn granted on a device.
+
+    ``wait`` is the time spent waiting for it and ``next_seq`` allocates the
+    sequence numbers of the requests sent during the turn.
+    """
+    __slots__ = ('wait', 'next_seq')
+
+    def __init__(self, wait: float, next_seq):
+        self.wait = wait
+        self.next_seq = next_seq
+
+
+def operation_priority(code: int) -> int:
+    """Sales and returns go before admin work such as login, time sync or disconnect."""
+    return PRIORITY_FISCAL if code in FISCAL_CODES else PRIORITY_ADMIN
+
+
+class DeviceQueue:
+    """Serializes the operations sent to one device, highest priority first.
+
+    Callers keep running in their own thread (and with their own cursor); the
+    queue only decides whose turn it is. Equal priorities are served in
+    arrival order.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._busy = False
+        self.served = 0
+        self.total_wait = 0.0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self) -> int:
+        """Number of callers waiting or being served."""
+        return len(self._waiting) + int(self._busy)
+
+    @contextmanager
+    def turn(self, code: int, timeout=None):
+        """Wait until this caller may talk to the device.
+
+        Raises ``DeviceBusyError`` when the turn does not come within ``timeout`` seconds.
+        """
+        entry = (operation_priority(code), next(self._tickets))
+        start = time.monotonic()
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            ready = self._condition.wait_for(lambda: not self._busy and self._waiting[0] == entry, timeout)
+            if not ready:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise DeviceBusyError(f"HDM {self.name} is busy, {self.depth} operation(s) ahead")
+            heapq.heappop(self._waiting)
+            self._busy = True
+            wait = time.monotonic() - start
+            self.served += 1
+            self.total_wait += wait
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+        if wait > 1:
+            _logger.info(f'HDM {self.name}: operation {code} waited {wait:.2f}s in queue')
+        try:
+            yield wait
+        finally:
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'served': self.served,
+            'last_wait': self.last_wait,
+            'avg_wait': self.total_wait / self.served if self.served else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+class Dispatcher:
+    """Per-device request queues shared by every caller of the process."""
+
+    def __init__(self, timeout=120):
+        self.timeout = timeout
+        self.queues = dict()
+        self._lock = threading.Lock()
+
+    def queue(self, id) -> DeviceQueue:
+        with self._lock:
+            queue = self.queues.get(id)
+            if queue is None:
+                queue = self.queues[id] = DeviceQueue(id)
+            return queue
+
+    def turn(self, id, code: int, timeout=None):
+        return self.queue(id).turn(code, timeout=self.timeout if timeout is None else timeout)
+
+    def stats(self, id) -> dict:
+        queue = self.queues.get(id)
+        return queue.stats() if queue else DeviceQueue(id).stats()
+
+
+HDM_DISPATCHER = Dispatcher()
+
+
+def advisory_lock(cr, key: int, timeout=None) -> float:
+    """Take the session advisory lock of device ``key`` on ``cr``, waiting at most ``timeout`` seconds.
+
+    The lock outlives the transaction, so the caller can commit right away
+    and keep no snapshot open while it talks to the device; it must give the
+    lock back with ``advisory_unlock``. A worker that dies while holding it
+    closes its connection, which releases the lock. Returns the time waited;
+    raises ``DeviceBusyError`` like ``DeviceQueue.turn``.
+    """
+    start = time.monotonic()
+    while True:
+        cr.execute("SELECT pg_try_advisory_lock(%s, %s)", [ADVISORY_LOCK_NAMESPACE, key])
+        if cr.fetchone()[0]:
+            return time.monotonic() - start
+        if timeout is not None and time.monotonic() - start >= timeout:
+            raise DeviceBusyError(f"HDM {key} is busy in another worker")
+        time.sleep(ADVISORY_LOCK_POLL)
+
+
+def advisory_unlock(cr, key: int):
+    """Give back the lock taken by ``advisory_lock``."""
+    cr.execute("SELECT pg_advisory_unlock(%s, %s)", [ADVISORY_LOCK_NAMESPACE, key])
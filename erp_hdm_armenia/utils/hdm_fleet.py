@@ -0,0 +1,109 @@
+"""Run one admin operation on many devices at once.
+
+Every device is driven by its ``AsyncHdmClient`` on the process event loop,
+with at most ``limit`` devices in flight. The client uses the same session
+as ``HDM``, so a fleet login is the session the next sale is sent on. A
+device still takes its turn (``hdm.connection._hdm_turn``), so a fleet run
+never interleaves with the sales and returns of the same device, and its
+sequence number is only allocated once the turn is taken.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .hdm_async import HDM_LOOP
+from .hdm_codec import is_unanswered
+from .hdm_metrics import HDM_METRICS
+
+_logger = logging.getLogger(__name__)
+
+FLEET_OPERATIONS = {
+    'sync_time': 10,
+    'login': 2,
+    'disconnect': 3,
+}
+
+
+def _outcome(status, message, start, wait=0.0) -> dict:
+    return {'status': status, 'message': message, 'seconds': time.perf_counter() - start, 'queue_wait': wait}
+
+
+async def _run_call(call: dict, semaphore: asyncio.Semaphore) -> dict:
+    turn = call['turn']
+    timer = HDM_METRICS.timer(call['device'], call['code'])
+    start = time.perf_counter()
+    async with semaphore:
+        # The turn blocks and holds a cursor, so it is taken, used and given back from one thread of its own.
+        loop = asyncio.get_running_loop()
+        thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hdm_fleet')
+        try:
+            try:
+                granted = await loop.run_in_executor(thread, turn.__enter__)
+            except TimeoutError as e:
+                timer.finish('busy')
+                return _outcome('busy', str(e), start)
+            except Exception as e:
+                _logger.exception('HDM fleet operation %s could not take the turn of %s', call['code'], call['device'])
+                timer.finish('failed')
+                return _outcome('failed', str(e), start)
+            timer.add('queue', granted.wait)
+            outcome = None
+            try:
+                outcome = await _send(call, lambda: thread.submit(granted.next_seq).result(), timer, start,
+                                      granted.wait)
+            finally:
+                try:
+                    await loop.run_in_executor(thread, turn.__exit__, None, None, None)
+                except Exception as e:
+                    _logger.exception('HDM fleet operation %s could not give back the turn of %s',
+                                      call['code'], call['device'])
+                    if outcome is not None:
+                        outcome = _outcome('failed', str(e), start, granted.wait)
+            return outcome
+        finally:
+            thread.shutdown(wait=False)
+
+
+async def _send(call: dict, next_seq, timer, start, wait) -> dict:
+    client, code = call['client'], call['code']
+    try:
+        with timer.phase('request'):
+            if code == 2:
+                result = await client.check_login()
+            else:
+                result = await client.request(code, dict(call['data']), next_seq=next_seq)
+    except ConnectionError as e:
+        timer.finish('unreachable')
+        return _outcome('unreachable', str(e), start, wait)
+    except Exception as e:
+        _logger.exception('HDM fleet operation %s failed on %s', code, call['device'])
+        timer.finish('failed')
+        return _outcome('failed', str(e), start, wait)
+    if is_unanswered(result):
+        timer.finish('no_response')
+        return _outcome('no_response', 'No readable answer from HDM.', start, wait)
+    if result.get('hdm_error'):
+        timer.finish(result['hdm_error'].split(':', 1)[0])
+        return _outcome('error', result['hdm_error'], start, wait)
+    timer.finish(200)
+    return _outcome('ok', '', start, wait)
+
+
+def run_fleet(calls: list, limit=8) -> list:
+    """Run ``calls`` and return one outcome per call, in order.
+
+    A call is ``{'client': AsyncHdmClient, 'device': label, 'code': int,
+    'data': dict, 'turn': context manager}``, ``turn`` yielding the
+    ``DeviceTurn`` of the device (see ``hdm.connection._hdm_turn``) whose
+    ``next_seq`` numbers the request right before the send; an outcome is
+    ``{'status', 'message', 'seconds', 'queue_wait'}`` where ``status`` is
+    ``ok``, ``error``, ``no_response``, ``unreachable``, ``busy`` or ``failed``.
+    """
+    async def _run_all():
+        semaphore = asyncio.Semaphore(max(1, limit))
+        return await asyncio.gather(*(_run_call(call, semaphore) for call in calls))
+
+    if not calls:
+        return []
+    return HDM_LOOP.run(_run_all())
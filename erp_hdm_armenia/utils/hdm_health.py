@@ -0,0 +1,132 @@
+"""Device health: circuit breakers and reachability probes.
+
+Every device has a ``CircuitBreaker`` per process. Connection failures of
+real requests or of the health monitor open it, and while it is open
+requests to the device fail at once instead of waiting for the connect
+timeout. After ``reset_timeout`` seconds one request is let through; its
+outcome closes the breaker or opens it again.
+
+Breakers are per worker, so the status the monitor stores on
+``hdm.connection`` is fed back with ``observe_down`` to open the breaker of
+workers that have not met the failure themselves.
+"""
+import asyncio
+import threading
+import time
+
+from .hdm_async import HDM_LOOP
+
+BREAKER_THRESHOLD = 2
+BREAKER_RESET_TIMEOUT = 30.0
+PROBE_TIMEOUT = 3.0
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.succeeded_at = 0.0
+        self.last_error = ''
+        self._probing_since = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'open' if time.time() - self.opened_at < self.reset_timeout else 'half_open'
+
+    def retry_in(self) -> float:
+        """Seconds until a request is let through again."""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.time())
+
+    def allow(self) -> bool:
+        """Whether a request may be sent.
+
+        In the half-open state one caller gets through; another one does only
+        if that caller did not report back within ``reset_timeout``.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.time()
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            if self._probing_since is not None and now - self._probing_since < self.reset_timeout:
+                return False
+            self._probing_since = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.succeeded_at = time.time()
+            self._probing_since = None
+
+    def record_failure(self, error=''):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            # A failed half-open probe opens the breaker again at once.
+            if self.failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = time.time()
+            self._probing_since = None
+
+    def observe_down(self, since: float, error=''):
+        """Open the breaker for a failure seen by another process at ``since`` (epoch seconds).
+
+        A failure older than ``reset_timeout`` leaves the breaker half-open,
+        so a single request checks whether the device is back.
+        """
+        with self._lock:
+            if self.opened_at is None and since > self.succeeded_at:
+                self.failures = max(self.failures, self.threshold)
+                self.opened_at = since
+                self.last_error = str(error)
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self.breakers = dict()
+        self._lock = threading.Lock()
+
+    def get(self, id) -> CircuitBreaker:
+        with self._lock:
+            breaker = self.breakers.get(id)
+            if breaker is None:
+                breaker = self.breakers[id] = CircuitBreaker()
+            return breaker
+
+
+HDM_BREAKERS = BreakerRegistry()
+
+
+async def _probe(host, timeout, semaphore) -> tuple:
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            _reader, writer = await asyncio.wait_for(asyncio.open_connection(*host), timeout=timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            return False, None, str(e) or e.__class__.__name__
+        rtt = time.perf_counter() - start
+        writer.close()
+        return True, rtt, ''
+
+
+def probe_hosts(hosts: list, timeout=PROBE_TIMEOUT, limit=8) -> list:
+    """TCP connect to every ``(host, port)`` concurrently.
+
+    Returns ``(reachable, rtt_seconds, error)`` per host, in order.
+    """
+    async def _run_all():
+        semaphore = asyncio.Semaphore(max(1, limit))
+        return await asyncio.gather(*(_probe(host, timeout, semaphore) for host in hosts))
+
+    if not hosts:
+        return []
+    return HDM_LOOP.run(_run_all())
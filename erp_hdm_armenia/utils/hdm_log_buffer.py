@@ -0,0 +1,54 @@
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+class LogBuffer:
+    """Collects log entries per database and hands them to ``flush`` in batches.
+
+    A batch is written when ``max_size`` entries are waiting or, at the
+    latest, ``interval`` seconds after its first entry, from a timer thread,
+    so the caller's transaction never writes log rows itself.
+    """
+
+    def __init__(self, flush, max_size=50, interval=5.0):
+        self._flush = flush
+        self.max_size = max_size
+        self.interval = interval
+        self._entries = dict()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._entries.values())
+
+    def add(self, dbname, entry: dict):
+        with self._lock:
+            entries = self._entries.setdefault(dbname, [])
+            entries.append(entry)
+            full = len(entries) >= self.max_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush_all)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush(dbname)
+
+    def flush(self, dbname):
+        with self._lock:
+            entries = self._entries.pop(dbname, [])
+        if not entries:
+            return
+        try:
+            self._flush(dbname, entries)
+        except Exception:
+            _logger.exception('Failed to write %s HDM log entries to %s', len(entries), dbname)
+
+    def flush_all(self):
+        with self._lock:
+            self._timer = None
+            dbnames = list(self._entries)
+        for dbname in dbnames:
+            self.flush(dbname)
@@ -0,0 +1,169 @@
+"""In-process latency and throughput metrics of HDM operations.
+
+Every call through ``hdm.connection.send_request_to_hdm`` is timed per
+phase (queue, seq, connect, login, encrypt, send, wait, decrypt, write)
+and labeled with the device, the operation code and the result status.
+The samples are aggregated in ``HDM_METRICS`` and rendered in the
+Prometheus text format by the ``/hdm/metrics`` route.
+
+Each Odoo worker keeps its own registry, so every series also carries a
+``pid`` label and a scrape only sees the worker that answered it.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = dict()
+
+    def inc(self, labels: tuple, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., +Inf count, sum]
+        self.values = dict()
+
+    def observe(self, labels: tuple, value: float):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else _format_value(float(bound))
+                lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+class RequestTimer:
+    """Collects the phase durations of one request until ``finish`` records them."""
+
+    def __init__(self, registry, device, code):
+        self.registry = registry
+        self.device = device
+        self.code = code
+        self.phases = dict()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # A retried request logs in twice: both logins count.
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self, status):
+        self.registry.record(self.device, self.code, status, self.phases, time.perf_counter() - self.start)
+
+
+class NullTimer:
+    """Timer used when the caller does not measure anything."""
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def add(self, name, seconds):
+        pass
+
+    def finish(self, status):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter('hdm_requests_total', 'HDM operations by device, operation code and result status.')
+        self.duration = Histogram('hdm_request_duration_seconds', 'Total duration of HDM operations.')
+        self.phase_duration = Histogram('hdm_phase_duration_seconds', 'Duration of each phase of HDM operations.')
+
+    def timer(self, device, code) -> RequestTimer:
+        return RequestTimer(self, device, code)
+
+    @staticmethod
+    def labels(device, code, phase=None, status=None) -> tuple:
+        labels = (('pid', str(os.getpid())), ('device', str(device)), ('code', str(code)))
+        if phase is not None:
+            labels += (('phase', phase),)
+        return labels + (('status', str(status)),)
+
+    def record(self, device, code, status, phases: dict, total: float):
+        with self._lock:
+            self.requests.inc(self.labels(device, code, status=status))
+            self.duration.observe(self.labels(device, code, status=status), total)
+            for phase, value in phases.items():
+                self.phase_duration.observe(self.labels(device, code, phase, status), value)
+
+    @contextmanager
+    def timed(self, device, code, phase, status=200):
+        """Time a phase that runs after the request was recorded, such as the ORM write-back."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            labels = self.labels(device, code, phase, status)
+            with self._lock:
+                self.phase_duration.observe(labels, time.perf_counter() - start)
+
+    def render(self) -> str:
+        with self._lock:
+            lines = self.requests.render() + self.duration.render() + self.phase_duration.render()
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self.requests.values.clear()
+            self.duration.values.clear()
+            self.phase_duration.values.clear()
+
+
+HDM_METRICS = MetricsRegistry()
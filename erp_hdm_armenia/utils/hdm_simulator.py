@@ -0,0 +1,329 @@
+"""Local HDM fiscal register simulator.
+
+Speaks the framing used by ``SocketConnection``: the ``default_header_bytes``
+magic, the dynamic header, 3DES with the password for login and with the
+session key afterwards, and the status codes of ``hdm_error_codes``. It
+implements login (2), disconnect (3), sale (4), return (6) and time sync (10),
+keeps sequence numbers and receipts, and can add latency, jitter, dropped
+connections and injected errors.
+
+Run it without Odoo (only pycryptodome is needed)::
+
+    python3 erp_hdm_armenia/utils/hdm_simulator.py --port 8888 --latency 0.08 --jitter 0.02
+
+then point an ``hdm.connection`` at 127.0.0.1:8888 with the same password,
+cashier and pin.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+if __package__:
+    from .hdm_codec import (
+        PROTOCOL_VERSION, REQUEST_HEADER, decode_request_header, default_header_bytes, encode_json, encode_response,
+    )
+    from .utils import generate_hdm_key, generate_second_key, hdm_error_codes, unpack_hdm_key, unpack_hdm_response
+else:
+    # Run as a script from the utils directory.
+    from hdm_codec import (
+        PROTOCOL_VERSION, REQUEST_HEADER, decode_request_header, default_header_bytes, encode_json, encode_response,
+    )
+    from utils import generate_hdm_key, generate_second_key, hdm_error_codes, unpack_hdm_key, unpack_hdm_response
+
+_logger = logging.getLogger(__name__)
+
+
+class HdmError(Exception):
+    def __init__(self, status):
+        super().__init__(f'{status}: {hdm_error_codes.get(status, "Unknown Error")}')
+        self.status = status
+
+
+class HdmSimulator:
+    """In-memory fiscal register served over asyncio."""
+
+    def __init__(self, host='127.0.0.1', port=0, password='password', cashier=1, pin='1234', crn='SIM00001',
+                 latency=0.0, jitter=0.0, error_rate=0.0, error_codes=(143,), drop_rate=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.cashier = int(cashier)
+        self.pin = str(pin)
+        self.crn = crn
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.session_key = None
+        self.last_seq = 0
+        self.rseq = 0
+        self.receipts = dict()
+        self.stats = {'connections': 0, 'requests': 0, 'errors': 0, 'dropped': 0, 'by_code': {}}
+        self._server = None
+        self._loop = None
+        self._handlers = dict()
+
+    # Framing
+
+    def response(self, status, body=b''):
+        return encode_response(status, body)
+
+    async def read_request(self, reader):
+        header = await reader.readexactly(REQUEST_HEADER.size)
+        magic, version, code, length = decode_request_header(header)
+        body = await reader.readexactly(length)
+        if magic != default_header_bytes:
+            raise HdmError(103)
+        if version != PROTOCOL_VERSION:
+            raise HdmError(402)
+        return code, body
+
+    # Connection handling
+
+    async def handle(self, reader, writer):
+        self.stats['connections'] += 1
+        self._handlers[asyncio.current_task()] = writer
+        try:
+            while True:
+                try:
+                    code, body = await self.read_request(reader)
+                except HdmError as e:
+                    writer.write(self.response(e.status))
+                    await writer.drain()
+                    break
+                self.stats['requests'] += 1
+                self.stats['by_code'][code] = self.stats['by_code'].get(code, 0) + 1
+                await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+                if self.drop_rate and self.random.random() < self.drop_rate:
+                    self.stats['dropped'] += 1
+                    break
+                writer.write(self.dispatch(code, body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._handlers.pop(asyncio.current_task(), None)
+            writer.close()
+
+    def dispatch(self, code, body):
+        try:
+            if self.error_rate and code != 2 and self.random.random() < self.error_rate:
+                raise HdmError(self.random.choice(self.error_codes))
+            if code == 2:
+                return self.response(200, generate_hdm_key(self.password, encode_json(self.login(body))))
+            handler = {3: self.logout, 4: self.sale, 6: self.return_receipt, 10: self.sync_time}.get(code)
+            if handler is None:
+                raise HdmError(404)
+            key = self.session_key
+            result = handler(self.decode(body))
+            return self.response(200, generate_second_key(key, encode_json(result)) if result is not None else b'')
+        except HdmError as e:
+            self.stats['errors'] += 1
+            return self.response(e.status)
+        except Exception:
+            _logger.exception('HDM simulator failure')
+            self.stats['errors'] += 1
+            return self.response(500)
+
+    def decode(self, body):
+        if not self.session_key:
+            raise HdmError(102)
+        try:
+            text = unpack_hdm_response(self.session_key, body)
+        except (ValueError, UnicodeDecodeError):
+            raise HdmError(102)
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise HdmError(105)
+        seq = data.get('seq')
+        if not isinstance(seq, int) or seq <= self.last_seq:
+            raise HdmError(104)
+        self.last_seq = seq
+        return data
+
+    # Operations
+
+    def login(self, body):
+        try:
+            data = json.loads(unpack_hdm_key(self.password, body))
+        except (ValueError, UnicodeDecodeError):
+            raise HdmError(101)
+        if data.get('cashier') != self.cashier:
+            raise HdmError(112)
+        if data.get('password') != self.password or str(data.get('pin')) != self.pin:
+            raise HdmError(111)
+        # A new login replaces the previous session, like on the device.
+        self.session_key = base64.b64encode(os.urandom(24)).decode()
+        return {'key': self.session_key}
+
+    def logout(self, data):
+        self.session_key = None
+        return None
+
+    def sync_time(self, data):
+        return None
+
+    def sale(self, data):
+        mode = data.get('mode')
+        if mode not in (1, 2, 3):
+            raise HdmError(172)
+        items = data.get('items') or []
+        if mode == 2:
+            if not items:
+                raise HdmError(400)
+            total = 0.0
+            for item in items:
+                if not item.get('productName'):
+                    raise HdmError(162)
+                if not item.get('unit'):
+                    raise HdmError(163)
+                if item.get('qty', 0) <= 0 or item.get('price', 0) <= 0:
+                    raise HdmError(159)
+                price = item['price']
+                if item.get('discountType') == 1:
+                    if not 0 <= item.get('discount', 0) < 100:
+                        raise HdmError(160)
+                    price *= 1 - item['discount'] / 100
+                total += item['qty'] * price
+        else:
+            total = data.get('paidAmount', 0) + data.get('paidAmountCard', 0) + data.get('prePaymentAmount', 0)
+        paid = data.get('paidAmount', 0) + data.get('paidAmountCard', 0) + data.get('prePaymentAmount', 0)
+        if total <= 0:
+            raise HdmError(154)
+        if data.get('paidAmountCard', 0) > total:
+            raise HdmError(167)
+        if paid + 0.01 < total:
+            raise HdmError(152)
+        self.rseq += 1
+        receipt = {
+            'rseq': self.rseq,
+            'crn': self.crn,
+            'sn': 'SIM',
+            'tin': '00000000',
+            'taxpayer': 'HDM Simulator',
+            'address': 'localhost',
+            'time': int(time.time() * 1000),
+            'fiscal': f'{self.rseq:08d}',
+            'lottery': '',
+            'prize': 0,
+            'total': round(total, 2),
+            'change': round(max(paid - total, 0), 2),
+        }
+        self.receipts[str(self.rseq)] = {'receipt': receipt, 'items': items, 'returned': 0.0}
+        return receipt
+
+    def return_receipt(self, data):
+        if str(data.get('crn')) != self.crn:
+            raise HdmError(175)
+        original = self.receipts.get(str(data.get('returnTicketId')))
+        if original is None:
+            raise HdmError(174)
+        remaining = original['receipt']['total'] - original['returned']
+        if remaining <= 0:
+            raise HdmError(158)
+        amount = remaining
+        if data.get('returnItemList'):
+            amount = 0.0
+            for line in data['returnItemList']:
+                rpid = line.get('rpid')
+                if not isinstance(rpid, int) or not 0 <= rpid < len(original['items']):
+                    raise HdmError(181)
+                item = original['items'][rpid]
+                if line.get('quantity', 0) <= 0 or line['quantity'] > item['qty']:
+                    raise HdmError(181)
+                price = item['price'] * (1 - item.get('discount', 0) / 100 if item.get('discountType') == 1 else 1)
+                amount += line['quantity'] * price
+        if amount > remaining + 0.01:
+            raise HdmError(180)
+        original['returned'] += amount
+        self.rseq += 1
+        return {
+            'rseq': self.rseq,
+            'crn': self.crn,
+            'fiscal': f'{self.rseq:08d}',
+            'time': int(time.time() * 1000),
+            'total': round(amount, 2),
+        }
+
+    # Serving
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.host, self.port = self._server.sockets[0].getsockname()[:2]
+        _logger.info(f'HDM simulator listening on {self.host}:{self.port}')
+        return self.host, self.port
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start_in_thread(self):
+        """Serve from a daemon thread and return the ``(host, port)`` address."""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def _run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        threading.Thread(target=_run, name='hdm-simulator', daemon=True).start()
+        started.wait()
+        return self.host, self.port
+
+    async def _shutdown(self):
+        # Close the connections still open before the loop stops, so no handler is left pending.
+        self._server.close()
+        handlers = list(self._handlers.items())
+        for _task, writer in handlers:
+            writer.transport.abort()
+        await asyncio.gather(*(task for task, _writer in handlers), return_exceptions=True)
+        self._loop.stop()
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local HDM fiscal register simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--cashier', type=int, default=1)
+    parser.add_argument('--pin', default='1234')
+    parser.add_argument('--crn', default='SIM00001')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds around the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with an error')
+    parser.add_argument('--error-codes', default='143', help='Comma separated statuses to inject, e.g. 143,145')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Share of requests whose connection is dropped')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    simulator = HdmSimulator(
+        host=args.host, port=args.port, password=args.password, cashier=args.cashier, pin=args.pin,
+        crn=args.crn, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_codes=[int(code) for code in args.error_codes.split(',') if code], drop_rate=args.drop_rate,
+        seed=args.seed,
+    )
+    try:
+        asyncio.run(simulator.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,52 @@
+import select
 import socket
-import struct
-
-import json
+import threading
+import time
 
 from .utils import *
+from .hdm_codec import (
+    HdmResponse, RESPONSE_HEADER, decode_response_header, encode_login, encode_password_request,
+    encode_session_request,
+)
+from .hdm_metrics import NULL_TIMER
+from .hdm_timeouts import DeviceTimeouts, request_size
 
 import logging
 
 _logger = logging.getLogger(__name__)
 
+SESSION_ERROR_CODES = (101, 102)
+
+
+def recv_into_exactly(client: socket.socket, view: memoryview) -> None:
+    received = 0
+    while received < len(view):
+        size = client.recv_into(view[received:])
+        if not size:
+            raise ConnectionResetError(f"HDM closed the connection after {received} of {len(view)} bytes")
+        received += size
+
+
+def recv_frame(client: socket.socket) -> HdmResponse:
+    """Read one complete response frame, however many TCP segments it spans."""
+    header = bytearray(RESPONSE_HEADER.size)
+    recv_into_exactly(client, memoryview(header))
+    status, length = decode_response_header(header)
+    body = memoryview(bytearray(length))
+    recv_into_exactly(client, body)
+    return HdmResponse(status, body)
+
 
 class SocketConnection:
+    """Sockets and session keys of the devices, per process.
+
+    Nothing here is shared between the workers of a prefork server: callers
+    serialize across workers and hand the session key over with
+    ``hdm.connection._hdm_turn`` and ``adopt``.
+    """
     connection = dict()
+    sessions = dict()
+    locks = dict()
 
     @staticmethod
     def log_connection(func):
@@ -19,7 +54,7 @@ class SocketConnection:
             client = self.check_connection(id)
             if not client:
                 raise ConnectionError(f"No active connection for id: {id}")
-            _logger.info(f"Connection status for {id}: {client if client else 'inactive'}")
+            _logger.debug("Connection status for %s: %s", id, client)
             return func(self, id, client, *args, **kwargs)
 
         return wrapper
@@ -29,18 +64,22 @@ class SocketConnection:
         if not client:
             return False
         try:
-            client.send(b"", socket.MSG_DONTWAIT | socket.MSG_NOSIGNAL)
+            readable, _, _ = select.select([client], [], [], 0)
+            # An idle session has nothing to read, so a readable socket with an
+            # empty peek means the device closed its side.
+            if readable and client.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b"":
+                return False
             return client
-        except (BrokenPipeError, ConnectionResetError, OSError):
+        except (BrokenPipeError, ConnectionResetError, OSError, ValueError):
             return False
 
     def connect(self, host: str | tuple, id: int, timeout=60) -> socket.socket | None:
-        if client := self.connection.get(id):
-            if self.check_connection(client):
-                _logger.info("Using existing connection")
+        if self.connection.get(id):
+            if client := self.check_connection(id):
+                _logger.debug("Using existing connection")
                 return client
 
-        _logger.info(f"Creating new connection to {host}")
+        _logger.info("Creating new connection to %s", host)
 
         try:
             client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -49,36 +88,44 @@ class SocketConnection:
             client.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 20)
             client.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
             client.connect(host)
-            _logger.info(f"Connected to {host}")
+            _logger.info("Connected to %s", host)
         except Exception as e:
-            _logger.error(f"Connection failed: {e}")
+            _logger.error("Connection failed: %s", e)
             return None
         else:
             self.connection[id] = client
             return client
 
     @log_connection
-    def send(self, id: int, client: socket.socket | None, data: dict, code: int, connection, **kwargs) -> bytes | None:
-        header = bytearray(default_header_bytes)
-        added_bytes_to_header(header, generate_dynamic_headers_data(code))
-        if code == 2:
-            sending_data = generate_hdm_key(connection.hdm_password, json.dumps(data))
-        else:
-            sending_data = generate_second_key(connection.hdm_key, json.dumps(data))
-
-        added_bytes_to_header(header, [len(sending_data).to_bytes(2, 'big'), sending_data])
+    def send(self, id: int, client: socket.socket | None, data: dict, code: int, connection, frame=None,
+             timer=NULL_TIMER, timeouts: DeviceTimeouts | None = None, **kwargs) -> HdmResponse | None:
+        size = request_size(data)
+        if timeouts is not None:
+            client.settimeout(timeouts.read_timeout(code, size))
+        if frame is None:
+            with timer.phase('encrypt'):
+                if code == 2:
+                    frame = encode_password_request(connection.hdm_password, code, data)
+                else:
+                    frame = encode_session_request(self.sessions.get(id) or connection.hdm_key, code, data)
 
-        client.sendall(header)
+        with timer.phase('send'):
+            client.sendall(frame)
 
         try:
-            response = client.recv(2048)
-            _logger.info(f'Recv information: {response}')
-            connection.hdm_seq += 1
+            with timer.phase('wait'):
+                start = time.perf_counter()
+                response = recv_frame(client)
+            if timeouts is not None:
+                timeouts.record_read(code, time.perf_counter() - start, size)
+            _logger.debug('Recv information: %s', response)
             return response
         except socket.timeout:
-            _logger.error("Timed out")
+            _logger.error("HDM %s did not answer operation %s within %.1fs", id, code, client.gettimeout())
         except ConnectionRefusedError:
             _logger.error("Connection refused.")
+        except ConnectionResetError as e:
+            _logger.error("Incomplete response: %s", e)
         except Exception as e:
             _logger.error(e)
 
@@ -100,7 +147,116 @@ class SocketConnection:
                     _logger.error(f"Error closing socket + connection: {e}")
                 finally:
                     self.connection.pop(id)
-                    connection.hdm_key = ''
+                    forget_session_key(self.sessions.pop(id, None))
+                    if connection is not None:
+                        connection.hdm_key = ''
+
+    def adopt(self, id, key):
+        """Use ``key``, issued to another worker for the same device, as the session of ``id``.
+
+        ``sessions`` belongs to one process; the key is the device's, so the
+        socket of this worker may send with it instead of logging in again.
+        """
+        if key and self.sessions.get(id) != key:
+            forget_session_key(self.sessions.get(id))
+            self.sessions[id] = key
+
+    def drop(self, id):
+        """Forget the session of ``id``, closing its socket if one is still open."""
+        forget_session_key(self.sessions.pop(id, None))
+        client = self.connection.pop(id, None)
+        if client:
+            try:
+                client.close()
+            except OSError as e:
+                _logger.warning(f"Error closing socket: {e}")
+
+    def login(self, id, connection, timeouts: DeviceTimeouts | None = None) -> HdmResponse | None:
+        """Authenticate the socket of ``id`` and remember the session key issued by the device.
+
+        Returns the raw login response so callers can report a rejected login.
+        """
+        frame = encode_login(id, connection.hdm_password, connection.hdm_login_data)
+        response = self.send(id=id, data=None, code=2, connection=connection, frame=frame, timeouts=timeouts)
+        if response is not None and response.ok:
+            key = response.decode_login(connection.hdm_password).get('key')
+            if key:
+                self.sessions[id] = key
+        return response
+
+    def open_session(self, id, host, connection, timeout=60, timer=NULL_TIMER,
+                     timeouts: DeviceTimeouts | None = None) -> HdmResponse | None:
+        """Connect to ``host`` and log in, replacing any previous session of ``id``.
+
+        ``timeout`` bounds the connect unless ``timeouts`` provides learned deadlines.
+        """
+        self.drop(id)
+        if timeouts is not None:
+            timeout = timeouts.connect_timeout()
+        with timer.phase('connect'):
+            start = time.perf_counter()
+            client = self.connect(host=host, id=id, timeout=timeout)
+        if client is None:
+            raise ConnectionError(f"Unable to connect to HDM at {host}")
+        if timeouts is not None:
+            timeouts.record_connect(time.perf_counter() - start)
+        with timer.phase('login'):
+            return self.login(id, connection, timeouts=timeouts)
+
+    def request(self, id, host, data: dict, code: int, connection, timeout=60, next_seq=None,
+                timer=NULL_TIMER, timeouts: DeviceTimeouts | None = None) -> HdmResponse | None:
+        """Send ``data`` over the authenticated session of ``id``.
+
+        The session is reused while the device accepts its key. A new login is
+        made only when there is no session yet, when the device dropped the
+        socket, or when it rejects the key with 101/102. A request that may have
+        reached the device is never repeated, so a receipt cannot be printed twice.
+        Returns None only when the request was sent and no answer came back;
+        raises ``ConnectionError`` when it could not be sent.
+
+        ``next_seq`` allocates the request sequence number; it is called right
+        before each send so a retried request never reuses a number. ``timer``
+        receives the duration of each phase (see ``hdm_metrics``). ``timeouts``
+        gives the connect and read deadlines learned for the device; without
+        it ``timeout`` bounds both.
+        """
+        lock = self.locks.setdefault(id, threading.Lock())
+        with lock:
+            for attempt in range(2):
+                if not (self.sessions.get(id) and self.check_connection(id)):
+                    login_response = self.open_session(id, host, connection, timeout=timeout, timer=timer,
+                                                       timeouts=timeouts)
+                    if id not in self.sessions:
+                        self.drop(id)
+                        if login_response is None:
+                            raise ConnectionError(f"HDM {id} did not answer the login")
+                        return login_response
+                if next_seq is not None:
+                    with timer.phase('seq'):
+                        data['seq'] = next_seq()
+                try:
+                    response = self.send(id=id, data=data, code=code, connection=connection, timer=timer,
+                                         timeouts=timeouts)
+                except (BrokenPipeError, ConnectionResetError):
+                    _logger.info('HDM session %s was dropped by the device, logging in again.', id)
+                    self.drop(id)
+                    continue
+                except socket.timeout as e:
+                    # The frame was not written completely, so the device cannot have processed it.
+                    self.drop(id)
+                    raise ConnectionError(f"HDM {id} stopped reading the request: {e}") from e
+                if response_status(response) in SESSION_ERROR_CODES and not attempt:
+                    _logger.info('HDM session key of %s is no longer valid, logging in again.', id)
+                    self.drop(id)
+                    continue
+                if not response or code == 3:
+                    self.drop(id)
+                return response
+            raise ConnectionError(f"HDM {id} dropped the session before the request was sent")
+
+
+def response_status(response: HdmResponse | None) -> int | None:
+    return response.status if response else None
 
 
 HDM = SocketConnection()
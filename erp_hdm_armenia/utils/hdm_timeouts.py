@@ -0,0 +1,109 @@
+"""Connect and read deadlines learned from the latency of each device.
+
+The synchronous socket records how long every connect and every answer
+took. A deadline is a multiple of the recent 99th percentile for the same
+kind of work, clamped between the floor and the ceiling configured on the
+device. Answers are grouped by operation code and by the number of items
+of the receipt, so a 300 line print is not judged by the latency of
+logins. Until enough samples are known the ceiling is used, and so it is
+for a receipt with more items than any timed in its class: the last class
+has no upper bound, and 50 line receipts say little about a 300 line one.
+"""
+import bisect
+import math
+import threading
+from collections import deque
+
+WINDOW = 200
+MIN_SAMPLES = 20
+# Sessions are kept open, so connects are rare.
+MIN_CONNECT_SAMPLES = 5
+FACTOR = 3.0
+CONNECT_MARGIN = 0.5
+READ_MARGIN = 1.0
+# Item counts splitting receipts into size classes.
+SIZE_CLASSES = (10, 50)
+
+
+def quantile(samples, q) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+
+
+def size_class(size: int) -> int:
+    return bisect.bisect_left(SIZE_CLASSES, size)
+
+
+class DeviceTimeouts:
+    """Rolling latency samples and deadlines of one device."""
+
+    def __init__(self, connect_floor=1.0, connect_ceiling=10.0, read_floor=5.0, read_ceiling=60.0):
+        self.connect_floor = connect_floor
+        self.connect_ceiling = connect_ceiling
+        self.read_floor = read_floor
+        self.read_ceiling = read_ceiling
+        self.samples = dict()
+        self.largest = dict()
+        self._lock = threading.Lock()
+
+    def configure(self, connect_floor, connect_ceiling, read_floor, read_ceiling):
+        self.connect_floor, self.connect_ceiling = connect_floor, max(connect_floor, connect_ceiling)
+        self.read_floor, self.read_ceiling = read_floor, max(read_floor, read_ceiling)
+
+    def record_connect(self, seconds: float):
+        self._record(('connect',), seconds)
+
+    def record_read(self, code: int, seconds: float, size=0):
+        key = ('read', code, size_class(size))
+        self._record(key, seconds)
+        with self._lock:
+            self.largest[key] = max(self.largest.get(key, 0), size)
+
+    def _record(self, key, seconds):
+        with self._lock:
+            window = self.samples.get(key)
+            if window is None:
+                window = self.samples[key] = deque(maxlen=WINDOW)
+            window.append(seconds)
+
+    def _deadline(self, key, margin, floor, ceiling, min_samples=MIN_SAMPLES) -> float:
+        with self._lock:
+            window = tuple(self.samples.get(key, ()))
+        if len(window) < min_samples:
+            return ceiling
+        return min(ceiling, max(floor, quantile(window, 0.99) * FACTOR + margin))
+
+    def connect_timeout(self) -> float:
+        return self._deadline(('connect',), CONNECT_MARGIN, self.connect_floor, self.connect_ceiling,
+                              min_samples=MIN_CONNECT_SAMPLES)
+
+    def read_timeout(self, code: int, size=0) -> float:
+        """Deadline for the answer to operation ``code`` carrying ``size`` items."""
+        key = ('read', code, size_class(size))
+        if size > self.largest.get(key, 0):
+            return self.read_ceiling
+        return self._deadline(key, READ_MARGIN, self.read_floor, self.read_ceiling)
+
+
+class TimeoutRegistry:
+    def __init__(self):
+        self.devices = dict()
+        self._lock = threading.Lock()
+
+    def get(self, id, connect_floor, connect_ceiling, read_floor, read_ceiling) -> DeviceTimeouts:
+        with self._lock:
+            timeouts = self.devices.get(id)
+            if timeouts is None:
+                timeouts = self.devices[id] = DeviceTimeouts()
+        timeouts.configure(connect_floor, connect_ceiling, read_floor, read_ceiling)
+        return timeouts
+
+
+HDM_TIMEOUTS = TimeoutRegistry()
+
+
+def request_size(data: dict | None) -> int:
+    """Number of items of a sale or a return, used to pick its latency class."""
+    if not data:
+        return 0
+    return len(data.get('items') or data.get('returnItemList') or ())
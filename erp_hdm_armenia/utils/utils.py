@@ -1,10 +1,48 @@
 import base64
+import threading
+from collections import OrderedDict
 
 from Crypto.Hash import SHA256
 from Crypto.Cipher import DES3
 from Crypto.Util.Padding import pad, unpad
 
-default_header_bytes = bytes([0xD5, 0x80, 0xD4, 0xB4, 0xD5, 0x84])
+
+class BoundedCache:
+    """Small thread-safe LRU mapping used to keep crypto setup out of the request path."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                return self._data[key]
+            except KeyError:
+                pass
+        value = factory()
+        with self._lock:
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+password_ciphers = BoundedCache(maxsize=32)
+session_ciphers = BoundedCache(maxsize=128)
 
 
 def generate_key_from_password(password):
@@ -13,50 +51,39 @@ def generate_key_from_password(password):
     return key
 
 
-def generate_dynamic_headers_data(gorcaruyti_code) -> list:
-    arc, arc_hamar, reserve = 0, 7, 0
-    return [arc, arc_hamar, gorcaruyti_code, reserve]
+def password_cipher(password: str):
+    return password_ciphers.get_or_create(
+        password, lambda: DES3.new(generate_key_from_password(password), DES3.MODE_ECB))
+
+
+def session_cipher(key: str):
+    return session_ciphers.get_or_create(key, lambda: DES3.new(base64.b64decode(key), DES3.MODE_ECB))
+
+
+def forget_session_key(key: str) -> None:
+    """Drop the cipher of a session key the device no longer accepts."""
+    if key:
+        session_ciphers.discard(key)
 
 
 def generate_hdm_key(password: str, data: str) -> bytes:
-    key = generate_key_from_password(password)
-    cipher = DES3.new(key, DES3.MODE_ECB)
     padded_data = pad(data.encode(), DES3.block_size)
-    return cipher.encrypt(padded_data)
+    return password_cipher(password).encrypt(padded_data)
 
 
 def unpack_hdm_key(password: str, data: bytes) -> str:
-    key = generate_key_from_password(password)
-    cipher = DES3.new(key, DES3.MODE_ECB)
-    decrypted_data = unpad(cipher.decrypt(data), DES3.block_size)
+    decrypted_data = unpad(password_cipher(password).decrypt(data), DES3.block_size)
     return decrypted_data.decode()
 
 
 def unpack_hdm_response(key, data: bytes) -> str:
-    cipher = DES3.new(base64.b64decode(key), DES3.MODE_ECB)
-    decrypted_data = unpad(cipher.decrypt(data), DES3.block_size)
+    decrypted_data = unpad(session_cipher(key).decrypt(data), DES3.block_size)
     return decrypted_data.decode()
 
 
 def generate_second_key(key, data: str) -> bytes:
-    cipher = DES3.new(base64.b64decode(key), DES3.MODE_ECB)
     padded_data = pad(data.encode(), DES3.block_size)
-    return cipher.encrypt(padded_data)
-
-
-def check_byte_and_add(header, data):
-    if isinstance(data, bytes):
-        header += data
-    elif isinstance(data, int):
-        header += data.to_bytes(length=1, byteorder='little')
-
-
-def added_bytes_to_header(header, data) -> None:
-    if isinstance(data, list):
-        for byte in data:
-            check_byte_and_add(header, byte)
-    else:
-        check_byte_and_add(header, data)
+    return session_cipher(key).encrypt(padded_data)
 
 
 hdm_error_codes = {
@@ -4,3 +4,4 @@ from . import pos_order
 from . import pos_config
 from . import res_config
 from . import pos_payment_method
+from . import hdm_connection
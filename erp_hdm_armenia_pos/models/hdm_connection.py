@@ -0,0 +1,16 @@
+from odoo import models
+
+
+class HdmConnection(models.Model):
+    _inherit = 'hdm.connection'
+
+    def _hdm_notify_status(self, status, error):
+        super()._hdm_notify_status(status, error)
+        configs = self.env['pos.config'].sudo().search([
+            '|', ('hdm_connection_id', 'in', self.ids), ('hdm_connection_ids', 'in', self.ids)])
+        for config in configs:
+            config._notify('HDM_STATUS', {
+                'hdm_connection_id': self.id,
+                'status': config.hdm_status,
+                'error': error,
+            })
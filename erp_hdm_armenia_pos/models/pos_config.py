@@ -7,6 +7,9 @@ class PosConfig(models.Model):
     _inherit = 'pos.config'
 
     hdm_connection_id = fields.Many2one('hdm.connection', string='HDM Armenia Connection')
+    hdm_connection_ids = fields.Many2many('hdm.connection', 'pos_config_hdm_connection_rel', 'config_id',
+                                          'connection_id', string='HDM Device Pool',
+                                          help='More devices the receipts of this point of sale are spread over')
     hdm_dep = fields.Selection([('1', 'հարկվող'), ('2', 'չհարկվող')], string='HDM Department', default='1')
     use_dep = fields.Boolean(string='Use HDM Department', default=False)
     hdm_type = fields.Selection([
@@ -15,5 +18,25 @@ class PosConfig(models.Model):
         ('3', 'Կանխավճար'),
     ], string='Mode', default='2')
     use_hdm_type = fields.Boolean(string='Use HDM Type', default=True)
+    hdm_status = fields.Selection([
+        ('unknown', 'Unknown'),
+        ('up', 'Online'),
+        ('down', 'Offline'),
+    ], string='HDM Status', compute='_compute_hdm_status')
 
+    @api.depends('hdm_connection_id.hdm_status', 'hdm_connection_ids.hdm_status')
+    def _compute_hdm_status(self):
+        """Online when a device of the pool is, offline when all of them are."""
+        for config in self:
+            statuses = set(config._hdm_pool().mapped('hdm_status'))
+            config.hdm_status = 'up' if 'up' in statuses else 'down' if statuses == {'down'} else 'unknown'
 
+    def _hdm_pool(self):
+        """Devices receipts of this point of sale may be printed on, its HDM connection first."""
+        self.ensure_one()
+        return self.hdm_connection_id | self.hdm_connection_ids
+
+    @api.model
+    def _load_pos_self_data_fields(self, config):
+        fields = super()._load_pos_self_data_fields(config)
+        return fields + ['hdm_status'] if fields else fields
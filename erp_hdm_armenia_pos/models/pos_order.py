@@ -3,20 +3,27 @@ import logging
 from odoo import api, fields, models, _, Command
 from odoo.exceptions import ValidationError, AccessError
 
+from odoo.addons.erp_hdm_armenia.utils.hdm_metrics import HDM_METRICS
+
 _logger = logging.getLogger(__name__)
 
+PAYMENT_TOTAL_KEYS = ('cash_amount', 'bank_amount', 'prepayment_amount')
+
 
 class PosOrderLine(models.Model):
     _inherit = 'pos.order.line'
 
-    def _prepare_hdm_item_data(self, hdm_dep) -> dict:
+    def _prepare_hdm_item_data(self, hdm_dep, fiscal_data=None) -> dict:
+        """``fiscal_data`` is the ``_get_hdm_fiscal_data`` of the order's products, when already read."""
         self.ensure_one()
-        hs_code = self.product_id.hs_code or self.product_id.product_tmpl_id and self.product_id.product_tmpl_id.hs_code
+        if fiscal_data is None:
+            fiscal_data = self.product_id._get_hdm_fiscal_data()
+        product = fiscal_data.get(self.product_id.id, {})
         item = {
-            "dep": self.product_id.hdm_dep or hdm_dep,
-            "adgCode": hs_code,
+            "dep": product.get('dep') or hdm_dep,
+            "adgCode": product.get('adgCode', False),
             "productCode": self.product_id.id,
-            "productName": self.product_id.hdm_product_name,
+            "productName": product.get('productName', False),
             "qty": self.qty,
             "unit": self.product_uom_id.name,
             "price": round(self.price_subtotal_incl / self.qty, 2)
@@ -28,6 +35,12 @@ class PosOrderLine(models.Model):
             })
         return item
 
+    def _prepare_hdm_items(self, hdm_dep) -> list:
+        """Items of all lines in ``self``, with product data read once for the whole order."""
+        fiscal_data = self.product_id._get_hdm_fiscal_data()
+        self.product_uom_id.fetch(['name'])
+        return [line._prepare_hdm_item_data(hdm_dep, fiscal_data) for line in self]
+
 
 class PosOrder(models.Model):
     _inherit = 'pos.order'
@@ -38,11 +51,102 @@ class PosOrder(models.Model):
         ('2', 'Ապրանքներ ռեժիմ'),
         ('3', 'Կանխավճար'),
     ], string='Mode', help='HDM Կտրոնի ռեժիմը')
-    fiscal_receipt_id = fields.Many2one('hdm.receipt', string='Fiscal Receipt', help='HDM Կտրոն')
+    fiscal_receipt_id = fields.Many2one('hdm.receipt', string='Fiscal Receipt', help='HDM Կտրոն',
+                                        index='btree_not_null')
     retunr_receipt_id = fields.Many2one('hdm.receipt', string='Return Receipt', help='HDM Վերադարձի Կտրոն')
     rseq = fields.Char(string='Rseq', help='Կտրոնի հերթական համար')
     returned_rseq = fields.Char(string='Returned Rseq', help='Վերադարձի Կտրոնի հերթական համար')
     hdm_success = fields.Boolean(string='HDM Success', readonly=True, help='Հաջողությամբ ուղարկված է HDM')
+    hdm_outbox_id = fields.Many2one('hdm.outbox', string='Queued Fiscal Receipt', readonly=True, copy=False,
+                                    help='Fiscal receipt waiting in the HDM outbox')
+    hdm_kiosk_payment_method_id = fields.Many2one('pos.payment.method', string='Kiosk HDM Payment', readonly=True,
+                                                  copy=False, help='Paid with this method once the device printed '
+                                                                   'the receipt of the kiosk order')
+    hdm_paid_cash = fields.Float(string='Paid Cash', compute='_compute_hdm_paid_amounts', store=True)
+    hdm_paid_card = fields.Float(string='Paid Card', compute='_compute_hdm_paid_amounts', store=True)
+    hdm_paid_prepayment = fields.Float(string='Paid Prepayment', compute='_compute_hdm_paid_amounts', store=True)
+    hdm_refundable_cash = fields.Float(string='Refundable Cash', compute='_compute_hdm_refundable', store=True,
+                                       help='Cash of this order not refunded yet')
+    hdm_refundable_card = fields.Float(string='Refundable Card', compute='_compute_hdm_refundable', store=True,
+                                       help='Card amount of this order not refunded yet')
+    hdm_refundable_prepayment = fields.Float(string='Refundable Prepayment', compute='_compute_hdm_refundable',
+                                             store=True, help='Prepayment of this order not refunded yet')
+
+    @api.depends('payment_ids.amount', 'payment_ids.payment_method_id')
+    def _compute_hdm_paid_amounts(self):
+        totals = self._hdm_payment_totals()
+        for order in self:
+            order.hdm_paid_cash = totals[order.id]['cash_amount']
+            order.hdm_paid_card = totals[order.id]['bank_amount']
+            order.hdm_paid_prepayment = totals[order.id]['prepayment_amount']
+
+    def _hdm_payment_totals(self) -> dict:
+        """Cash, bank and prepayment totals of the orders in ``self``, keyed by order id.
+
+        Saved orders are summed in one grouped query over ``pos.payment``,
+        whatever their number; the gift account of each order's till counts
+        as prepayment. The query runs as superuser: the totals are stored for
+        every user, so record rules of the current one must not hide payments.
+        """
+        totals = {order.id: dict.fromkeys(PAYMENT_TOTAL_KEYS, 0.0) for order in self}
+        saved = self.filtered('id')
+        rows = [
+            (order, method, amount)
+            for order, method, amount in self.env['pos.payment'].sudo()._read_group(
+                [('pos_order_id', 'in', saved.ids)], ['pos_order_id', 'payment_method_id'], ['amount:sum'])
+        ] if saved else []
+        rows += [(order, payment.payment_method_id, payment.amount)
+                 for order in self - saved for payment in order.payment_ids]
+        for order, method, amount in rows:
+            if method == order.config_id.gift_account_id:
+                totals[order.id]['prepayment_amount'] += amount
+            elif method.fiscal_payment_type == 'cash':
+                totals[order.id]['cash_amount'] += amount
+            elif method.fiscal_payment_type == 'bank':
+                totals[order.id]['bank_amount'] += amount
+        return totals
+
+    @api.depends('hdm_paid_cash', 'hdm_paid_card', 'hdm_paid_prepayment',
+                 'lines.refund_orderline_ids.order_id.hdm_paid_cash',
+                 'lines.refund_orderline_ids.order_id.hdm_paid_card',
+                 'lines.refund_orderline_ids.order_id.hdm_paid_prepayment')
+    def _compute_hdm_refundable(self):
+        """Refund ledger: what was paid minus what its refund orders paid back.
+
+        Recomputed only for the original order when one of its refunds is paid,
+        so validating a refund reads a single row instead of the refund chain.
+        """
+        for order in self:
+            refunds = order.lines.refund_orderline_ids.order_id
+            order.hdm_refundable_cash = order.hdm_paid_cash + sum(refunds.mapped('hdm_paid_cash'))
+            order.hdm_refundable_card = order.hdm_paid_card + sum(refunds.mapped('hdm_paid_card'))
+            order.hdm_refundable_prepayment = order.hdm_paid_prepayment + sum(refunds.mapped('hdm_paid_prepayment'))
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        orders = super().create(vals_list)
+        orders.filtered('hdm_outbox_id')._hdm_link_outbox()
+        return orders
+
+    def write(self, vals):
+        res = super().write(vals)
+        if vals.get('hdm_outbox_id'):
+            self._hdm_link_outbox()
+        return res
+
+    def _hdm_link_outbox(self):
+        """Attach receipts queued from the payment screen to their synced orders."""
+        for order in self:
+            entry = order.hdm_outbox_id.sudo()
+            entry.write({'res_model': order._name, 'res_id': order.id})
+            if entry.receipt_id and not order.fiscal_receipt_id:
+                entry.receipt_id.write({'related_model_name': order._name, 'related_model_id': order.id})
+                order.write({
+                    'hdm_success': True,
+                    'rseq': entry.receipt_id.rseq,
+                    'fiscal_uuid': entry.receipt_id.name,
+                    'fiscal_receipt_id': entry.receipt_id.id,
+                })
 
     @api.model
     def _order_fields(self, ui_order):
@@ -53,6 +157,8 @@ class PosOrder(models.Model):
             fields['fiscal_uuid'] = ui_order.get('fiscal_uuid')
         if ui_order.get('fiscal_receipt_id'):
             fields['fiscal_receipt_id'] = ui_order.get('fiscal_receipt_id', False)
+        if ui_order.get('hdm_outbox_id'):
+            fields['hdm_outbox_id'] = ui_order.get('hdm_outbox_id')
         return fields
 
     def hdm_type_display(self) -> list:
@@ -76,23 +182,12 @@ class PosOrder(models.Model):
 
     def _prepare_already_payd_hdm_data(self, hdm_dep, hdm_type, **kwargs) -> dict:
         self.ensure_one()
-        cash_amount, bank_amount = 0, 0
-        payments = self.payment_ids.filtered(
-            lambda p: p.payment_method_id.fiscal_payment_type in ['cash',
-                                                                  'bank'] and p.payment_method_id.id != self.config_id.gift_account_id.id)
-
-        used_prepayment = sum(self.payment_ids.filtered(
-            lambda p: p.payment_method_id.id == self.config_id.gift_account_id.id).mapped('amount'))
+        cash_amount, bank_amount = self.hdm_paid_cash, self.hdm_paid_card
+        used_prepayment = self.hdm_paid_prepayment
         down_payment_lines = self.get_downpayment_lines()
         if bool(down_payment_lines):
             used_prepayment += abs(sum(down_payment_lines.mapped('price_subtotal_incl')))
         prepayment_amount = used_prepayment if used_prepayment else 0.0
-
-        for payment in payments:
-            if payment.payment_method_id.fiscal_payment_type == 'cash':
-                cash_amount += payment.amount
-            elif payment.payment_method_id.fiscal_payment_type == 'bank':
-                bank_amount += payment.amount
         data = {
             "items": None,
             "paidAmount": round(cash_amount, 2),
@@ -109,8 +204,7 @@ class PosOrder(models.Model):
         if hdm_type == 1:
             data['dep'] = hdm_dep
         if hdm_type == 2:
-            data['items'] = [line._prepare_hdm_item_data(hdm_dep) for line in
-                             self.get_lines_without_downpayment()]
+            data['items'] = self.get_lines_without_downpayment()._prepare_hdm_items(hdm_dep)
         return data
 
     def _prepare_invoice_hdm_data(self, hdm_dep, hdm_type, payment_method_id, **kwargs) -> dict:
@@ -144,9 +238,8 @@ class PosOrder(models.Model):
         if hdm_type == 1:
             data['dep'] = hdm_dep
         if hdm_type == 2:
-            data['items'] = [line._prepare_hdm_item_data(hdm_dep) for line in
-                             self.get_lines_without_downpayment()]
-        print(data, 'INVOICE DATA')
+            data['items'] = self.get_lines_without_downpayment()._prepare_hdm_items(hdm_dep)
+        _logger.debug('HDM invoice data of %s: %s', self.name, data)
         return data
 
     def check_refund_status(self):
@@ -159,15 +252,16 @@ class PosOrder(models.Model):
         self.ensure_one()
         pos_id = f'pos_{self.config_id.id}'
         pos_config = self.config_id
-        pos_connection = pos_config.hdm_connection_id
         refunded_order = None
         for line in self.lines:
             if line.refunded_orderline_id and line.refunded_orderline_id.order_id:
                 refunded_order = line.refunded_orderline_id.order_id
                 break
-        if not refunded_order or not refunded_order.fiscal_receipt_id:
+        receipt = refunded_order._hdm_fiscal_receipt() if refunded_order else None
+        if not receipt:
             return
-        receipt = refunded_order.fiscal_receipt_id
+        # A return is only accepted by the device that printed the sale.
+        pos_connection = self.env['hdm.connection']._find_by_crn(receipt.crn) or pos_config.hdm_connection_id
         hdm_data = {
             'crn': str(receipt.crn),
             'returnTicketId': str(receipt.rseq),
@@ -175,26 +269,17 @@ class PosOrder(models.Model):
         }
         returnItemList = []
         if abs(refunded_order.amount_total) != abs(self.amount_total):
-            cash_amount = sum(
-                self.payment_ids.filtered(lambda
-                                              p: p.payment_method_id.fiscal_payment_type == 'cash' and p.payment_method_id.id != self.config_id.gift_account_id.id).mapped(
-                    'amount'))
-            bank_amount = sum(
-                self.payment_ids.filtered(lambda
-                                              p: p.payment_method_id.fiscal_payment_type == 'bank' and p.payment_method_id.id != self.config_id.gift_account_id.id).mapped(
-                    'amount'))
-            prepayment_amount = sum(self.payment_ids.filtered(
-                lambda p: p.payment_method_id.id == self.config_id.gift_account_id.id).mapped('amount'))
-            data = [l.id for l in refunded_order.lines.sorted('id')]
+            cash_amount = self.hdm_paid_cash
+            bank_amount = self.hdm_paid_card
+            prepayment_amount = self.hdm_paid_prepayment
+            positions = refunded_order._hdm_line_positions()
             for current_line in self.lines:
-                count = 0
-                for i in data:
-                    if current_line.refunded_orderline_id.id == i:
-                        returnItemList.append({
-                            "rpid": count,
-                            "quantity": abs(current_line.qty),
-                        })
-                    count += 1
+                rpid = positions.get(current_line.refunded_orderline_id.id)
+                if rpid is not None:
+                    returnItemList.append({
+                        "rpid": rpid,
+                        "quantity": abs(current_line.qty),
+                    })
 
             hdm_data.update({
                 "returnItemList": returnItemList,
@@ -202,29 +287,16 @@ class PosOrder(models.Model):
                 "prePaymentAmountForReturn": round(abs(prepayment_amount)),
                 "cardAmountForReturn": round(abs(bank_amount)),
             })
-        response = pos_connection.send_request_to_hdm(id=pos_id, code=6, data=hdm_data)
+        response = pos_connection.send_or_enqueue(id=pos_id, code=6, data=hdm_data, record=self, hdm_type=4)
         if response is False or response.get('hdm_error'):
-            pos_connection.create_log_entry(response.get('hdm_error', 'Unknown HDM error occurred.'),
+            pos_connection.create_log_entry(response and response.get('hdm_error') or 'Unknown HDM error occurred.',
                                             request_data=hdm_data,
                                             model=self._name, res_id=self.id)
             return response
+        if response.get('queued'):
+            return self._hdm_queued(response)
 
-        receipt_id = self.env['hdm.receipt'].sudo().create({
-            'rseq': response.get('rseq', ''),
-            'name': response.get('fiscal', ''),
-            'crn': response.get('crn', ''),
-            'related_model_name': self._name,
-            'related_model_id': self.id,
-            'hdm_type': str(4),
-            'total': response.get('total', 0.0),
-            'related_hdm_receipt_id': receipt.id,
-        })
-        self.write({
-            'hdm_success': True,
-            'rseq': response.get('rseq', ''),
-            'fiscal_uuid': response.get('fiscal', ''),
-            'fiscal_receipt_id': receipt_id.id,
-        })
+        self._hdm_apply_response(response, 4, related_receipt=receipt, connection=pos_connection)
         return {'success': True, 'fiscal_uuid': response.get('fiscal', '')}
 
     def hdm_receipt_send(self, hdm_type=False, hdm_dep=False, payment=False, *args, **kwargs):
@@ -233,117 +305,204 @@ class PosOrder(models.Model):
             return self.hdm_return_order()
         pos_id = f'pos_{self.config_id.id}'
         pos_config = self.config_id
-        pos_connection = pos_config.hdm_connection_id
         hdm_dep = int(hdm_dep) or int(pos_config.hdm_dep)
         hdm_type = int(hdm_type) or int(pos_config.hdm_type)
         self.write({'hdm_type': str(hdm_type)})
         hdm_data = self._prepare_invoice_hdm_data(hdm_dep, hdm_type, payment, **kwargs)
-        response = pos_connection.send_request_to_hdm(id=pos_id, code=4, data=hdm_data)
-        if response.get('hdm_error'):
-            pos_connection.create_log_entry(response.get('hdm_error', 'Unknown HDM error occurred.'), request_data=hdm_data,
-                                            model=self._name, res_id=self.id)
-            return response
+        connection, response = pos_config._hdm_pool().send_pooled(id=pos_id, code=4, data=hdm_data, record=self,
+                                                                  hdm_type=hdm_type)
+        if response is False or response.get('hdm_error'):
+            connection.create_log_entry(response and response.get('hdm_error') or 'Unknown HDM error occurred.',
+                                        request_data=hdm_data, model=self._name, res_id=self.id)
+            return response or {'hdm_error': 'Unknown HDM error occurred.'}
+        if response.get('queued'):
+            return self._hdm_queued(response)
 
         if response:
             receipt = response.get('fiscal', '')
-            receipt_id = self.env['hdm.receipt'].sudo().create({
-                'rseq': response.get('rseq', ''),
-                'name': receipt,
-                'crn': response.get('crn', ''),
-                'related_model_name': self._name,
-                'related_model_id': self.id,
-                'hdm_type': str(hdm_type),
-                'total': response.get('total', 0.0),
-            })
+            self._hdm_apply_response(response, hdm_type, connection=connection)
+            return {'success': True, 'fiscal_uuid': receipt}
+
+    def _hdm_apply_response(self, response, hdm_type, related_receipt=None, connection=None):
+        """Store the fiscal receipt returned by ``connection``, a device of the till's pool, on the order."""
+        self.ensure_one()
+        connection = connection or self.config_id.hdm_connection_id
+        line_ids = None
+        if not related_receipt and int(hdm_type) == 2:
+            line_ids = self.get_lines_without_downpayment().ids
+        with HDM_METRICS.timed(connection.hdm_metrics_device if connection else 'unknown',
+                               6 if related_receipt else 4, 'write'):
+            receipt_id = self.env['hdm.receipt']._create_from_response(response, hdm_type, record=self,
+                                                                       related_receipt=related_receipt,
+                                                                       line_ids=line_ids)
             self.write({
                 'hdm_success': True,
                 'rseq': response.get('rseq', ''),
-                'fiscal_uuid': receipt,
+                'fiscal_uuid': response.get('fiscal', ''),
                 'fiscal_receipt_id': receipt_id.id,
             })
-            return {'success': True, 'fiscal_uuid': receipt}
+        return receipt_id
+
+    def _hdm_line_positions(self) -> dict:
+        """``{line id: rpid}`` of the fiscal receipt of this order.
+
+        Read from the index stored with the receipt; receipts printed before it
+        existed fall back to the position of the line among the order lines.
+        """
+        self.ensure_one()
+        return self._hdm_fiscal_receipt()._get_line_positions() or {
+            line_id: position for position, line_id in enumerate(self.lines.sorted('id').ids)}
+
+    def _hdm_fiscal_receipt(self):
+        """Sale receipt of this order.
+
+        Orders not linked to their receipt are matched by the sequence number
+        the device printed, when a single device of the point of sale has a
+        receipt under it, then by source document.
+        """
+        self.ensure_one()
+        if self.fiscal_receipt_id:
+            return self.fiscal_receipt_id
+        receipts = self.env['hdm.receipt'].sudo()
+        if self.rseq:
+            matches = receipts.union(*(receipts._find_by_number(crn, self.rseq)
+                                       for crn in self.config_id._hdm_pool().mapped('hdm_crn')))
+            if len(matches) == 1:
+                return matches
+        return receipts._find_for_record(self)
+
+    @api.model
+    def search_hdm_receipt(self, fiscal_code, limit=10) -> list:
+        """Receipts whose fiscal code matches ``fiscal_code``, with the POS order they were printed for."""
+        receipts = self.env['hdm.receipt'].search_fiscal_code(fiscal_code, limit=limit)
+        orders = self.search_fetch([('fiscal_receipt_id', 'in', [receipt['id'] for receipt in receipts])],
+                                   ['fiscal_receipt_id', 'pos_reference'])
+        order_by_receipt = {order.fiscal_receipt_id.id: order for order in orders}
+        for receipt in receipts:
+            order = order_by_receipt.get(receipt['id'])
+            if not order and receipt['related_model_name'] == self._name:
+                order = self.browse(receipt['related_model_id']).exists()
+            receipt['pos_order_id'] = order.id if order else False
+            receipt['pos_reference'] = order.pos_reference if order else False
+        return receipts
+
+    def _hdm_queued(self, response):
+        self.ensure_one()
+        self.write({'hdm_outbox_id': response['hdm_outbox_id']})
+        return {'success': True, 'queued': True, 'hdm_outbox_id': response['hdm_outbox_id']}
+
+    def _hdm_outbox_done(self, entry, response):
+        """Called by the outbox once the queued receipt of this order was printed."""
+        self.ensure_one()
+        related_receipt = None
+        if entry.code == 6:
+            refunded_order = self.lines.refunded_orderline_id.order_id[:1]
+            related_receipt = refunded_order and refunded_order._hdm_fiscal_receipt() or None
+        receipt = self._hdm_apply_response(response, entry.hdm_type or (4 if entry.code == 6 else self.hdm_type),
+                                           related_receipt=related_receipt, connection=entry.connection_id)
+        if entry.interactive:
+            self._hdm_kiosk_paid()
+        return receipt
+
+    def _hdm_outbox_failed(self, entry, error):
+        """Called by the outbox when the queued receipt of this order could not be printed."""
+        self.ensure_one()
+        if entry.interactive and self.state == 'draft':
+            _logger.error('HDM kiosk payment of %s failed: %s', self.pos_reference, error)
+            self._send_payment_result('fail')
+            self._hdm_notify_kiosk('fail', error=error)
+
+    def _hdm_kiosk_paid(self):
+        """Pay the kiosk order whose receipt was printed and tell the kiosk."""
+        self.ensure_one()
+        if self.state != 'draft' or not self.hdm_kiosk_payment_method_id:
+            return
+        self.add_payment({
+            'amount': self.amount_total,
+            'payment_method_id': self.hdm_kiosk_payment_method_id.id,
+            'payment_status': 'done',
+            'pos_order_id': self.id,
+        })
+        self.action_pos_order_paid()
+        self._send_payment_result('Success')
+        self._hdm_notify_kiosk('success')
+
+    def _hdm_notify_kiosk(self, status, error=False):
+        self.ensure_one()
+        self.config_id._notify('HDM_PAYMENT_STATUS', {
+            'order_id': self.id,
+            'status': status,
+            'fiscal_uuid': self.fiscal_uuid or False,
+            'error': error,
+        })
 
     def get_all_payment_total(self):
-        totals = {'cash_amount': 0.0, 'bank_amount': 0.0, 'prepayment_amount': 0.0}
-        for order in self:
-            payment_totals = order.get_current_payment_total()
-            totals['cash_amount'] += payment_totals['cash_amount']
-            totals['bank_amount'] += payment_totals['bank_amount']
-            totals['prepayment_amount'] += payment_totals['prepayment_amount']
+        totals = dict.fromkeys(PAYMENT_TOTAL_KEYS, 0.0)
+        for order_totals in self._hdm_payment_totals().values():
+            for key in PAYMENT_TOTAL_KEYS:
+                totals[key] += order_totals[key]
         return totals
 
     def get_current_payment_total(self):
         self.ensure_one()
-        cash_amount = sum(
-            self.payment_ids.filtered(lambda
-                                          p: p.payment_method_id.fiscal_payment_type == 'cash' and p.payment_method_id.id != self.config_id.gift_account_id.id).mapped(
-                'amount'))
-        bank_amount = sum(
-            self.payment_ids.filtered(lambda
-                                          p: p.payment_method_id.fiscal_payment_type == 'bank' and p.payment_method_id.id != self.config_id.gift_account_id.id).mapped(
-                'amount'))
-        prepayment_amount = sum(self.payment_ids.filtered(
-            lambda p: p.payment_method_id.id == self.config_id.gift_account_id.id).mapped('amount'))
         return {
-            'cash_amount': cash_amount,
-            'bank_amount': bank_amount,
-            'prepayment_amount': prepayment_amount,
+            'cash_amount': self.hdm_paid_cash,
+            'bank_amount': self.hdm_paid_card,
+            'prepayment_amount': self.hdm_paid_prepayment,
         }
 
     def get_refunded_orders_remaining_payments(self):
+        """Amounts of the refunded orders that this refund may still pay back.
+
+        Read from the refund ledger of the original orders; this order's own
+        payments are added back since every ledger it refunds already counts them.
+        """
         self.ensure_one()
-        refunded_orders = self.refunded_order_ids
-        total_refunded_payments = {
-            'cash_amount': 0,
-            'bank_amount': 0,
-            'prepayment_amount': 0,
+        return self._hdm_remaining_refundable(self.refunded_order_ids)
+
+    def _hdm_remaining_refundable(self, refunded_orders) -> dict:
+        self.ensure_one()
+        count = len(refunded_orders)
+        return {
+            'cash_amount': sum(refunded_orders.mapped('hdm_refundable_cash')) - count * self.hdm_paid_cash,
+            'bank_amount': sum(refunded_orders.mapped('hdm_refundable_card')) - count * self.hdm_paid_card,
+            'prepayment_amount': sum(refunded_orders.mapped('hdm_refundable_prepayment'))
+                                 - count * self.hdm_paid_prepayment,
         }
-        for order in refunded_orders:
-
-            cash_amount = sum(
-                order.payment_ids.filtered(lambda
-                                               p: p.payment_method_id.fiscal_payment_type == 'cash' and p.payment_method_id.id != order.config_id.gift_account_id.id).mapped(
-                    'amount'))
-            bank_amount = sum(
-                order.payment_ids.filtered(lambda
-                                               p: p.payment_method_id.fiscal_payment_type == 'bank' and p.payment_method_id.id != order.config_id.gift_account_id.id).mapped(
-                    'amount'))
-            prepayment_amount = sum(order.payment_ids.filtered(
-                lambda p: p.payment_method_id.id == order.config_id.gift_account_id.id).mapped('amount'))
-            total_refunded_payments.update({
-                'cash_amount': total_refunded_payments.get('cash_amount', 0) + cash_amount,
-                'bank_amount': total_refunded_payments.get('bank_amount', 0) + bank_amount,
-                'prepayment_amount': total_refunded_payments.get('prepayment_amount', 0) + prepayment_amount,
-            })
-            another_refund = order.mapped('lines.refund_orderline_ids.order_id').ids
-            if another_refund:
-                refund = {i for i in another_refund if i != self.id}
-                another_refund = self.env['pos.order'].browse(refund)
-                another_refunds_totals = another_refund.get_all_payment_total()
-                total_refunded_payments.update({
-                    'cash_amount': total_refunded_payments['cash_amount'] + another_refunds_totals['cash_amount'],
-                    'bank_amount': total_refunded_payments['bank_amount'] + another_refunds_totals['bank_amount'],
-                    'prepayment_amount': total_refunded_payments['prepayment_amount'] + another_refunds_totals[
-                        'prepayment_amount'],
-                })
 
-        return total_refunded_payments
+    def _hdm_refunded_origins(self) -> dict:
+        """``{order id: refunded orders}`` for the refunds in ``self``, read in one grouped query.
+
+        Read as superuser, like ``_hdm_payment_totals``, so the ledger checks see every refunded line.
+        """
+        groups = self.env['pos.order.line'].sudo()._read_group(
+            [('order_id', 'in', self.ids), ('refunded_orderline_id', '!=', False)],
+            ['order_id', 'refunded_orderline_id.order_id'],
+        )
+        origins = {}
+        for order, refunded_order in groups:
+            origins[order.id] = origins.get(order.id, self.browse()) | refunded_order.with_env(self.env)
+        return origins
 
     def check_extra_rules(self):
+        """Refunds must go back through the payment types of their original orders, up to their ledger.
+
+        Origins, refund ledgers and payment totals are read for the whole
+        batch at once, so syncing many orders does not cost queries per order.
+        """
         super().check_extra_rules()
+        origins_by_order = self._hdm_refunded_origins()
+        if not origins_by_order:
+            return
+        self.browse(list(origins_by_order)).fetch(['hdm_paid_cash', 'hdm_paid_card', 'hdm_paid_prepayment'])
+        self.browse().union(*origins_by_order.values()).fetch(
+            ['hdm_refundable_cash', 'hdm_refundable_card', 'hdm_refundable_prepayment'])
         for current_order in self:
-            refunded_order = None
-            for line in current_order.lines:
-                if line.refunded_orderline_id and line.refunded_orderline_id.order_id:
-                    refunded_order = line.refunded_orderline_id.order_id
-                    break
-            if not refunded_order:
+            if current_order.id not in origins_by_order:
                 continue
-            refunded_payments = current_order.get_refunded_orders_remaining_payments()
-            _logger.info(f"{refunded_payments}, 'refunded_payments'")
-
+            refunded_payments = current_order._hdm_remaining_refundable(origins_by_order[current_order.id])
             current_payments = current_order.get_current_payment_total()
-            _logger.info(f"{current_payments}, 'current_payments'")
+            _logger.debug('Refund %s: remaining %s, current %s', current_order.id, refunded_payments, current_payments)
             for payment_type in ['cash_amount', 'bank_amount', 'prepayment_amount']:
                 original = refunded_payments.get(payment_type, 0.0)
                 refund = current_payments.get(payment_type, 0.0)
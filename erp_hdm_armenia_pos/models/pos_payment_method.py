@@ -1,4 +1,5 @@
 from odoo import api, fields, models, _, Command
+from odoo.exceptions import UserError
 from odoo.fields import Domain
 
 import logging
@@ -36,8 +37,9 @@ class PosPaymentMethod(models.Model):
         return domain
 
     def _construct_hdm_connection(self, pos_config, hdm_dep=False, hdm_type=False):
+        """The device pool of ``pos_config``, the caller id and the department and mode to print with."""
         pos_id = f'pos_{pos_config.id}'
-        pos_connection = pos_config.hdm_connection_id
+        pos_connection = pos_config._hdm_pool()
         hdm_dep = hdm_dep or pos_config.hdm_dep
         hdm_type = hdm_type or pos_config.hdm_type
         return pos_connection, pos_id, int(hdm_dep), int(hdm_type)
@@ -49,24 +51,30 @@ class PosPaymentMethod(models.Model):
             return self.hdm_kiosk_payment_request(order)
 
     def _prepare_hdm_item_data(self, lines, hdm_dep=False):
+        """Items of a basket sent by the POS as parallel arrays.
+
+        ``lines`` is ``{'product_ids': [...], 'qty': [...], 'price_unit': [...], 'discount': [...]}``;
+        the fiscal data of the products is read here, once for the whole basket.
+        """
+        product_ids = lines['product_ids']
+        fiscal_data = self.env['product.product'].browse(set(product_ids))._get_hdm_fiscal_data()
         items = []
-        for line in lines:
-            product_id = self.env['product.product'].browse(line.get('product_id'))
+        for product_id, qty, price_unit, discount in zip(product_ids, lines['qty'], lines['price_unit'],
+                                                         lines['discount']):
+            product = fiscal_data.get(product_id, {})
             item = {
-                "dep": product_id.hdm_dep or hdm_dep,
-                "adgCode": product_id.hs_code or product_id.product_tmpl_id and product_id.product_tmpl_id.hs_code,
-                "productCode": product_id.id,
-                "productName": product_id.hdm_product_name,
-                "qty": line.get('qty', 1),
-                "unit": product_id.uom_id.name,
-                "price": round(
-                    line.get('price_unit', 1) * line.get('discount') / 100 if line.get('discount', 0) else line.get(
-                        'price_unit', 1), 2),
+                "dep": product.get('dep') or hdm_dep,
+                "adgCode": product.get('adgCode', False),
+                "productCode": product_id,
+                "productName": product.get('productName', False),
+                "qty": qty,
+                "unit": product.get('unit', False),
+                "price": round(price_unit * discount / 100 if discount else price_unit, 2),
             }
-            if line.get('discount', 0):
+            if discount:
                 item.update({
                     'discountType': 1,
-                    'discount': line['discount']
+                    'discount': discount
                 })
             if hdm_dep:
                 item['dep'] = 1
@@ -88,13 +96,11 @@ class PosPaymentMethod(models.Model):
         }
         if hdm_type == 1:
             data['dep'] = hdm_dep
-        print(hdm_type, lines, 'CHECK THIS')
         if hdm_type == 2 and lines:
             data['items'] = self._prepare_hdm_item_data(lines, hdm_dep)
         return data
 
     def hdm_pos_payment_request(self, config_id, amount, lines=False, hdm_dep=False, hdm_type=False, *args, **kwargs):
-        print("HDM POS PAYMENT REQUEST CALLED", lines)
         pos_config = self.env['pos.config'].browse(config_id)
         pos_connection, pos_id, hdm_dep, hdm_type = self._construct_hdm_connection(pos_config, hdm_dep, hdm_type)
 
@@ -111,11 +117,13 @@ class PosPaymentMethod(models.Model):
             if self.use_ext_pos:
                 updated_data["useExtPOS"] = True
         data.update({**kwargs, **updated_data})
-        response = pos_connection.send_request_to_hdm(id=pos_id, code=4, data=data)
+        connection, response = pos_connection.send_pooled(id=pos_id, code=4, data=data, hdm_type=hdm_type)
         if response is False or response.get('hdm_error'):
-            pos_connection.create_log_entry(response.get('hdm_error', 'Unknown HDM error occurred.'), request_data=data,
-                                            model=self._name)
+            connection.create_log_entry(response and response.get('hdm_error') or 'Unknown HDM error occurred.',
+                                        request_data=data, model=self._name)
             return response
+        if response.get('queued'):
+            return {'success': True, 'queued': True, 'hdm_outbox_id': response['hdm_outbox_id']}
         if response:
             receipt = response.get('fiscal', '')
             receipt_id = self.env['hdm.receipt'].sudo().create({
@@ -134,16 +142,21 @@ class PosPaymentMethod(models.Model):
     def hdm_pos_payment_refund(self, config_id, amount, refunded_line_id, lines=False, hdm_dep=False, hdm_type=False,
                                *args,
                                **kwargs):
+        """``refunded_line_id`` holds the ids of the refunded order lines, the receipt is the one of their order."""
         pos_config = self.env['pos.config'].browse(config_id)
-        pos_connection, pos_id, _, _ = self._construct_hdm_connection(pos_config)
+        pos_id = f'pos_{pos_config.id}'
 
-        order = self.env['pos.order.line'].browse(refunded_line_id[0]).order_id
-        if not order.fiscal_receipt_id:
+        refunded_line_id = [line_id for line_id in refunded_line_id if line_id]
+        order = self.env['pos.order.line'].browse(refunded_line_id[:1]).order_id
+        receipt = order._hdm_fiscal_receipt() if order else None
+        if not receipt:
             return {'hdm_error': 'Original fiscal receipt not found for refund.'}
+        # A return is only accepted by the device that printed the sale.
+        pos_connection = self.env['hdm.connection']._find_by_crn(receipt.crn) or pos_config.hdm_connection_id
 
         hdm_data = {
-            'crn': str(order.fiscal_receipt_id.crn),
-            'returnTicketId': str(order.fiscal_receipt_id.rseq),
+            'crn': str(receipt.crn),
+            'returnTicketId': str(receipt.rseq),
             'seq': pos_connection.hdm_seq,
         }
 
@@ -156,18 +169,20 @@ class PosPaymentMethod(models.Model):
                 "cardAmountForReturn": abs(round(amount, 2)),
             }
         hdm_data.update({**kwargs, **updated_data})
-        response = pos_connection.send_request_to_hdm(id=pos_id, code=6, data=hdm_data)
-        if response.get('hdm_error'):
-            pos_connection.create_log_entry(response.get('hdm_error', 'Unknown HDM error occurred.'), request_data=hdm_data,
-                                            model=self._name)
+        response = pos_connection.send_or_enqueue(id=pos_id, code=6, data=hdm_data, hdm_type=4)
+        if response is False or response.get('hdm_error'):
+            pos_connection.create_log_entry(response and response.get('hdm_error') or 'Unknown HDM error occurred.',
+                                            request_data=hdm_data, model=self._name)
             return response
+        if response.get('queued'):
+            return {'success': True, 'queued': True, 'hdm_outbox_id': response['hdm_outbox_id']}
         receipt_id = self.env['hdm.receipt'].sudo().create({
             'rseq': response.get('rseq', ''),
             'name': response.get('fiscal', ''),
             'crn': response.get('crn', ''),
             'hdm_type': str(4),
             'total': response.get('total', 0.0),
-            'related_hdm_receipt_id': order.fiscal_receipt_id.id,
+            'related_hdm_receipt_id': receipt.id,
         })
         return {
             'success': True,
@@ -176,19 +191,21 @@ class PosPaymentMethod(models.Model):
         }
 
     def hdm_kiosk_payment_request(self, order):
+        """Queue the fiscal receipt of a kiosk order and answer at once.
+
+        The kiosk cron of the outbox sends it to the device; the order is then
+        paid and the result is pushed to the kiosk over the bus (see
+        ``pos.order._hdm_outbox_done``).
+        """
         self.ensure_one()
-        hdm_response = order.hdm_receipt_send(False, False, self)
-        if hdm_response.get('success') and hdm_response.get('fiscal_uuid'):
-            order.add_payment({
-                'amount': order.amount_total,
-                'payment_method_id': self.id,
-                'payment_status': 'done',
-                'pos_order_id': order.id,
-            })
-            order.action_pos_order_paid()
-            order._send_payment_result('Success')
-            return 'success'
-        elif hdm_response.get('hdm_error'):
-            order._send_payment_result('fail')
-            _logger.error(f'HDM Payment Error: {hdm_response.get("hdm_error")}')
-            return 'fail'
+        pos_config = order.config_id
+        pos_connection, _pos_id, hdm_dep, hdm_type = self._construct_hdm_connection(pos_config)
+        connection = pos_connection._hdm_route()[:1]
+        if not connection:
+            raise UserError(_("No HDM device is set for %(pos)s. Please ask the staff for help.", pos=pos_config.name))
+        order.write({'hdm_type': str(hdm_type), 'hdm_kiosk_payment_method_id': self.id})
+        hdm_data = order._prepare_invoice_hdm_data(hdm_dep, hdm_type, self)
+        entry = self.env['hdm.outbox'].enqueue(connection, 4, hdm_data, record=order, hdm_type=hdm_type,
+                                               interactive=True)
+        order.write({'hdm_outbox_id': entry.id})
+        return 'pending'
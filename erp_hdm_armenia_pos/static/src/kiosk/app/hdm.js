@@ -33,6 +33,8 @@ export class Hdm {
     async startPayment(order) {
          await this.processPayment(order);
     }
+    // The server only queues the fiscal receipt and answers "pending"; the
+    // result arrives over the bus (PAYMENT_STATUS and HDM_PAYMENT_STATUS).
     async processPayment(order) {
         try {
             const initial_response = await rpc(`/kiosk/payment/${this.pos_config.id}/kiosk`, {
@@ -1,5 +1,7 @@
 import { patch } from "@web/core/utils/patch";
 import { PaymentPage } from "@pos_self_order/app/pages/payment_page/payment_page";
+import { _t } from "@web/core/l10n/translation";
+import { HdmError } from "@erp_hdm_armenia_pos/kiosk/app/hdm";
 
 patch(PaymentPage.prototype, {
     async startPayment() {
@@ -9,6 +11,10 @@ patch(PaymentPage.prototype, {
         );
 
         if (paymentMethod.use_payment_terminal === "hdm") {
+            if (this.selfOrder.hdmStatus === "down") {
+                this.selfOrder.handleHdmError(new HdmError(_t("The fiscal printer is offline.")));
+                return;
+            }
             await this.selfOrder.hdm.startPayment(this.selfOrder.currentOrder);
         } else {
             await super.startPayment(...arguments);
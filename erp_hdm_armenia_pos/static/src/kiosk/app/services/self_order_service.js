@@ -1,5 +1,6 @@
 import { patch } from "@web/core/utils/patch";
 import { SelfOrder } from "@pos_self_order/app/services/self_order_service";
+import { _t } from "@web/core/l10n/translation";
 import { Hdm, HdmError } from "@erp_hdm_armenia_pos/kiosk/app/hdm";
 
 patch(SelfOrder.prototype, {
@@ -11,6 +12,17 @@ patch(SelfOrder.prototype, {
         );
 
         if (hdmPaymentMethod) {
+            this.hdmStatus = this.config.hdm_status || "unknown";
+            this.data.connectWebSocket("HDM_STATUS", (payload) => {
+                this.hdmStatus = payload.status;
+            });
+            // The receipt is printed in the background; PAYMENT_STATUS moves the page on,
+            // this only tells the customer why a payment failed.
+            this.data.connectWebSocket("HDM_PAYMENT_STATUS", (payload) => {
+                if (payload.status === "fail" && payload.order_id === this.currentOrder?.id) {
+                    this.handleHdmError(new HdmError(payload.error || _t("The payment failed.")));
+                }
+            });
             this.hdm = new Hdm(
                 this.env,
                 hdmPaymentMethod,
@@ -38,7 +50,7 @@ patch(SelfOrder.prototype, {
     },
     filterPaymentMethods(paymentMethods) {
         let methods = super.filterPaymentMethods(...arguments);
-        if (this.hdm) {
+        if (this.hdm && this.hdmStatus !== "down") {
             methods.push(this.hdm.paymentMethod);
         }
         return methods;
@@ -10,6 +10,9 @@ patch(PosOrder.prototype, {
         if (this.fiscal_receipt_id && !data.fiscal_receipt_id) {
             data.fiscal_receipt_id = this.fiscal_receipt_id;
         }
+        if (this.hdm_outbox_id && !data.hdm_outbox_id) {
+            data.hdm_outbox_id = this.hdm_outbox_id;
+        }
         return data;
     },
 });
@@ -25,24 +25,25 @@ export class HdmPaymentArmeniaPos extends PaymentInterface {
          if (paymentLine.amount !== order.priceIncl){
             this._showError('Payment line amount must be equal to order total amount when use HDM fiscal printer')
          }
-         let refunded_lines = []
-         for (const line of order.lines) {
-                console.log(line.serializeForORM())
-                console.log(line.serializeForORM()?.refunded_orderline_id)
-                refunded_lines.push(line.serializeForORM()?.refunded_orderline_id)
-         }
-
          let result = {}
-         const lines = order.lines.map(line => line.serializeForORM())
          if (order.is_refund){
-            result = await this.env.services.orm.call("pos.payment.method", "hdm_pos_payment_refund", [[this.payment_method_id.id], this.pos.config.id, paymentLine.amount, refunded_lines, lines])
+            const refunded_lines = order.lines.map((line) => line.refunded_orderline_id?.id).filter(Boolean)
+            result = await this.env.services.orm.call("pos.payment.method", "hdm_pos_payment_refund", [[this.payment_method_id.id], this.pos.config.id, paymentLine.amount, refunded_lines])
          } else {
-            result = await this.env.services.orm.call("pos.payment.method", "hdm_pos_payment_request", [[this.payment_method_id.id], this.pos.config.id, paymentLine.amount, lines])
+            result = await this.env.services.orm.call("pos.payment.method", "hdm_pos_payment_request", [[this.payment_method_id.id], this.pos.config.id, paymentLine.amount, this._hdmLines(order)])
          }
          try {
              if ("success" in result){
-                 order.fiscal_uuid = result.fiscal_uuid
-                 order.fiscal_receipt_id = result.fiscal_receipt_id
+                 if (result.queued) {
+                     order.hdm_outbox_id = result.hdm_outbox_id
+                     this.env.services.notification.add(
+                         "HDM is unreachable, the fiscal receipt will be printed when it is back.",
+                         { type: "warning" }
+                     )
+                 } else {
+                     order.fiscal_uuid = result.fiscal_uuid
+                     order.fiscal_receipt_id = result.fiscal_receipt_id
+                 }
                  paymentLine.setPaymentStatus('done')
                 return true
              } else {
@@ -53,6 +54,17 @@ export class HdmPaymentArmeniaPos extends PaymentInterface {
          }
 
 
+    }
+    // Basket as parallel arrays; the server reads the fiscal data of the products itself.
+    _hdmLines(order) {
+        const lines = { product_ids: [], qty: [], price_unit: [], discount: [] }
+        for (const line of order.lines) {
+            lines.product_ids.push(line.product_id.id)
+            lines.qty.push(line.qty)
+            lines.price_unit.push(line.price_unit)
+            lines.discount.push(line.discount || 0)
+        }
+        return lines
     }
     _showError(error_msg) {
         this.env.services.dialog.add(AlertDialog, {
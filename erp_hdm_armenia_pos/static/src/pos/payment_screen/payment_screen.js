@@ -1,6 +1,7 @@
 import { PaymentScreen } from "@point_of_sale/app/screens/payment_screen/payment_screen";
 import { patch } from "@web/core/utils/patch";
 import { onMounted } from "@odoo/owl";
+import { _t } from "@web/core/l10n/translation";
 
 patch(PaymentScreen.prototype, {
     setup() {
@@ -19,6 +20,12 @@ patch(PaymentScreen.prototype, {
     },
 
     async addNewPaymentLine(paymentMethod) {
+        if (paymentMethod.use_payment_terminal === "hdm" && this.pos.hdmDown) {
+            this.notification.add(_t("The HDM devices of this point of sale are offline."), {
+                type: "warning",
+            });
+            return false;
+        }
         if (paymentMethod.use_payment_terminal === "hdm" && this.isRefundOrder) {
             const refundedOrder = this.currentOrder.lines[0]?.refunded_orderline_id?.order_id;
             if (!refundedOrder){return await super.addNewPaymentLine(paymentMethod);}
@@ -0,0 +1,16 @@
+import { PosStore } from "@point_of_sale/app/services/pos_store";
+import { patch } from "@web/core/utils/patch";
+
+patch(PosStore.prototype, {
+    async setup() {
+        await super.setup(...arguments);
+        // Online when a device of the pool is, offline when all of them are; see pos.config.hdm_status.
+        this.hdmStatus = this.config.hdm_status || "unknown";
+        this.data.connectWebSocket("HDM_STATUS", (payload) => {
+            this.hdmStatus = payload.status;
+        });
+    },
+    get hdmDown() {
+        return this.hdmStatus === "down";
+    },
+});
@@ -0,0 +1,60 @@
+from odoo import Command
+from odoo.tests.common import tagged
+
+from odoo.addons.point_of_sale.tests.common import TestPoSCommon
+
+
+@tagged('post_install', '-at_install')
+class TestHdmRefundLedger(TestPoSCommon):
+
+    def setUp(self):
+        super().setUp()
+        self.config = self.basic_config
+        self.product = self.create_product('HDM Product', self.categ_basic, 100.0)
+        self.open_new_session()
+
+    def paid_order(self, payments):
+        order = self.env['pos.order'].create({
+            'session_id': self.pos_session.id,
+            'lines': [Command.create({
+                'product_id': self.product.id,
+                'qty': 1,
+                'price_unit': 100.0,
+                'price_subtotal': 100.0,
+                'price_subtotal_incl': 100.0,
+            })],
+            'amount_tax': 0.0,
+            'amount_total': 100.0,
+            'amount_paid': 0.0,
+            'amount_return': 0.0,
+        })
+        self.pay(order, payments)
+        return order
+
+    def pay(self, order, payments):
+        for method, amount in payments:
+            order.add_payment({'pos_order_id': order.id, 'payment_method_id': method.id, 'amount': amount})
+
+    def test_paid_amounts_by_fiscal_type(self):
+        order = self.paid_order([(self.cash_pm1, 60.0), (self.bank_pm1, 40.0)])
+        self.assertRecordValues(order, [{
+            'hdm_paid_cash': 60.0,
+            'hdm_paid_card': 40.0,
+            'hdm_paid_prepayment': 0.0,
+            'hdm_refundable_cash': 60.0,
+            'hdm_refundable_card': 40.0,
+        }])
+
+    def test_refunds_reduce_the_ledger(self):
+        order = self.paid_order([(self.cash_pm1, 60.0), (self.bank_pm1, 40.0)])
+        refund = order._refund()
+        self.pay(refund, [(self.cash_pm1, -50.0)])
+        self.assertRecordValues(order, [{'hdm_refundable_cash': 10.0, 'hdm_refundable_card': 40.0}])
+        # The refund's own payment is counted in the ledger it checks against, so it is added back.
+        self.assertEqual(refund.get_refunded_orders_remaining_payments(),
+                         {'cash_amount': 60.0, 'bank_amount': 40.0, 'prepayment_amount': 0.0})
+
+        second = order._refund()
+        self.pay(second, [(self.cash_pm1, -10.0)])
+        self.assertRecordValues(order, [{'hdm_refundable_cash': 0.0, 'hdm_refundable_card': 40.0}])
+        self.assertEqual(second.get_refunded_orders_remaining_payments()['cash_amount'], 10.0)